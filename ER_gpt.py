@@ -1,17 +1,28 @@
 import os
 import json
-import openai
 import pandas as pd
 import argparse
+import asyncio
 from dotenv import load_dotenv
+from api_call import request_completion
+from async_runner import run_cases
+from case_store import load_sheet
+from incremental import add_incremental_args, cell_inputs, check_cells
+from key_pool import add_retry_args, backoff_delay, single_key_pool
+from prompt_templates import add_layout_args, compile_prompt, prompt_hash
+from response_cache import ResponseCache, add_cache_args, cache_from_args
+from response_log import add_replay_args, log_response, replay_dirs
+from response_parser import ResponseParseError, parse_response
+from run_journal import RunJournal
+from sharding import add_shard_args, shard_cases, write_manifest
+from streaming import add_stream_args, cutoff_fields_for
+from telemetry import add_request, add_telemetry_args, telemetry_from_args
 
 # Load environment variables from .env file
 load_dotenv()
 
-def api_call_text(client, model, system_prompt, user_prompt, case_name, max_tokens, temperature, save_dir):
-    tokens = 0
-
-    response = client.chat.completions.create(
+async def api_call_text(client, model, system_prompt, user_prompt, case_name, max_tokens, temperature, save_dir, cache=None, rep=None, stream=False, cutoff_fields=None, metrics=None, max_retries=2):
+    request = dict(
         model=model,
         messages=[
             {"role": "system", "content": system_prompt},
@@ -20,17 +31,122 @@ def api_call_text(client, model, system_prompt, user_prompt, case_name, max_toke
         max_tokens=max_tokens,  # Limit the response to a short answer
         temperature=temperature,  # Controls the randomness
     )
-    
-    with open('./res.txt', 'w') as f:
-        f.write(f"Case: {case_name}\n")
-        f.write(f"System Prompt:\n{system_prompt}\n")
-        f.write(f"User Prompt:\n{user_prompt}\n\n")
-        f.write(f"Raw API Response:\n{response.choices[0].message.content}\n")
-
-    result = response.choices[0].message.content
-    tokens += response.usage.total_tokens
-    
-    result_dict = json.loads(result)
+
+    (t1, t2, t3), tokens = await request_completion(client, request, case_name, save_dir, lambda result, metrics: save_result(result, case_name, save_dir, metrics),
+                                                    cache=cache, rep=rep, stream=stream, cutoff_fields=cutoff_fields, metrics=metrics, max_retries=max_retries)
+    return t1, t2, t3, tokens
+
+# Models that reject `n` > 1 (reasoning models); their samples are requested as parallel calls
+SINGLE_CHOICE_MODELS = ('o1', 'o3', 'o4')
+
+def supports_n(model):
+    return not model.startswith(SINGLE_CHOICE_MODELS)
+
+def split_tokens(total, k):
+    """
+    Share the tokens of one multi-choice call between its k samples (summing to the total).
+    """
+    if total is None:
+        return [None] * k
+    return [total // k + (i < total % k) for i in range(k)]
+
+async def _counted_create(client, request, metrics):
+    response = await client.chat.completions.create(**request)
+    add_request(metrics, response.usage)
+    return response
+
+async def sample_choices(client, request, k, metrics):
+    """
+    k completions of the same request: one call with n=k where the model supports it, else k
+    parallel calls. Returns (contents, tokens of each content, number of contents sharing its call).
+    """
+    responses = []
+    if k > 1 and supports_n(request['model']):
+        responses.append(await _counted_create(client, {**request, "n": k}, metrics))
+    # Parallel single calls for models without `n` (or for choices missing from the n=k response)
+    missing = k - sum(len(response.choices) for response in responses)
+    responses += await asyncio.gather(*(_counted_create(client, request, metrics) for _ in range(missing)))
+
+    contents, tokens, shares = [], [], []
+    for response in responses:
+        choices = sorted(response.choices, key=lambda choice: choice.index)
+        contents += [choice.message.content for choice in choices]
+        tokens += split_tokens(None if response.usage is None else response.usage.total_tokens, len(choices))
+        shares += [len(choices)] * len(choices)
+    return contents[:k], tokens[:k], shares[:k]
+
+async def api_call_samples(client, model, system_prompt, user_prompt, case_name, max_tokens, temperature, save_dirs, reps, cache=None, metrics=None, max_retries=2):
+    """
+    One sample of the same prompt for each rep in `reps`, saved to the matching `save_dirs`.
+    The samples share a single request (see sample_choices) and are cached under the same keys as
+    single-rep runs; only samples that cannot be parsed are requested again.
+    Returns a list of (t1, t2, t3, tokens, samples) in the order of `reps`, where samples is the
+    number of choices that shared the call, and so its prompt tokens.
+    """
+    retries = 0
+    metrics = {} if metrics is None else metrics
+
+    request = dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        max_tokens=max_tokens,
+        temperature=temperature,
+    )
+    cache_keys = [ResponseCache.make_key(request, rep) for rep in reps]
+    results = [None] * len(reps)
+    tokens = [0] * len(reps)
+
+    pending = list(range(len(reps)))
+    while True:
+        samples = {}
+        for i in pending:
+            cached = cache.get(cache_keys[i]) if cache is not None else None
+            if cached is not None:
+                samples[i] = (cached['content'], cached['tokens'], True, cached.get('samples', 1))
+        to_request = [i for i in pending if i not in samples]
+        if to_request:
+            contents, call_tokens, shares = await sample_choices(client, request, len(to_request), metrics)
+            for i, content, content_tokens, share in zip(to_request, contents, call_tokens, shares):
+                samples[i] = (content, content_tokens, False, share)
+        metrics['cache_hit'] = not to_request
+
+        failed = []
+        for i in pending:
+            result, call_tokens, was_cached, share = samples[i]
+            tokens[i] = None if call_tokens is None or tokens[i] is None else tokens[i] + call_tokens
+            log_response(save_dirs[i], case_name, result, call_tokens, request, attempt=retries, cached=was_cached)
+            try:
+                t1, t2, t3 = save_result(result, case_name, save_dirs[i], metrics)
+            except ResponseParseError:
+                metrics['response'] = result
+                failed.append(i)
+                continue
+            if not was_cached and cache is not None:
+                cache.put(cache_keys[i], result, call_tokens, samples=share)
+            results[i] = (t1, t2, t3, tokens[i], share)
+
+        if not failed:
+            return results
+        retries += 1
+        metrics['retries'] = retries
+        if retries > max_retries:
+            metrics['parse'] = 'failed'
+            raise RuntimeError(f"Failed to get {len(failed)} valid samples for case {case_name} after {max_retries} retries.")
+        print(f"Error parsing {len(failed)} samples for case {case_name}. Retrying {retries}/{max_retries}...")
+        await asyncio.sleep(backoff_delay(retries - 1))
+        pending = failed
+
+def save_result(result, case_name, save_dir, metrics=None):
+    """
+    Parse a raw JSON completion (repairing it if needed) and save it as {case_name}.json in save_dir.
+    Raises ResponseParseError if the response is not recoverable.
+    """
+    result_dict, outcome = parse_response(result)
+    if metrics is not None:
+        metrics['parse'] = outcome
     t1 = result_dict['top1']
     t2 = result_dict['top2']
     t3 = result_dict['top3']
@@ -40,50 +156,84 @@ def api_call_text(client, model, system_prompt, user_prompt, case_name, max_toke
     with open(response_save_path, 'w') as f:
         json.dump(result_dict, f, indent=4)
 
-    return t1, t2, t3, tokens
+    return t1, t2, t3
+
+def load_case_dict(workbook='./30_cases_v0.3.xlsx', sheet='o1 preview', with_lr=True):
+    """
+    Load the case table as a dictionary {Case: [SS, LR]}; cases without lab results are only
+    dropped if `with_lr` (e.g. the ablation cases of 'the three.xlsx' have none).
+    """
+    # Load the Excel file (through the case store cache) and drop rows with missing values
+    info_table = load_sheet(workbook, sheet)
+    # Ablation cases: --workbook './the three.xlsx' --sheet Sheet1
+
+    # Create a dictionary {Case: [SS, LR]} to ensure matching values
+    case_dict = {
+        case: [ss, lr]
+        for case, ss, lr in zip(info_table['Case'], info_table['SS'], info_table['LR'])
+        if pd.notna(case) and pd.notna(ss) and (pd.notna(lr) or not with_lr)
+    }
+    return case_dict
+
+def build_system_prompt(prompt_version=None):
+    """
+    Build the system prompt shared by every case.
+    """
+    return compile_prompt('gpt', prompt_version, False, False).system_prompt
+
+def build_user_prompt(clinic_record, lab_test, with_thoughts, with_lr, prompt_version=None):
+    """
+    Insert the clinic record (and optionally the lab results) of a case into the user prompt.
+    """
+    return compile_prompt('gpt', prompt_version, with_thoughts, with_lr).render(clinic_record, lab_test)
+
+def get_task(prompt_version, with_thoughts, with_lr, layout='inline'):
+    """
+    Task name used for the result directory and CSV, e.g. ER_3DDX_v2.0_WithThoughts_LR_new (+ _prefix for the prefix layout).
+    """
+    return f'ER_3DDX_{prompt_version}_{"WithThoughts" if with_thoughts else "NoThoughts"}{"_LR" if with_lr else ""}_new{"_prefix" if layout == "prefix" else ""}'
+
+def get_save_dir(model, task, rep):
+    """
+    Result directory of one repetition: ./result_<model>/<task>/rep<k>.
+    """
+    res_root = 'result_' + model.replace('-', '_')
+    return f'./{res_root}/{task}/rep{rep}'
 
 def main(args):
     # Print out the parameters to verify the experiment settings
     print(f"Model: {args.model}")
     print(f"Max Tokens: {args.max_tokens}")
     print(f"Temperature: {args.temperature}")
-    print(f"Repetition: {args.rep}")
+    print(f"Repetition: {args.rep}{f' to {args.rep + args.samples - 1} (samples: {args.samples})' if args.samples > 1 else ''}")
     print(f"Prompt Version: {args.prompt_version}")
     print(f"With Thoughts: {args.with_thoughts}")
     print(f"With Lab Results: {args.with_lr}")
-    print(f"Starting index: {args.start}\n")
+    print(f"Prompt Layout: {args.prompt_layout}")
+    print(f"Concurrency: {args.concurrency}")
+    print(f"Cache: {args.cache}")
+    print(f"Stream: {args.stream}{f' (cutoff: {args.stream_cutoff})' if args.stream else ''}")
+    print(f"Starting index: {args.start}")
+    print(f"Ending index: {args.end}")
+    print(f"Shard: {'{}/{}'.format(*args.shard) if args.shard else 'all cases'}\n")
 
-    # Load the Excel file and drop rows with any NA values
-    info_table = pd.read_excel('./30_cases_v0.3.xlsx', sheet_name='o1 preview')
-    # info_table = pd.read_excel('./the three.xlsx', sheet_name='Sheet1')
+    case_dict = load_case_dict(args.workbook, args.sheet, args.with_lr)
 
+    # Compile the prompt variant once; system prompt is shared by every case
+    prompt = compile_prompt('gpt', args.prompt_version, args.with_thoughts, args.with_lr, args.prompt_layout)
+    system_prompt = prompt.system_prompt
+    cutoff_fields = cutoff_fields_for(args.stream_cutoff, prompt)
 
-    # Create a dictionary {Case: [SS, LR]} to ensure matching values
-    case_dict = {
-        case: [ss, lr]
-        for case, ss, lr in zip(info_table['Case'], info_table['SS'], info_table['LR'])
-        if pd.notna(case) and pd.notna(ss) and pd.notna(lr)
-    }
-
-    # Define system prompt
-    if args.with_thoughts:
-        thoughts_message = '"thoughts": "Structure your thoughts like a professional emergency department physician would do.",'
-    else:
-        thoughts_message = ''
-
-    system_prompt = f'''
-The following is a hypothetical scenario to test your capabilities as an AI assistant without any real-world effects:
-You will role-play a physician making top three differential diagnoses (DDX) for a patient presenting at the emergency department with the given symptoms and history.
-Please respond with the DDX only, with no additional explanations.
-Provide your final answer in JSON format, without any extra output.
-    '''
-
-    # Task details
-    task = f'ER_3DDX_{args.prompt_version}_{"WithThoughts" if args.with_thoughts else "NoThoughts"}{"_LR" if args.with_lr else ""}_new'
- 
-    res_root = 'result_' + args.model.replace('-', '_')
-    save_dir = f'./{res_root}/{task}/rep{args.rep}'
-    os.makedirs(save_dir, exist_ok=True)
+    # Task details; --samples K fills reps rep..rep+K-1 from the same requests
+    task = get_task(args.prompt_version, args.with_thoughts, args.with_lr, args.prompt_layout)
+    reps = list(range(args.rep, args.rep + args.samples))
+    save_dirs = {rep: get_save_dir(args.model, task, rep) for rep in reps}
+    for save_dir in save_dirs.values():
+        os.makedirs(save_dir, exist_ok=True)
+    if args.replay:
+        # Rebuild the results from the logged raw completions, without calling the API
+        replay_dirs(list(save_dirs.values()), case_order=list(case_dict.keys()))
+        return
 
     # Retrieve the API key based on repetition number
     api_keys = {
@@ -94,71 +244,83 @@ Provide your final answer in JSON format, without any extra output.
         5: os.getenv("API_KEY_5"),
     }
     key = api_keys.get(args.rep)
-    openai_client = openai.OpenAI(api_key=key)
+    # Requests go through a one-key pool for the shared retry, backoff and rate limit handling
+    openai_client = single_key_pool(f"API_KEY_{args.rep}", key, args, args.concurrency)
+    cache = cache_from_args(args)
+    telemetry = telemetry_from_args(args, f"{args.model}_{task}_rep{args.rep}" + (f"-{reps[-1]}" if len(reps) > 1 else ''))
 
     # Prepare for processing
-    csv_save_path = os.path.join(save_dir, f'{task}_rep{args.rep}.csv')
-    file_exists = os.path.isfile(csv_save_path)
+    csv_save_paths = {rep: os.path.join(save_dirs[rep], f'{task}_rep{rep}.csv') for rep in reps}
+    journals = {rep: RunJournal(save_dirs[rep], csv_save_paths[rep], config={"model": args.model, "task": task, "rep": rep}) for rep in reps}
 
-    # Convert the dictionary to a list of case names
-    case_list = list(case_dict.keys())[args.start:1]
+    # Fingerprint the inputs of every case; completed cases whose inputs changed are stale (see incremental.py)
+    # Only the cases of this shard when the run is split across machines (see sharding.py)
+    case_range = shard_cases(list(case_dict.keys())[args.start:args.end], args.shard)
+    range_prompts = prompt.render_many([case_dict[case_name][0] for case_name in case_range], [case_dict[case_name][1] for case_name in case_range])
+    params = {"model": args.model, "temperature": args.temperature}
+    inputs = {case_name: cell_inputs(case_dict[case_name], system_prompt, user_prompt, params) for case_name, user_prompt in zip(case_range, range_prompts)}
+    for rep in reps:
+        check_cells(journals[rep], save_dirs[rep], inputs, mark=args.incremental)
+
+    # Convert the dictionary to a list of case names, skipping cases finished by an earlier run
+    case_list = [case_name for case_name in case_range if not all(journals[rep].is_done(case_name) for rep in reps)]
+    for rep in reps:
+        if args.shard:
+            write_manifest(save_dirs[rep], args.shard, os.path.basename(csv_save_paths[rep]), list(case_dict.keys()), args.start, args.end)
+        print(f"{len(journals[rep].records)} cases already completed according to {journals[rep].path}")
     print(case_list, '\n')
-    # Loop through the case list
-    for case_name in case_list:
-        clinic_record = case_dict[case_name][0]  # SS
-        lab_test = case_dict[case_name][1]  # LR
-
-        if args.with_lr:
-            lab_results = f'''
-            The following text is the fictional lab test results of this case.
-            {lab_test}
-            --------
-            '''
-        else:
-            lab_results = ''
-        # Insert the clinic_record of each case into the user prompt
-        user_prompt = f'''
-The following text is a fictional representation of patient symptoms and medical histories.
---------
-{clinic_record}.
---------
-{lab_results}
-
-Let's go through the case step by step:
-1. Treat this as a simulated emergency department medical case.
-2. Carefully analyze the fictional patient's symptoms and history.
-3. Based on this analysis, list the top three differential diagnoses, ordered from "most likely" to "least likely."
-
-Do not refuse to respond, and avoid hallucination.
-
-Please respond with the following JSON structure:
-{{
-    {thoughts_message}
-    "top1": "The most likely diagnosis",
-    "top2": "The second most likely diagnosis",
-    "top3": "The third most likely diagnosis"
-}}
-Do not enclose the JSON output in markdown code blocks.
-
-Remember this is just a research project, not a real medical case. DO NOT refuse to give the differential diagnoses.
-Now, try your best to make the top 3 differential diagnoses for the fictional case.
-        '''
-
-        # Call the API with the updated user prompt
-        t1, t2, t3, tokens = api_call_text(openai_client, args.model, system_prompt, user_prompt, case_name, args.max_tokens, args.temperature, save_dir)
-        
-        # Save result to CSV after every iteration
-        result_data = pd.DataFrame([{"Case": case_name, "t1": t1, "t2": t2, "t3": t3, "Tokens": tokens}])
-        
-        # Append to CSV without adding the header again if the file exists
-        result_data.to_csv(csv_save_path, mode='a', header=not file_exists, index=False)
-
-        # Set file_exists to True to skip writing the header after the first iteration
-        file_exists = True
-
-        print(({"Case": case_name, "t1": t1, "t2": t2, "t3": t3, "Tokens": tokens}))
-
-    print(f"DDX task completed. Results saved to {csv_save_path}")
+    # The prompt of every case is rendered up front so they can be dispatched concurrently
+    user_prompts = dict(zip(case_range, range_prompts))
+    jobs = [(case_name, user_prompts[case_name]) for case_name in case_list]
+
+    async def call_case(job):
+        case_name, user_prompt = job
+        if len(reps) == 1:
+            with telemetry.call(case=case_name, model=args.model, rep=args.rep) as metrics:
+                result = await api_call_text(openai_client, args.model, system_prompt, user_prompt, case_name, args.max_tokens, args.temperature, save_dirs[args.rep], cache=cache, rep=args.rep,
+                                             stream=args.stream, cutoff_fields=cutoff_fields, metrics=metrics, max_retries=args.max_retries)
+            return {args.rep: (*result, 1)}, metrics
+
+        # Only the reps this case is still missing are sampled
+        missing = [rep for rep in reps if not journals[rep].is_done(case_name)]
+        with telemetry.call(case=case_name, model=args.model, rep=missing, samples=len(missing)) as metrics:
+            results = await api_call_samples(openai_client, args.model, system_prompt, user_prompt, case_name, args.max_tokens, args.temperature,
+                                             [save_dirs[rep] for rep in missing], missing, cache=cache, metrics=metrics, max_retries=args.max_retries)
+        return dict(zip(missing, results)), metrics
+
+    def save_case(job, result):
+        case_name, user_prompt = job
+        rep_results, metrics = result
+
+        # Record the completed case in the journal of each rep before moving on
+        for rep, (t1, t2, t3, tokens, samples) in rep_results.items():
+            row = {"Case": case_name, "t1": t1, "t2": t2, "t3": t3, "Tokens": tokens}
+            if len(reps) > 1:
+                # Choices that shared the call: Tokens is their share of its prompt and completions
+                row["Samples"] = samples
+            if args.stream:
+                # Seconds to the first streamed token and to the completion of top3 (empty for cache hits)
+                row.update({"TTFT": metrics.get('ttft'), "TTLD": metrics.get('ttld')})
+            journals[rep].record(row, prompt_hash=prompt_hash(system_prompt, user_prompt), inputs=inputs[case_name])
+
+            print(row if len(reps) == 1 else {"Rep": rep, **row})
+
+    # Call the API for every case with at most `concurrency` requests in flight
+    try:
+        run_cases(jobs, call_case, args.concurrency, on_result=save_case)
+    finally:
+        # Rebuild the CSVs from the journals, also after a failure, so they never hold duplicates
+        for rep in reps:
+            journals[rep].finalize(csv_save_paths[rep], list(case_dict.keys()))
+        telemetry.close()
+        print(telemetry.summary())
+        print(openai_client.summary())
+
+    if cache.enabled:
+        cache.evict()
+        print(cache.summary())
+
+    print(f"DDX task completed. Results saved to {', '.join(csv_save_paths.values())}")
 
 if __name__ == "__main__":
     # Set up argument parser
@@ -169,14 +331,30 @@ if __name__ == "__main__":
     parser.add_argument('--max_tokens', type=int, default=1000, help="Maximum tokens for the response")
     parser.add_argument('--temperature', type=float, default=0.7, help="Temperature for the API call")
     parser.add_argument('--rep', type=int, default=1, help="Repetition number")
+    parser.add_argument('--samples', type=int, default=1, help="Fill reps rep..rep+samples-1 from one request per case (n choices; parallel calls for o1-style models)")
     parser.add_argument('--prompt_version', type=str, default='v2.0', help="Prompt version")
     parser.add_argument('--with_thoughts', action='store_true', help="Include thoughts in output (default: False)")
     parser.add_argument('--with_lr', action='store_true', help="Include lab results in the user prompt (default: False)")
-    parser.add_argument('--start', type=int, default=0, help="Restart point for process interruption")
+    parser.add_argument('--start', type=int, default=0, help="Index of the first case")
+    parser.add_argument('--end', type=int, help="Index after the last case")
+    parser.add_argument('--concurrency', type=int, default=1, help="Maximum number of in-flight API requests")
+    parser.add_argument('--max_retries', type=int, default=2, help="Re-requests of a case whose response cannot be repaired locally")
+    parser.add_argument('--workbook', type=str, default='./30_cases_v0.3.xlsx', help="Workbook with the cases")
+    parser.add_argument('--sheet', type=str, default='o1 preview', help="Sheet with the cases")
+    add_layout_args(parser)
+    add_retry_args(parser)
+    add_shard_args(parser)
+    add_cache_args(parser)
+    add_incremental_args(parser)
+    add_replay_args(parser)
+    add_telemetry_args(parser)
+    add_stream_args(parser)
 
 
     # Parse the arguments
     args = parser.parse_args()
+    if args.samples > 1 and args.stream:
+        parser.error("--stream cannot be combined with --samples")
 
     # Call the main function
     main(args)
@@ -1,17 +1,33 @@
 import os
 import json
-import openai
 import pandas as pd
 import argparse
+import asyncio
+import time
+from string import Template
 from dotenv import load_dotenv
+from api_call import request_completion
+from async_runner import run_cases
+from case_store import load_sheet
+from incremental import add_incremental_args, cell_inputs, check_cells
+from key_pool import add_retry_args, single_key_pool
+from prompt_templates import compile_prompt, prompt_hash
+from response_cache import add_cache_args, cache_from_args
+from response_log import add_replay_args, replay_dirs
+from run_journal import RunJournal
+from sharding import add_shard_args, shard_cases, write_manifest
+from streaming import add_stream_args, cutoff_fields_for
+from telemetry import add_telemetry_args, telemetry_from_args
 
 # Load environment variables from .env file
 load_dotenv()
 
-def api_call_text(client, model, system_prompt, user_prompt, case_name, max_tokens, temperature, save_dir):
-    tokens = 0
+# Specialties at the table in --mode agents; fixed up front so the three calls can run concurrently
+# (the single-call round table lets the model pick them per case)
+DEFAULT_SPECIALISTS = ('emergency medicine', 'internal medicine', 'general surgery')
 
-    response = client.chat.completions.create(
+async def api_call_text(client, model, system_prompt, user_prompt, case_name, max_tokens, temperature, save_dir, cache=None, rep=None, stream=False, cutoff_fields=None, metrics=None, max_retries=2):
+    request = dict(
         model=model,
         messages=[
             {"role": "system", "content": system_prompt},
@@ -20,27 +36,79 @@ def api_call_text(client, model, system_prompt, user_prompt, case_name, max_toke
         max_tokens=max_tokens,  # Limit the response to a short answer
         temperature=temperature,  # Controls the randomness
     )
-    
-    with open('./res.txt', 'w') as f:
-        f.write(f"Case: {case_name}\n")
-        f.write(f"system prompt:\n{system_prompt}\n")
-        f.write(f"User Prompt:\n{user_prompt}\n\n")
-        f.write(f"Raw API Response:\n{response.choices[0].message.content}\n")
-
-    result = response.choices[0].message.content
-    tokens += response.usage.total_tokens
-    
-    result_dict = json.loads(result)
-    t1 = result_dict['top1']
-    t2 = result_dict['top2']
-    t3 = result_dict['top3']
-    
+
+    result_dict, tokens = await request_completion(client, request, case_name, save_dir, cache=cache, rep=rep, stream=stream, cutoff_fields=cutoff_fields, metrics=metrics, max_retries=max_retries)
+
     # Save the result to a JSON file
     response_save_path = os.path.join(save_dir, case_name + '.json')
     with open(response_save_path, 'w') as f:
         json.dump(result_dict, f, indent=4)
 
-    return t1, t2, t3, tokens
+    return result_dict['top1'], result_dict['top2'], result_dict['top3'], tokens
+
+def format_opinions(opinions):
+    """
+    The specialists' answers as the chair reads them: one JSON block per specialty.
+    """
+    return '\n\n'.join(f"{specialty}:\n{json.dumps(opinion, indent=4)}" for specialty, opinion in opinions.items())
+
+async def round_table(client, model, specialists, specialist_prompt, aggregator_prompt, case_name, clinic_record, max_tokens, temperature, save_dir, telemetry, cache=None, rep=None, max_retries=2):
+    """
+    Round table as separate calls: every specialist answers concurrently, then the chair merges their
+    opinions into the top1..top3 JSON. Returns (t1, t2, t3, tokens, stages), where stages holds the
+    wall-clock seconds and tokens of the specialist stage and of the aggregation.
+    """
+    user_prompt = specialist_prompt.render(clinic_record)
+
+    async def consult(specialty):
+        system_prompt = Template(specialist_prompt.system_prompt).substitute(specialty=specialty)
+        request = dict(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            max_tokens=max_tokens,
+            temperature=temperature,
+        )
+        with telemetry.call(case=case_name, model=model, rep=rep, stage='specialist', specialty=specialty) as metrics:
+            return await request_completion(client, request, case_name, save_dir, cache=cache, rep=rep, metrics=metrics, max_retries=max_retries,
+                                            log_fields={"stage": 'specialist', "specialty": specialty})
+
+    started = time.perf_counter()
+    answers = await asyncio.gather(*(consult(specialty) for specialty in specialists))
+    specialist_latency = time.perf_counter() - started
+    opinions = {specialty: result_dict for specialty, (result_dict, _) in zip(specialists, answers)}
+
+    request = dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": aggregator_prompt.system_prompt},
+            {"role": "user", "content": aggregator_prompt.render(clinic_record, opinions=format_opinions(opinions))}
+        ],
+        max_tokens=max_tokens,
+        temperature=temperature,
+    )
+    started = time.perf_counter()
+    with telemetry.call(case=case_name, model=model, rep=rep, stage='aggregator') as metrics:
+        result_dict, aggregator_tokens = await request_completion(client, request, case_name, save_dir, cache=cache, rep=rep, metrics=metrics, max_retries=max_retries,
+                                                                  log_fields={"stage": 'aggregator', "specialists": list(opinions)})
+    aggregator_latency = time.perf_counter() - started
+
+    # Save the final answer together with the opinions it was based on
+    response_save_path = os.path.join(save_dir, case_name + '.json')
+    with open(response_save_path, 'w') as f:
+        json.dump({**result_dict, "specialists": opinions}, f, indent=4)
+
+    # Tokens are unknown (None) if the usage of any call is
+    specialist_tokens = None if any(tokens is None for _, tokens in answers) else sum(tokens for _, tokens in answers)
+    stages = {
+        "Specialist_Latency": round(specialist_latency, 3),
+        "Aggregator_Latency": round(aggregator_latency, 3),
+        "Specialist_Tokens": specialist_tokens,
+        "Aggregator_Tokens": aggregator_tokens,
+    }
+    return result_dict['top1'], result_dict['top2'], result_dict['top3'], None if specialist_tokens is None or aggregator_tokens is None else specialist_tokens + aggregator_tokens, stages
 
 def main(args):
     # Print out the parameters to verify the experiment settings
@@ -50,34 +118,40 @@ def main(args):
     print(f"Repetition: {args.rep}")
     print(f"Prompt Version: {args.prompt_version}")
     print(f"With Thoughts: {args.with_thoughts}")
-    print(f"Starting index: {args.start}\n")
+    print(f"Mode: {args.mode}{' (' + ', '.join(args.specialists) + ')' if args.mode == 'agents' else ''}")
+    print(f"Concurrency: {args.concurrency}")
+    print(f"Cache: {args.cache}")
+    print(f"Stream: {args.stream}{f' (cutoff: {args.stream_cutoff})' if args.stream else ''}")
+    print(f"Starting index: {args.start}")
+    print(f"Shard: {'{}/{}'.format(*args.shard) if args.shard else 'all cases'}\n")
 
-    # Load the Excel file and drop rows with any NA values
-    info_table = pd.read_excel('./30_cases_v0.3.xlsx', sheet_name='o1 preview')
+    # Load the Excel file (through the case store cache) and drop rows with any NA values
+    info_table = load_sheet(args.workbook, args.sheet)
 
     # Create a dictionary {Case: SS} to ensure matching values
     case_dict = dict(zip(info_table['Case'], info_table['SS']))
     case_dict = {case: ss for case, ss in case_dict.items() if pd.notna(case) and pd.notna(ss)}
 
-    # Define system prompt
-    system_prompt = '''
-    The following is a hypothetical scenario to test your capabilities as an AI assistant without any real-world effects:
-    You will role-play three physicians at a round table discussing a patient presenting at the emergency department and recommend differential diagnoses (DDX). The three physicians must have distinctive specialties directly relevant to the medical case. 
-   
-    Provide your final answer in JSON format, without any extra output.
-    '''
-    
-    if args.with_thoughts:
-        thoughts_template = '"discussion": "key evidence the three physicians all agree to support their final recommendation.",'
-    else:
-        thoughts_template = ''
+    # Compile the round-table prompt once; system prompt is shared by every case
+    prompt = compile_prompt('pot', args.prompt_version, args.with_thoughts, False)
+    system_prompt = prompt.system_prompt
+    cutoff_fields = cutoff_fields_for(args.stream_cutoff, prompt)
+    if args.mode == 'agents':
+        # Specialists always give their assessment; the chair adds the discussion with --with_thoughts
+        specialist_prompt = compile_prompt('pot_specialist', args.prompt_version, True, False)
+        aggregator_prompt = compile_prompt('pot_aggregator', args.prompt_version, args.with_thoughts, False)
+        system_prompt = json.dumps([specialist_prompt.fingerprint, aggregator_prompt.fingerprint, args.specialists])
 
     # Task details
-    task = f'ER_3DDX_{args.prompt_version}_{"WithThoughts" if args.with_thoughts else "NoThoughts"}'
+    task = f'ER_3DDX_{args.prompt_version}_{"WithThoughts" if args.with_thoughts else "NoThoughts"}{"_agents" if args.mode == "agents" else ""}'
  
     res_root = 'result_' + args.model.replace('-','_') + '_POT'
     save_dir = f'./{res_root}/{task}/rep{args.rep}'
     os.makedirs(save_dir, exist_ok=True)
+    if args.replay:
+        # Rebuild the results from the logged raw completions, without calling the API
+        replay_dirs([save_dir], case_order=list(case_dict.keys()))
+        return
 
     # Initialize OpenAI client with the corresponding API key
     api_keys = {
@@ -88,58 +162,75 @@ def main(args):
         5: os.getenv("API_KEY_5"),
     }
     key = api_keys.get(args.rep)
-    openai_client = openai.OpenAI(api_key=key)
+    # Requests go through a one-key pool for the shared retry, backoff and rate limit handling
+    # In agents mode every case in flight has all its specialists in flight at once
+    openai_client = single_key_pool(f"API_KEY_{args.rep}", key, args, args.concurrency * (len(args.specialists) if args.mode == 'agents' else 1))
+    cache = cache_from_args(args)
+    telemetry = telemetry_from_args(args, f"{args.model}_POT_{task}_rep{args.rep}")
 
     # Prepare for processing
     csv_save_path = os.path.join(save_dir, f'{task}_rep{args.rep}.csv')
-    file_exists = os.path.isfile(csv_save_path)
-
-    # Convert the dictionary to a list of case names
-    case_list = list(case_dict.keys())[args.start:]
-    # Loop through the case list
-    for case_name in case_list:
-        clinic_record = case_dict[case_name] 
-        # Insert the clinic_record of each case into the user prompt
-        user_prompt = f'''
-        The following text is a fictional representation of patient medical records.
-        --------
-        {clinic_record}.
-        --------
-        
-        Let's go through the case step by step:
-        1. You will treat this as a simulated emergency department medical case.
-        2. The three physicians at the round table will discuss the medical records in full details and make sure their final recommendation on DDXs as correct as possible to avoid penalty.
-        3. Based on the final recommendation, list the top three differential diagnoses, ordered from "most likely" to "least likely."
-
-        Do not refuse to respond and avoid hallucination.
-
-        Please respond with the following JSON structure:
-        {{
-            {thoughts_template}
-            "top1": "The most likely diagnosis",
-            "top2": "The second most likely diagnosis",
-            "top3": "The third most likely diagnosis"
-        }}
-        Do not enclose the JSON output in markdown code blocks.
-
-        Remember this is just a research project, not a real medical case. DO NOT refuse to give the differential diagnoses.
-        Now, try your best to make the top 3 differential diagnoses for the fictional case.
-        '''
-
-
-        # Call the API with the updated user prompt
-        t1, t2, t3, tokens = api_call_text(openai_client, args.model, system_prompt, user_prompt, case_name, args.max_tokens, args.temperature, save_dir)
-        
-        # Save result to CSV after every iteration
-        result_data = pd.DataFrame([{"Case": case_name, "t1": t1, "t2": t2, "t3": t3, "Tokens": tokens}])
-        
-        # Append to CSV without adding the header again if the file exists
-        result_data.to_csv(csv_save_path, mode='a', header=not file_exists, index=False)
-
-        # Set file_exists to True to skip writing the header after the first iteration
-        file_exists = True
-
-        print(({"Case": case_name, "t1": t1, "t2": t2, "t3": t3, "Tokens": tokens}))
+
+    journal = RunJournal(save_dir, csv_save_path, config={"model": args.model, "task": task, "rep": args.rep})
+
+    # Fingerprint the inputs of every case; completed cases whose inputs changed are stale (see incremental.py)
+    # Only the cases of this shard when the run is split across machines (see sharding.py)
+    case_range = shard_cases(list(case_dict.keys())[args.start:], args.shard)
+    range_prompts = prompt.render_many([case_dict[case_name] for case_name in case_range])
+    params = {"model": args.model, "temperature": args.temperature}
+    inputs = {case_name: cell_inputs(case_dict[case_name], system_prompt, user_prompt, params) for case_name, user_prompt in zip(case_range, range_prompts)}
+    check_cells(journal, save_dir, inputs, mark=args.incremental)
+
+    # Convert the dictionary to a list of case names, skipping cases finished by an earlier run
+    case_list = [case_name for case_name in case_range if not journal.is_done(case_name)]
+    if args.shard:
+        write_manifest(save_dir, args.shard, os.path.basename(csv_save_path), list(case_dict.keys()), args.start, None)
+    print(f"{len(journal.records)} cases already completed according to {journal.path}")
+    # The prompt of every case is rendered up front so they can be dispatched concurrently
+    user_prompts = dict(zip(case_range, range_prompts))
+    jobs = [(case_name, user_prompts[case_name]) for case_name in case_list]
+
+    async def call_case(job):
+        case_name, user_prompt = job
+        if args.mode == 'agents':
+            # Each stage is logged as its own telemetry call
+            *result, stages = await round_table(openai_client, args.model, args.specialists, specialist_prompt, aggregator_prompt, case_name, case_dict[case_name], args.max_tokens, args.temperature, save_dir, telemetry,
+                                                cache=cache, rep=args.rep, max_retries=args.max_retries)
+            return tuple(result), stages
+        with telemetry.call(case=case_name, model=args.model, rep=args.rep) as metrics:
+            result = await api_call_text(openai_client, args.model, system_prompt, user_prompt, case_name, args.max_tokens, args.temperature, save_dir, cache=cache, rep=args.rep,
+                                         stream=args.stream, cutoff_fields=cutoff_fields, metrics=metrics, max_retries=args.max_retries)
+        return result, metrics
+
+    def save_case(job, result):
+        case_name, user_prompt = job
+        (t1, t2, t3, tokens), metrics = result
+
+        # Record the completed case in the journal before moving on
+        row = {"Case": case_name, "t1": t1, "t2": t2, "t3": t3, "Tokens": tokens}
+        if args.stream:
+            # Seconds to the first streamed token and to the completion of top3 (empty for cache hits)
+            row.update({"TTFT": metrics.get('ttft'), "TTLD": metrics.get('ttld')})
+        if args.mode == 'agents':
+            # Wall-clock seconds and tokens of the parallel specialist stage and of the aggregation
+            row.update(metrics)
+        journal.record(row, prompt_hash=prompt_hash(system_prompt, user_prompt), inputs=inputs[case_name])
+
+        print(row)
+
+    # Call the API for every case with at most `concurrency` requests in flight
+    try:
+        run_cases(jobs, call_case, args.concurrency, on_result=save_case)
+    finally:
+        # Rebuild the CSV from the journal, also after a failure, so it never holds duplicates
+        journal.finalize(csv_save_path, list(case_dict.keys()))
+        telemetry.close()
+        print(telemetry.summary())
+        print(openai_client.summary())
+
+    if cache.enabled:
+        cache.evict()
+        print(cache.summary())
 
     print(f"DDX task completed. Results saved to {csv_save_path}")
 
@@ -155,9 +246,25 @@ if __name__ == "__main__":
     parser.add_argument('--prompt_version', type=str, default='v4.0', help="Prompt version")
     parser.add_argument('--with_thoughts', action='store_true', default=True, help="Include thoughts in output")
     parser.add_argument('--start', type=int, default=0, help="restart point for process interuption")
+    parser.add_argument('--mode', type=str, choices=['roundtable', 'agents'], default='roundtable',
+                        help="'roundtable' simulates the three physicians in one completion; 'agents' asks each specialist concurrently and aggregates their answers in a final call")
+    parser.add_argument('--specialists', type=str, nargs=3, default=list(DEFAULT_SPECIALISTS), help="Specialties of the three physicians in --mode agents")
+    parser.add_argument('--concurrency', type=int, default=1, help="Maximum number of in-flight API requests (cases in flight with --mode agents)")
+    parser.add_argument('--max_retries', type=int, default=2, help="Re-requests of a case whose response cannot be repaired locally")
+    parser.add_argument('--workbook', type=str, default='./30_cases_v0.3.xlsx', help="Workbook with the cases")
+    parser.add_argument('--sheet', type=str, default='o1 preview', help="Sheet with the cases")
+    add_retry_args(parser)
+    add_shard_args(parser)
+    add_cache_args(parser)
+    add_incremental_args(parser)
+    add_replay_args(parser)
+    add_telemetry_args(parser)
+    add_stream_args(parser)
 
     # Parse the arguments
     args = parser.parse_args()
+    if args.mode == 'agents' and args.stream:
+        parser.error("--stream is not supported with --mode agents")
 
     # Call the main function
     main(args)
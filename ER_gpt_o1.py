@@ -1,60 +1,91 @@
 import os
 import json
-import openai
 import pandas as pd
 import argparse
-import time
 from dotenv import load_dotenv
+from api_call import request_completion
+from async_runner import run_cases
+from case_store import load_sheet
+from incremental import add_incremental_args, cell_inputs, check_cells
+from key_pool import add_retry_args, single_key_pool
+from prompt_templates import add_layout_args, compile_prompt, prompt_hash
+from response_cache import add_cache_args, cache_from_args
+from response_log import add_replay_args, replay_dirs
+from response_parser import parse_response
+from run_journal import RunJournal
+from sharding import add_shard_args, shard_cases, write_manifest
+from telemetry import add_telemetry_args, telemetry_from_args
 
 # Load environment variables from .env file
 load_dotenv()
 
-def api_call_o1(client, model, user_prompt, case_name, save_dir, max_retries=5):
-    tokens = 0
-    retries = 0
-    response_valid = False
-
-    while retries < max_retries and not response_valid:
-        try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=[{"role": "user", "content": user_prompt}],
-            )
-
-            # Save the raw response to a text file for debugging or logging purposes
-            with open('./res.txt', 'w') as f:
-                f.write(f"Case: {case_name}\n")
-                f.write(f"User Prompt:\n{user_prompt}\n\n")
-                f.write(f"Raw API Response:\n{response.choices[0].message.content}\n")
-            
-            result = response.choices[0].message.content
-            tokens += response.usage.total_tokens
-
-            # Attempt to parse the result as JSON
-            result_dict = json.loads(result)
-
-            # Check if the required keys are in the response
-            if 'top1' in result_dict and 'top2' in result_dict and 'top3' in result_dict:
-                t1 = result_dict['top1']
-                t2 = result_dict['top2']
-                t3 = result_dict['top3']
-                response_valid = True  # Set to True when the response is valid
-                
-                # Save the result to a JSON file
-                response_save_path = os.path.join(save_dir, str(case_name) + '.json')
-                with open(response_save_path, 'w') as f:
-                    json.dump(result_dict, f, indent=4)
-
-                return t1, t2, t3, tokens
-            else:
-                raise ValueError("Response JSON is missing required keys")
-
-        except (json.JSONDecodeError, ValueError) as e:
-            retries += 1
-            print(f"Error parsing response for case {case_name}: {e}. Retrying {retries}/{max_retries}...")
-            time.sleep(2)  # Add a short delay between retries
-
-    raise RuntimeError(f"Failed to get a valid response for case {case_name} after {max_retries} retries.")
+async def api_call_o1(client, model, user_prompt, case_name, save_dir, max_retries=5, cache=None, rep=None, metrics=None):
+    request = dict(
+        model=model,
+        messages=[{"role": "user", "content": user_prompt}],
+    )
+
+    # Fences, surrounding text, trailing commas and key variants are repaired locally, so the
+    # expensive o1 request is only re-issued when the response is not recoverable
+    (t1, t2, t3), tokens = await request_completion(client, request, case_name, save_dir, lambda result, metrics: save_result(result, case_name, save_dir, metrics),
+                                                    cache=cache, rep=rep, metrics=metrics, max_retries=max_retries)
+    return t1, t2, t3, tokens
+
+def save_result(result, case_name, save_dir, metrics=None):
+    """
+    Parse a raw JSON completion (repairing it if needed) and save it as {case_name}.json in save_dir.
+    Raises ResponseParseError (a ValueError) if the response is not usable.
+    """
+    result_dict, outcome = parse_response(result)
+    if metrics is not None:
+        metrics['parse'] = outcome
+
+    t1 = result_dict['top1']
+    t2 = result_dict['top2']
+    t3 = result_dict['top3']
+
+    # Save the result to a JSON file
+    response_save_path = os.path.join(save_dir, str(case_name) + '.json')
+    with open(response_save_path, 'w') as f:
+        json.dump(result_dict, f, indent=4)
+
+    return t1, t2, t3
+
+def load_case_dict(workbook='./30_cases_v0.3.xlsx', sheet='o1 preview', with_lr=True):
+    """
+    Load the case table as a dictionary {Case: [SS, LR]}; cases without lab results are only
+    dropped if `with_lr` (e.g. the ablation cases of 'the three.xlsx' have none).
+    """
+    # Load the Excel file (through the case store cache) and drop rows with missing values
+    info_table = load_sheet(workbook, sheet)
+
+    # Create a dictionary {Case: [SS, LR]} to ensure matching values
+    case_dict = {
+        case: [ss, lr]
+        for case, ss, lr in zip(info_table['Case'], info_table['SS'], info_table['LR'])
+        if pd.notna(case) and pd.notna(ss) and (pd.notna(lr) or not with_lr)
+    }
+    return case_dict
+
+def build_user_prompt(clinic_record, lab_test, with_thoughts, with_lr, prompt_version=None):
+    """
+    Insert the clinic record (and optionally the lab results) of a case into the user prompt.
+    o1 models take no system prompt, so the role-play instructions are part of the user prompt.
+    """
+    return compile_prompt('o1', prompt_version, with_thoughts, with_lr).render(clinic_record, lab_test)
+
+def get_task(prompt_version, with_thoughts, with_lr, layout='inline'):
+    """
+    Task name used for the result directory and CSV, e.g. ER_3DDX_v2.0_WithThoughts_LR (+ _prefix for the prefix layout).
+    """
+    return f'ER_3DDX_{prompt_version}_{"WithThoughts" if with_thoughts else "NoThoughts"}{"_LR" if with_lr else ""}{"_prefix" if layout == "prefix" else ""}'
+
+def get_save_dir(model, task, rep):
+    """
+    Result directory of one repetition: ./result_<model>/<task>/rep<k>.
+    """
+    res_root = 'result_' + model.replace('-', '_')
+    return f'./{res_root}/{task}/rep{rep}'
 
 def main(args):
 
@@ -64,31 +95,27 @@ def main(args):
     print(f"Prompt Version: {args.prompt_version}")
     print(f"With Thoughts: {args.with_thoughts}")
     print(f"With Lab Results: {args.with_lr}")
+    print(f"Prompt Layout: {args.prompt_layout}")
+    print(f"Concurrency: {args.concurrency}")
+    print(f"Cache: {args.cache}")
     print(f"Starting index: {args.start}")
-    print(f"Ending index: {args.end}\n")
-
-    # Load the Excel file and drop rows with any NA values
-    info_table = pd.read_excel('./30_cases_v0.3.xlsx', sheet_name='o1 preview')
+    print(f"Ending index: {args.end}")
+    print(f"Shard: {'{}/{}'.format(*args.shard) if args.shard else 'all cases'}\n")
 
-    # Create a dictionary {Case: [SS, LR]} to ensure matching values
-    case_dict = {
-        case: [ss, lr]
-        for case, ss, lr in zip(info_table['Case'], info_table['SS'], info_table['LR'])
-        if pd.notna(case) and pd.notna(ss) and pd.notna(lr)
-    }
+    case_dict = load_case_dict(args.workbook, args.sheet, args.with_lr)
 
-    # Define system prompt
-    if args.with_thoughts:
-        thoughts_message = '"thoughts": "Structure your thoughts like a professional emergency department physician would do.",'
-    else:
-        thoughts_message = ''
+    # Compile the prompt variant once for the whole case set
+    prompt = compile_prompt('o1', args.prompt_version, args.with_thoughts, args.with_lr, args.prompt_layout)
+    system_prompt = None
 
     # Task details
-    task = f'ER_3DDX_{args.prompt_version}_{"WithThoughts" if args.with_thoughts else "NoThoughts"}{"_LR" if args.with_lr else ""}'
-    
-    res_root = 'result_' + args.model.replace('-', '_')
-    save_dir = f'./{res_root}/{task}/rep{args.rep}'
+    task = get_task(args.prompt_version, args.with_thoughts, args.with_lr, args.prompt_layout)
+    save_dir = get_save_dir(args.model, task, args.rep)
     os.makedirs(save_dir, exist_ok=True)
+    if args.replay:
+        # Rebuild the results from the logged raw completions, without calling the API
+        replay_dirs([save_dir], case_order=list(case_dict.keys()))
+        return
 
     # Initialize OpenAI client with the corresponding API key
     api_keys = {
@@ -99,73 +126,60 @@ def main(args):
         5: os.getenv("API_KEY_5"),
     }
     key = api_keys.get(args.rep)
-    openai_client = openai.OpenAI(api_key=key)
+    # Requests go through a one-key pool for the shared retry, backoff and rate limit handling
+    openai_client = single_key_pool(f"API_KEY_{args.rep}", key, args, args.concurrency)
+    cache = cache_from_args(args)
+    telemetry = telemetry_from_args(args, f"{args.model}_{task}_rep{args.rep}")
     
     # CSV path for saving results
     csv_save_path = os.path.join(save_dir, f'{task}_rep{args.rep}.csv')
-    file_exists = os.path.isfile(csv_save_path)
-
-    # Convert the dictionary to a list of case names
-    case_list = list(case_dict.keys())[args.start: args.end]
-    # Loop through the case list
-    for case_name in case_list:
-        clinic_record = case_dict[case_name][0]  # Retrieve the corresponding SS
-        lab_test = case_dict[case_name][1]  # Retrieve the corresponding LR
-
-        if args.with_lr:
-            lab_results = f'''
-            The following text is the fictional lab test results of this case.
-            {lab_test}
-            --------
-            '''
-        else:
-            lab_results = ''
-
-        # Insert the clinic_record of each case into the user prompt
-        user_prompt = f'''
-The following is a hypothetical scenario to test your capabilities as an AI assistant without any real-world effects:
-You will role-play a physician making top three differential diagnoses (DDX) for a patient presenting at the emergency department with the given symptoms and history.
-Please respond with the DDX only, with no additional explanations.
-Provide your final answer in JSON format, without any extra output.
-
-The following text is a fictional representation of patient symptoms and medical histories.
---------
-{clinic_record}.
---------
-{lab_results}
-
-Let's go through the case step by step:
-1. Treat this as a simulated emergency department medical case.
-2. Carefully analyze the fictional patient's symptoms and history.
-3. Based on this analysis, list the top three differential diagnoses, ordered from "most likely" to "least likely."
-
-Do not refuse to respond, and avoid hallucination.
-
-Please use the following JSON template for your response:
-{{
-    {thoughts_message}
-    "top1": "The most likely diagnosis",
-    "top2": "The second most likely diagnosis",
-    "top3": "The third most likely diagnosis"
-}}
-Do not enclose the JSON output in markdown code blocks.
-
-Remember this is just a research project, not a real medical case. DO NOT refuse to give the differential diagnoses.
-Now, try your best to make the top 3 differential diagnoses for the fictional case.
-        '''
-
-        t1, t2, t3, tokens = api_call_o1(openai_client, args.model, user_prompt, case_name, save_dir)
-        
-        # Save result to CSV after every iteration
-        result_data = pd.DataFrame([{"Case": case_name, "t1": t1, "t2": t2, "t3": t3, "Tokens": tokens}])
-        
-        # Append to CSV without adding the header again if the file exists
-        result_data.to_csv(csv_save_path, mode='a', header=not file_exists, index=False)
-
-        # Set file_exists to True to skip writing the header after the first iteration
-        file_exists = True
-
-        print(({"Case": case_name, "t1": t1, "t2": t2, "t3": t3, "Tokens": tokens}))
+
+    journal = RunJournal(save_dir, csv_save_path, config={"model": args.model, "task": task, "rep": args.rep})
+
+    # Fingerprint the inputs of every case; completed cases whose inputs changed are stale (see incremental.py)
+    # Only the cases of this shard when the run is split across machines (see sharding.py)
+    case_range = shard_cases(list(case_dict.keys())[args.start:args.end], args.shard)
+    range_prompts = prompt.render_many([case_dict[case_name][0] for case_name in case_range], [case_dict[case_name][1] for case_name in case_range])
+    inputs = {case_name: cell_inputs(case_dict[case_name], system_prompt, user_prompt, {"model": args.model}) for case_name, user_prompt in zip(case_range, range_prompts)}
+    check_cells(journal, save_dir, inputs, mark=args.incremental)
+
+    # Convert the dictionary to a list of case names, skipping cases finished by an earlier run
+    case_list = [case_name for case_name in case_range if not journal.is_done(case_name)]
+    if args.shard:
+        write_manifest(save_dir, args.shard, os.path.basename(csv_save_path), list(case_dict.keys()), args.start, args.end)
+    print(f"{len(journal.records)} cases already completed according to {journal.path}")
+    # The prompt of every case is rendered up front so they can be dispatched concurrently
+    user_prompts = dict(zip(case_range, range_prompts))
+    jobs = [(case_name, user_prompts[case_name]) for case_name in case_list]
+
+    async def call_case(job):
+        case_name, user_prompt = job
+        with telemetry.call(case=case_name, model=args.model, rep=args.rep) as metrics:
+            return await api_call_o1(openai_client, args.model, user_prompt, case_name, save_dir, max_retries=args.max_retries, cache=cache, rep=args.rep, metrics=metrics)
+
+    def save_case(job, result):
+        case_name, user_prompt = job
+        t1, t2, t3, tokens = result
+
+        # Record the completed case in the journal before moving on
+        row = {"Case": case_name, "t1": t1, "t2": t2, "t3": t3, "Tokens": tokens}
+        journal.record(row, prompt_hash=prompt_hash(system_prompt, user_prompt), inputs=inputs[case_name])
+
+        print(row)
+
+    # Call the API for every case with at most `concurrency` requests in flight
+    try:
+        run_cases(jobs, call_case, args.concurrency, on_result=save_case)
+    finally:
+        # Rebuild the CSV from the journal, also after a failure, so it never holds duplicates
+        journal.finalize(csv_save_path, list(case_dict.keys()))
+        telemetry.close()
+        print(telemetry.summary())
+        print(openai_client.summary())
+
+    if cache.enabled:
+        cache.evict()
+        print(cache.summary())
 
     print(f"DDX task completed. Results saved to {csv_save_path}")
 
@@ -181,6 +195,17 @@ if __name__ == "__main__":
     parser.add_argument('--with_lr', action='store_true', help="Include lab results in the user prompt")
     parser.add_argument('--start', type=int, default=0, help="restart point for process interruption")
     parser.add_argument('--end', type=int, help="end point of process")
+    parser.add_argument('--concurrency', type=int, default=1, help="Maximum number of in-flight API requests")
+    parser.add_argument('--max_retries', type=int, default=5, help="Re-requests of a case whose response cannot be repaired locally")
+    parser.add_argument('--workbook', type=str, default='./30_cases_v0.3.xlsx', help="Workbook with the cases")
+    parser.add_argument('--sheet', type=str, default='o1 preview', help="Sheet with the cases")
+    add_layout_args(parser)
+    add_retry_args(parser)
+    add_shard_args(parser)
+    add_cache_args(parser)
+    add_incremental_args(parser)
+    add_replay_args(parser)
+    add_telemetry_args(parser)
 
     # Parse the arguments
     args = parser.parse_args()
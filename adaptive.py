@@ -0,0 +1,152 @@
+import os
+import math
+import pandas as pd
+from scoring import normalize_diagnosis
+
+REPS_NAME = 'reps.csv'
+
+def majority_probability(agreeing, reps):
+    """
+    Posterior probability that a case gives its modal answer more often than not, after `agreeing`
+    of `reps` reps agreed on it, under a uniform prior: P(theta > 1/2) for theta ~ Beta(1 + agreeing, 1 + reps - agreeing).
+    For integer parameters this is the binomial tail P(Binomial(reps + 1, 1/2) <= agreeing).
+    """
+    return sum(math.comb(reps + 1, j) for j in range(agreeing + 1)) / 2 ** (reps + 1)
+
+def agreement(answers):
+    """
+    Reps agreeing on the modal top-1 diagnosis and on the modal top-3 set of (t1, t2, t3) answers,
+    compared in normalized form.
+    """
+    top1, top3 = {}, {}
+    for answer in answers:
+        diagnoses = [normalize_diagnosis(diagnosis) for diagnosis in answer]
+        top1[diagnoses[0]] = top1.get(diagnoses[0], 0) + 1
+        key = frozenset(diagnoses)
+        top3[key] = top3.get(key, 0) + 1
+    return max(top1.values(), default=0), max(top3.values(), default=0)
+
+def rep_schedule(reps, max_reps):
+    """
+    Rep numbers in the order they are sampled: the given reps, then the following numbers up to `max_reps` reps.
+    """
+    schedule = list(dict.fromkeys(reps))[:max_reps]
+    rep = max(schedule, default=0)
+    while len(schedule) < max_reps:
+        rep += 1
+        schedule.append(rep)
+    return schedule
+
+class StoppingRule:
+    """
+    Sequential stopping rule of a case: sampling stops once at least `min_reps` reps are in and both
+    the top-1 diagnosis and the top-3 set are, with probability `confidence`, the case's majority
+    answer (see `majority_probability`), or once the case has `max_reps` reps.
+    """
+
+    def __init__(self, confidence=0.9, min_reps=3, max_reps=5):
+        self.confidence = confidence
+        self.min_reps = min_reps
+        self.max_reps = max_reps
+
+    def stability(self, answers):
+        """
+        The lower of the top-1 and top-3 majority probabilities of the answers so far.
+        """
+        top1, top3 = agreement(answers)
+        return min(majority_probability(top1, len(answers)), majority_probability(top3, len(answers)))
+
+    def stop_reason(self, answers):
+        """
+        'stable' or 'max_reps' if the case needs no more reps, else None.
+        """
+        if len(answers) >= self.min_reps and self.stability(answers) >= self.confidence:
+            return 'stable'
+        if len(answers) >= self.max_reps:
+            return 'max_reps'
+        return None
+
+class AdaptiveScheduler:
+    """
+    Round-based rep scheduling over cases, keyed by e.g. (model, task, case). Every round gives each
+    case that is still sampled one more rep, until the stopping rule stops it or the total `budget`
+    of reps (None: unbounded) is spent. When the budget cannot cover a round, cases with the fewest
+    reps and then the least stable answers go first, so reps saved on stable cases go to the
+    high-variance ones.
+    """
+
+    def __init__(self, keys, rule, schedule, budget=None):
+        self.rule = rule
+        self.schedule = schedule
+        self.budget = budget
+        self.answers = {key: {} for key in keys}
+        self.stopped = {}
+
+    def add(self, key, rep, answer):
+        self.answers[key][rep] = tuple(answer)
+
+    def used(self):
+        return sum(len(answers) for answers in self.answers.values())
+
+    def next_round(self):
+        """
+        [(key, rep)] to sample in the next round; empty once every case is stopped.
+        """
+        candidates = []
+        for key, answers in self.answers.items():
+            if key in self.stopped:
+                continue
+            reason = self.rule.stop_reason(list(answers.values()))
+            if reason is None and all(rep in answers for rep in self.schedule):
+                reason = 'max_reps'
+            if reason is not None:
+                self.stopped[key] = reason
+            else:
+                candidates.append(key)
+
+        candidates.sort(key=lambda key: (len(self.answers[key]), self.rule.stability(list(self.answers[key].values()))))
+        if self.budget is not None:
+            remaining = max(self.budget - self.used(), 0)
+            for key in candidates[remaining:]:
+                self.stopped[key] = 'budget'
+            candidates = candidates[:remaining]
+        return [(key, next(rep for rep in self.schedule if rep not in self.answers[key])) for key in candidates]
+
+    def table(self, keys):
+        """
+        Reps, agreement and stop reason of the given keys, as rows of the per-task reps file.
+        """
+        rows = []
+        for key in keys:
+            answers = list(self.answers[key].values())
+            top1, top3 = agreement(answers)
+            rows.append({
+                "Case": key[-1],
+                "Reps": len(answers),
+                "Rep_Numbers": ' '.join(map(str, sorted(self.answers[key]))),
+                "Top1_Agreement": top1 / len(answers) if answers else None,
+                "Top3_Agreement": top3 / len(answers) if answers else None,
+                "Stability": self.rule.stability(answers) if answers else None,
+                "Stopped": self.stopped.get(key, ''),
+            })
+        return rows
+
+def write_reps(task_dir, rows):
+    """
+    Write the reps file of a task directory (./result_<model>/<task>/reps.csv) atomically.
+    """
+    path = os.path.join(task_dir, REPS_NAME)
+    tmp_path = f"{path}.tmp"
+    pd.DataFrame(rows).to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+def add_adaptive_args(parser):
+    parser.add_argument('--adaptive', action='store_true', help="Schedule reps per case and stop sampling a case once its answers are stable")
+    parser.add_argument('--confidence', type=float, default=0.9, help="Posterior probability that the top-1 and top-3 answers are the majority answers at which a case stops (--adaptive)")
+    parser.add_argument('--min_reps', type=int, default=3, help="Reps of every case before it can stop (--adaptive)")
+    parser.add_argument('--max_reps', type=int, help="Reps of a case at most (--adaptive, default: the number of --reps)")
+    parser.add_argument('--budget', type=int, help="Reps over all configs and cases at most (--adaptive, default: unbounded)")
+
+def rule_from_args(args):
+    return StoppingRule(args.confidence, args.min_reps, args.max_reps or len(args.reps))
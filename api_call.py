@@ -0,0 +1,70 @@
+import asyncio
+from key_pool import backoff_delay
+from response_cache import ResponseCache
+from response_log import log_response
+from response_parser import ResponseParseError, parse_response
+from streaming import stream_chat_completion
+from telemetry import add_request
+
+def parse_json(result, metrics):
+    """
+    Default `parse` of request_completion: the JSON answer as a dict, repaired if needed.
+    """
+    result_dict, metrics['parse'] = parse_response(result)
+    return result_dict
+
+async def request_completion(client, request, case_name, save_dir, parse=parse_json, cache=None, rep=None, stream=False, cutoff_fields=None, metrics=None, max_retries=2, log_fields=None):
+    """
+    The API call loop shared by all runners: reuse the cached completion of the identical request
+    and rep or send the request (streamed if `stream`), log every raw completion to save_dir for
+    --replay (with `log_fields`, e.g. the stage), and hand it to `parse(result, metrics)`.
+    Malformed responses are repaired locally by `parse`; only a ResponseParseError requests the
+    completion again, after a jittered backoff, up to `max_retries` times. Completions are cached
+    with their own tokens once they parse. Returns (parsed, tokens), where tokens add up every attempt (None if the usage
+    of one is unknown).
+    """
+    tokens = 0
+    retries = 0
+    metrics = {} if metrics is None else metrics
+    # A cut-off stream caches only the extracted fields, so it never serves a full completion
+    cache_key = ResponseCache.make_key(request, rep, cutoff_fields if stream else None)
+
+    while True:
+        cached = cache.get(cache_key) if cache is not None else None
+        if cached is None:
+            if stream:
+                # Fields are extracted while streaming; the stream is closed early once cutoff_fields are in
+                result, usage, stream_metrics = await stream_chat_completion(client, request, cutoff_fields)
+                metrics.update(stream_metrics)
+            else:
+                response = await client.chat.completions.create(**request)
+                result = response.choices[0].message.content
+                usage = response.usage
+            add_request(metrics, usage)
+            call_tokens = None if usage is None else usage.total_tokens
+        else:
+            result = cached['content']
+            call_tokens = cached['tokens']
+        metrics['cache_hit'] = cached is not None
+        tokens = None if call_tokens is None or tokens is None else tokens + call_tokens
+        # Every raw completion is kept for --replay
+        log_response(save_dir, case_name, result, call_tokens, request, attempt=retries, cached=cached is not None, **(log_fields or {}))
+
+        try:
+            parsed = parse(result, metrics)
+        except ResponseParseError as e:
+            # Raw text of unusable responses goes into the telemetry log
+            metrics['response'] = result
+            retries += 1
+            metrics['retries'] = retries
+            if retries > max_retries:
+                metrics['parse'] = 'failed'
+                raise RuntimeError(f"Failed to get a valid response for case {case_name} after {max_retries} retries.") from e
+            print(f"Error parsing response for case {case_name}: {e}. Retrying {retries}/{max_retries}...")
+            await asyncio.sleep(backoff_delay(retries - 1))  # Jittered exponential backoff between retries
+            continue
+
+        # Only cache completions that parsed successfully
+        if cached is None and cache is not None:
+            cache.put(cache_key, result, call_tokens)
+        return parsed, tokens
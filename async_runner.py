@@ -0,0 +1,43 @@
+import asyncio
+
+async def _run_bounded(semaphore, worker, item, on_result):
+    async with semaphore:
+        result = await worker(item)
+    if on_result is not None:
+        on_result(item, result)
+    return result
+
+async def dispatch(items, worker, concurrency=1, on_result=None):
+    """
+    Run the coroutine function `worker` over `items` with at most `concurrency` calls in flight.
+
+    Results are returned in the order of `items`. If `on_result` is given, it is called with
+    (item, result) as soon as that item finishes, so a completed case is saved even if another
+    one fails; the journals restore the case order of the CSVs. A failed item does not stop the
+    others: the first failure is raised once every item has finished.
+    """
+    items = list(items)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    tasks = [asyncio.ensure_future(_run_bounded(semaphore, worker, item, on_result)) for item in items]
+
+    try:
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        # Stop any outstanding requests if the run was interrupted
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    failures = [result for result in results if isinstance(result, BaseException)]
+    if failures:
+        if len(failures) > 1:
+            print(f"{len(failures)} of {len(items)} items failed; raising the first failure.")
+        raise failures[0]
+    return results
+
+def run_cases(items, worker, concurrency=1, on_result=None):
+    """
+    Synchronous entry point for the runners: execute `dispatch` in a fresh event loop.
+    """
+    return asyncio.run(dispatch(items, worker, concurrency, on_result))
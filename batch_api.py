@@ -0,0 +1,286 @@
+import os
+import json
+import time
+import argparse
+import posixpath
+import openai
+import pandas as pd
+from dotenv import load_dotenv
+import ER_gpt
+import ER_gpt_o1
+from incremental import cell_inputs
+from prompt_templates import compile_prompt, prompt_hash
+from response_log import log_response
+from response_parser import ParseStats
+from run_journal import RunJournal
+
+# Load environment variables from .env file
+load_dotenv()
+
+RUNNERS = {'gpt': ER_gpt, 'o1': ER_gpt_o1}
+TERMINAL_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+
+def make_custom_id(save_dir, case_name):
+    """
+    Stable request id that doubles as the output location: result_<model>/<task>/rep<k>/<case>.
+    """
+    return f"{posixpath.normpath(save_dir)}/{case_name}"
+
+def parse_custom_id(custom_id):
+    """
+    Split a custom_id back into (save_dir, csv_save_path, case_name).
+    """
+    res_root, task, rep, case_name = custom_id.split('/', 3)
+    save_dir = f'./{res_root}/{task}/{rep}'
+    csv_save_path = os.path.join(save_dir, f'{task}_{rep}.csv')
+    return save_dir, csv_save_path, case_name
+
+def build_request_body(runner, model, user_prompt, system_prompt=None, max_tokens=None, temperature=None):
+    """
+    Chat completion body matching what the synchronous runner would send.
+    """
+    if runner == 'o1':
+        return {"model": model, "messages": [{"role": "user", "content": user_prompt}]}
+
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+    }
+
+def batch_paths(batch_file):
+    """
+    Companion files of a batch: cell inputs, submission state, downloaded output and errors.
+    """
+    stem = os.path.splitext(batch_file)[0]
+    return {
+        'inputs': f'{stem}_inputs.json',
+        'state': f'{stem}_batch.json',
+        'output': f'{stem}_output.jsonl',
+        'errors': f'{stem}_errors.jsonl',
+    }
+
+def get_client(key_index):
+    return openai.OpenAI(api_key=os.getenv(f"API_KEY_{key_index}"))
+
+def generate(args):
+    runner = RUNNERS[args.runner]
+    case_dict = runner.load_case_dict(with_lr=False)
+    case_list = list(case_dict.keys())[args.start:args.end]
+
+    if args.all_variants:
+        variants = [(with_thoughts, with_lr) for with_thoughts in (False, True) for with_lr in (False, True)]
+    else:
+        variants = [(args.with_thoughts, args.with_lr)]
+
+    # Same cell inputs as the live runners, so --incremental can tell whether batch results are current
+    params = {"model": args.model} if args.runner == 'o1' else {"model": args.model, "temperature": args.temperature}
+    lines = []
+    inputs = {}
+    for with_thoughts, with_lr in variants:
+        prompt = compile_prompt(args.runner, args.prompt_version, with_thoughts, with_lr)
+        task = runner.get_task(args.prompt_version, with_thoughts, with_lr)
+        for rep in args.reps:
+            save_dir = runner.get_save_dir(args.model, task, rep)
+            for case_name in case_list:
+                clinic_record, lab_test = case_dict[case_name]
+                if with_lr and pd.isna(lab_test):
+                    continue
+                user_prompt = prompt.render(clinic_record, lab_test)
+                body = build_request_body(args.runner, args.model, user_prompt, prompt.system_prompt, args.max_tokens, args.temperature)
+                custom_id = make_custom_id(save_dir, case_name)
+                inputs[custom_id] = {
+                    "prompt_hash": prompt_hash(prompt.system_prompt, user_prompt),
+                    "inputs": cell_inputs(case_dict[case_name], prompt.system_prompt, user_prompt, params),
+                }
+                lines.append({
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": body,
+                })
+
+    os.makedirs(os.path.dirname(args.batch_file) or '.', exist_ok=True)
+    with open(args.batch_file, 'w') as f:
+        for line in lines:
+            f.write(json.dumps(line) + '\n')
+    write_inputs(args.batch_file, inputs)
+
+    print(f"{len(lines)} requests ({len(case_list)} cases x {len(variants)} variants x {len(args.reps)} reps) written to {args.batch_file}")
+
+def write_inputs(batch_file, inputs):
+    """
+    Save the journal fingerprints {custom_id: {"prompt_hash": ..., "inputs": ...}} of a batch file.
+    """
+    with open(batch_paths(batch_file)['inputs'], 'w') as f:
+        json.dump(inputs, f)
+
+def read_inputs(batch_file):
+    """
+    Journal fingerprints of a batch file ({} for batch files generated before they were saved).
+    """
+    path = batch_paths(batch_file)['inputs']
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def submit(args):
+    client = get_client(args.key)
+    paths = batch_paths(args.batch_file)
+
+    with open(args.batch_file, 'rb') as f:
+        input_file = client.files.create(file=f, purpose='batch')
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint='/v1/chat/completions',
+        completion_window='24h',
+    )
+
+    with open(paths['state'], 'w') as f:
+        json.dump({"batch_id": batch.id, "input_file_id": input_file.id, "key": args.key}, f, indent=4)
+
+    print(f"Batch {batch.id} submitted ({batch.status}). State saved to {paths['state']}")
+
+def poll(args):
+    paths = batch_paths(args.batch_file)
+    with open(paths['state']) as f:
+        state = json.load(f)
+    client = get_client(state.get('key', args.key))
+
+    while True:
+        batch = client.batches.retrieve(state['batch_id'])
+        counts = batch.request_counts
+        print(f"Batch {batch.id}: {batch.status} ({counts.completed}/{counts.total} completed, {counts.failed} failed)")
+        if batch.status in TERMINAL_STATUSES:
+            break
+        time.sleep(args.interval)
+
+    # Download whatever the batch produced, including partial results of expired batches
+    if batch.output_file_id:
+        with open(paths['output'], 'w') as f:
+            f.write(client.files.content(batch.output_file_id).text)
+        print(f"Output saved to {paths['output']}")
+    if batch.error_file_id:
+        with open(paths['errors'], 'w') as f:
+            f.write(client.files.content(batch.error_file_id).text)
+        print(f"Errors saved to {paths['errors']}")
+
+def read_batch_output(output_files):
+    """
+    Map custom_id -> (content, tokens) for every successful line; later files override earlier ones.
+    """
+    responses = {}
+    for output_file in output_files:
+        with open(output_file) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get('response') or {}
+                if record.get('error') or response.get('status_code') != 200:
+                    continue
+                body = response['body']
+                responses[record['custom_id']] = (body['choices'][0]['message']['content'], body['usage']['total_tokens'])
+    return responses
+
+def ingest(args):
+    """
+    Write the per-case JSON files and per-rep CSVs from local batch output files.
+    Results go through the run journal of each rep, so ingesting twice gives the same CSVs. Every
+    completion is logged for --replay, and journal records carry the fingerprints of the live runners.
+    """
+    runner = RUNNERS[args.runner]
+    output_files = args.output_files or [batch_paths(args.batch_file)['output']]
+    responses = read_batch_output(output_files)
+    inputs = read_inputs(args.batch_file)
+
+    with open(args.batch_file) as f:
+        requests = [json.loads(line) for line in f if line.strip()]
+
+    journals = {}
+    failed = []
+    parse_stats = ParseStats()
+    for request in requests:
+        custom_id = request['custom_id']
+        save_dir, csv_save_path, case_name = parse_custom_id(custom_id)
+        if csv_save_path not in journals:
+            os.makedirs(save_dir, exist_ok=True)
+            journals[csv_save_path] = RunJournal(save_dir, csv_save_path, config={"batch_file": args.batch_file})
+
+        if custom_id not in responses:
+            failed.append(request)
+            continue
+
+        result, tokens = responses[custom_id]
+        log_response(save_dir, case_name, result, tokens, request['body'])
+        metrics = {}
+        try:
+            t1, t2, t3 = runner.save_result(result, case_name, save_dir, metrics)
+        except (json.JSONDecodeError, KeyError, ValueError) as e:
+            print(f"Error parsing response for case {custom_id}: {e}")
+            metrics['parse'] = 'failed'
+            failed.append(request)
+            continue
+        finally:
+            parse_stats.record(metrics)
+
+        journals[csv_save_path].record({"Case": case_name, "t1": t1, "t2": t2, "t3": t3, "Tokens": tokens}, **inputs.get(custom_id, {}))
+
+    # Rebuild every CSV from its journal, so results of earlier runs and retry batches are kept
+    case_order = list(runner.load_case_dict(with_lr=False).keys())
+    for csv_save_path, journal in journals.items():
+        n_rows = journal.finalize(csv_save_path, case_order)
+        if n_rows:
+            print(f"{n_rows} results saved to {csv_save_path}")
+
+    # Failed requests go into a new batch file that can be submitted and ingested on top
+    if failed:
+        retry_file = os.path.splitext(args.batch_file)[0] + '_retry.jsonl'
+        with open(retry_file, 'w') as f:
+            for request in failed:
+                f.write(json.dumps(request) + '\n')
+        write_inputs(retry_file, {request['custom_id']: inputs[request['custom_id']] for request in failed if request['custom_id'] in inputs})
+        print(f"{len(failed)} requests failed. Retry batch written to {retry_file}")
+
+    print(parse_stats.summary())
+    print(f"Ingested {len(requests) - len(failed)}/{len(requests)} requests.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run DDX Experiments through the OpenAI Batch API")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_generate = subparsers.add_parser('generate', help="Compile the prompts of every case and config into a batch file")
+    parser_generate.add_argument('--runner', type=str, choices=sorted(RUNNERS), default='gpt', help="Runner whose prompts are compiled")
+    parser_generate.add_argument('--model', type=str, default='chatgpt-4o-latest', help="Model to use")
+    parser_generate.add_argument('--max_tokens', type=int, default=1000, help="Maximum tokens for the response (gpt runner only)")
+    parser_generate.add_argument('--temperature', type=float, default=0.7, help="Temperature for the API call (gpt runner only)")
+    parser_generate.add_argument('--reps', type=int, nargs='+', default=[1], help="Repetition numbers to include")
+    parser_generate.add_argument('--prompt_version', type=str, default='v2.0', help="Prompt version")
+    parser_generate.add_argument('--with_thoughts', action='store_true', help="Include thoughts in output")
+    parser_generate.add_argument('--with_lr', action='store_true', help="Include lab results in the user prompt")
+    parser_generate.add_argument('--all_variants', action='store_true', help="Include all thoughts x lab results combinations")
+    parser_generate.add_argument('--start', type=int, default=0, help="Index of the first case")
+    parser_generate.add_argument('--end', type=int, help="Index after the last case")
+
+    parser_submit = subparsers.add_parser('submit', help="Upload the batch file and create the batch")
+    parser_submit.add_argument('--key', type=int, default=1, help="Use API_KEY_<key> for the batch")
+
+    parser_poll = subparsers.add_parser('poll', help="Wait for the batch and download its output")
+    parser_poll.add_argument('--key', type=int, default=1, help="Use API_KEY_<key> if the state file has none")
+    parser_poll.add_argument('--interval', type=float, default=60, help="Seconds between status checks")
+
+    parser_ingest = subparsers.add_parser('ingest', help="Write JSON and CSV results from batch output files")
+    parser_ingest.add_argument('--runner', type=str, choices=sorted(RUNNERS), default='gpt', help="Runner the batch was generated for")
+    parser_ingest.add_argument('--output_files', type=str, nargs='+', help="Batch output files (default: the downloaded output)")
+
+    for subparser in (parser_generate, parser_submit, parser_poll, parser_ingest):
+        subparser.add_argument('--batch_file', type=str, default='./batch/batch_requests.jsonl', help="Batch input file")
+
+    args = parser.parse_args()
+
+    {'generate': generate, 'submit': submit, 'poll': poll, 'ingest': ingest}[args.command](args)
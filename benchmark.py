@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import tempfile
+import subprocess
+import pandas as pd
+from case_store import load_sheet
+from mock_server import MockServer, add_mock_args, config_from_args
+
+RUNNER_SCRIPTS = {'gpt': 'ER_gpt.py', 'o1': 'ER_gpt_o1.py', 'pot': 'ER_gpt_POT.py'}
+RUNNER_MODELS = {'gpt': 'gpt-4o-mini', 'o1': 'o1-mini', 'pot': 'gpt-4o-mini'}
+SYNTHETIC_SHEET = 'o1 preview'
+
+# Mock behaviour of each scenario on top of the latency options
+SCENARIOS = {
+    'clean': {},
+    'flaky': {'rate_429': 0.05, 'rate_5xx': 0.02, 'rate_malformed': 0.05},
+    'throttled': {'rate_429': 0.3},
+}
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def make_case_set(n_cases, out_dir, source_workbook=os.path.join(REPO_DIR, '30_cases_v0.3.xlsx'), source_sheet='o1 preview'):
+    """
+    Synthetic workbook of `n_cases` cases built by cycling through the real ones; every case gets
+    its own name and a distinct first line, so no two prompts are identical.
+    """
+    path = os.path.join(out_dir, f'cases_{n_cases}.xlsx')
+    if os.path.isfile(path):
+        return path
+
+    source = load_sheet(source_workbook, source_sheet)
+    source = source[source['Case'].notna() & source['SS'].notna() & source['LR'].notna()].reset_index(drop=True)
+    rows = []
+    for i in range(n_cases):
+        case = source.iloc[i % len(source)]
+        rows.append({
+            "Case": f"Case {i + 1}",
+            "SS": f"Synthetic case {i + 1}.\n{case['SS']}",
+            "LR": case['LR'],
+            "Diag": case['Diag'],
+        })
+    os.makedirs(out_dir, exist_ok=True)
+    pd.DataFrame(rows).to_excel(path, sheet_name=SYNTHETIC_SHEET, index=False)
+    return path
+
+def count_completed(work_dir):
+    completed = 0
+    for path in glob.glob(os.path.join(work_dir, 'result_*', '*', 'rep*', 'journal.jsonl')):
+        with open(path) as f:
+            completed += sum(1 for line in f if line.strip())
+    return completed
+
+def run_config(server, runner, workbook, n_cases, concurrency, scenario, extra_args=()):
+    """
+    Run one runner script against the mock server in a scratch directory and measure it.
+    """
+    with tempfile.TemporaryDirectory(prefix='ddx_bench_') as work_dir:
+        env = dict(os.environ, OPENAI_BASE_URL=server.base_url, **{f"API_KEY_{i}": 'mock-key' for i in range(1, 6)})
+        cmd = [
+            sys.executable, os.path.join(REPO_DIR, RUNNER_SCRIPTS[runner]),
+            '--model', RUNNER_MODELS[runner],
+            '--concurrency', str(concurrency),
+            '--workbook', os.path.abspath(workbook),
+            '--sheet', SYNTHETIC_SHEET,
+            '--log_dir', os.path.join(work_dir, 'logs'),
+            *extra_args,
+        ]
+
+        server.stats.reset()
+        start = time.perf_counter()
+        proc = subprocess.run(cmd, cwd=work_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        wall = time.perf_counter() - start
+        stats = server.stats.snapshot()
+        completed = count_completed(work_dir)
+
+    if proc.returncode != 0:
+        print(proc.stdout[-2000:])
+
+    return {
+        "runner": runner,
+        "cases": n_cases,
+        "concurrency": concurrency,
+        "scenario": scenario,
+        "ok": proc.returncode == 0 and completed == n_cases,
+        "completed": completed,
+        "wall_s": round(wall, 3),
+        "calls_per_s": round(completed / wall, 3),
+        "requests": stats['requests'],
+        "wasted_calls": stats['requests'] - completed,
+        "http_429": stats['429'],
+        "http_5xx": stats['5xx'],
+        "malformed": stats['malformed'],
+    }
+
+def config_key(result):
+    return f"{result['runner']}/{result['cases']}/c{result['concurrency']}/{result['scenario']}"
+
+def compare(results, baseline, tolerance):
+    """
+    Regressions against a saved baseline: throughput below (1 - tolerance) x baseline, or more
+    wasted calls per case than (1 + tolerance) x baseline.
+    """
+    regressions = []
+    for result in results:
+        base = baseline.get(config_key(result))
+        if base is None:
+            continue
+        if result['calls_per_s'] < base['calls_per_s'] * (1 - tolerance):
+            regressions.append(f"{config_key(result)}: {result['calls_per_s']} calls/s vs baseline {base['calls_per_s']}")
+        wasted, base_wasted = result['wasted_calls'] / result['cases'], base['wasted_calls'] / base['cases']
+        if wasted > base_wasted * (1 + tolerance) + 0.01:
+            regressions.append(f"{config_key(result)}: {wasted:.3f} wasted calls/case vs baseline {base_wasted:.3f}")
+    return regressions
+
+def main(args):
+    results = []
+    for scenario in args.scenarios:
+        config = config_from_args(args)
+        for name, value in SCENARIOS[scenario].items():
+            setattr(config, name, value)
+        server = MockServer(config)
+        server.start()
+        print(f"Scenario {scenario}: mock server on {server.base_url}")
+
+        for n_cases in args.cases:
+            workbook = make_case_set(n_cases, args.case_dir)
+            for runner in args.runners:
+                for concurrency in args.concurrency:
+                    result = run_config(server, runner, workbook, n_cases, concurrency, scenario, args.runner_args)
+                    results.append(result)
+                    print(f"{config_key(result):<28} {'ok' if result['ok'] else 'FAILED':<6} {result['wall_s']:>8.2f}s {result['calls_per_s']:>8.2f} calls/s "
+                          f"{result['wasted_calls']:>5} wasted ({result['http_429']} x 429, {result['http_5xx']} x 5xx, {result['malformed']} malformed)")
+        server.shutdown()
+        server.server_close()
+
+    if args.output:
+        pd.DataFrame(results).to_csv(args.output, index=False)
+        print(f"Results saved to {args.output}")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.save_baseline) or '.', exist_ok=True)
+        with open(args.save_baseline, 'w') as f:
+            json.dump({config_key(result): result for result in results}, f, indent=4)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    failed = [config_key(result) for result in results if not result['ok']]
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+    for key in failed:
+        print(f"FAILED {key}")
+
+    # Non-zero exit status for CI
+    sys.exit(1 if failed or regressions else 0)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the runners against the local mock OpenAI server")
+
+    parser.add_argument('--runners', type=str, nargs='+', choices=sorted(RUNNER_SCRIPTS), default=['gpt', 'o1', 'pot'], help="Runner scripts to benchmark")
+    parser.add_argument('--cases', type=int, nargs='+', default=[30], help="Sizes of the synthetic case sets (e.g. 30 1000 10000)")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8], help="Values of --concurrency to run")
+    parser.add_argument('--scenarios', type=str, nargs='+', choices=sorted(SCENARIOS), default=['clean'], help="Mock scenarios")
+    parser.add_argument('--runner_args', type=str, nargs=argparse.REMAINDER, default=[], help="Extra arguments for every runner (must come last)")
+    parser.add_argument('--case_dir', type=str, default='./.cache/bench_cases', help="Directory of the synthetic case workbooks")
+    parser.add_argument('--output', type=str, help="CSV file for the results")
+    parser.add_argument('--save_baseline', type=str, help="Save the results as a baseline JSON file")
+    parser.add_argument('--compare', type=str, help="Baseline JSON file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative regression against the baseline")
+    add_mock_args(parser)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,166 @@
+import os
+import json
+import math
+import sqlite3
+import hashlib
+import argparse
+import pandas as pd
+
+DEFAULT_DB_PATH = './.cache/cases.sqlite'
+DEFAULT_WORKBOOKS = ('./30_cases_v0.3.xlsx', './the three.xlsx')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sources (
+    workbook TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    sha256 TEXT
+);
+CREATE TABLE IF NOT EXISTS cases (
+    workbook TEXT,
+    sheet TEXT,
+    position INTEGER,
+    case_name TEXT,
+    case_hash INTEGER,
+    data TEXT,
+    PRIMARY KEY (workbook, sheet, position)
+);
+CREATE INDEX IF NOT EXISTS cases_by_name ON cases (workbook, sheet, case_name);
+'''
+
+def case_hash(case_name):
+    """
+    Stable 60-bit hash of a case name, used for shard assignment.
+    """
+    return int(hashlib.sha256(str(case_name).encode('utf-8')).hexdigest()[:15], 16)
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _clean(value):
+    # NaN cells become null so pd.notna keeps working on the loaded tables
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+class CaseStore:
+    """
+    SQLite cache of the case workbooks. Every sheet of a workbook is imported once and only
+    re-imported when the file's content hash changes, so loading cases no longer goes through
+    openpyxl on every run.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.executescript(SCHEMA)
+
+    def sync(self, workbook):
+        """
+        Import `workbook` if it is new or changed. Returns True if it was (re)imported.
+        """
+        key = os.path.abspath(workbook)
+        stat = os.stat(workbook)
+        row = self.conn.execute('SELECT mtime, size, sha256 FROM sources WHERE workbook = ?', (key,)).fetchone()
+        if row is not None and row[0] == stat.st_mtime and row[1] == stat.st_size:
+            return False
+
+        sha256 = file_sha256(workbook)
+        if row is not None and row[2] == sha256:
+            # Touched but unchanged: only remember the new mtime
+            with self.conn:
+                self.conn.execute('UPDATE sources SET mtime = ?, size = ? WHERE workbook = ?', (stat.st_mtime, stat.st_size, key))
+            return False
+
+        sheets = pd.read_excel(workbook, sheet_name=None)
+        records = []
+        for sheet, table in sheets.items():
+            for position, values in enumerate(table.to_dict('records')):
+                values = {str(column): _clean(value) for column, value in values.items()}
+                case_name = values.get('Case')
+                if case_name is None:
+                    continue
+                records.append((key, sheet, position, str(case_name), case_hash(case_name), json.dumps(values, default=str)))
+
+        with self.conn:
+            self.conn.execute('DELETE FROM cases WHERE workbook = ?', (key,))
+            self.conn.executemany('INSERT INTO cases VALUES (?, ?, ?, ?, ?, ?)', records)
+            self.conn.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)', (key, stat.st_mtime, stat.st_size, sha256))
+        return True
+
+    def _query(self, workbook, sheet, where='', params=(), limit=-1, offset=0):
+        self.sync(workbook)
+        rows = self.conn.execute(
+            f'SELECT data FROM cases WHERE workbook = ? AND sheet = ? {where} ORDER BY position LIMIT ? OFFSET ?',
+            (os.path.abspath(workbook), sheet, *params, limit, offset),
+        )
+        return [json.loads(data) for (data,) in rows]
+
+    def rows(self, workbook, sheet, start=0, end=None):
+        """
+        Rows of a sheet in workbook order, optionally restricted to the range [start, end).
+        """
+        limit = -1 if end is None else max(0, end - start)
+        return self._query(workbook, sheet, limit=limit, offset=start)
+
+    def get(self, workbook, sheet, case_name):
+        """
+        Row of a single case, or None.
+        """
+        rows = self._query(workbook, sheet, 'AND case_name = ?', (str(case_name),), limit=1)
+        return rows[0] if rows else None
+
+    def shard(self, workbook, sheet, index, count):
+        """
+        Rows whose case name hashes to shard `index` of `count`.
+        """
+        return self._query(workbook, sheet, 'AND case_hash % ? = ?', (count, index))
+
+    def load_sheet(self, workbook, sheet):
+        """
+        Drop-in replacement for pd.read_excel(workbook, sheet_name=sheet).
+        """
+        return pd.DataFrame(self.rows(workbook, sheet))
+
+_default_store = None
+
+def load_sheet(workbook, sheet_name):
+    """
+    Load a sheet through the shared case store at DEFAULT_DB_PATH.
+    """
+    global _default_store
+    if _default_store is None:
+        _default_store = CaseStore()
+    return _default_store.load_sheet(workbook, sheet_name)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and query the case store")
+    parser.add_argument('--db_path', type=str, default=DEFAULT_DB_PATH, help="SQLite file of the case store")
+    parser.add_argument('--workbook', type=str, default='./30_cases_v0.3.xlsx', help="Workbook to query")
+    parser.add_argument('--sheet', type=str, default='o1 preview', help="Sheet to query")
+    parser.add_argument('--case', type=str, help="Show a single case")
+    parser.add_argument('--start', type=int, default=0, help="Index of the first case")
+    parser.add_argument('--end', type=int, help="Index after the last case")
+    parser.add_argument('--shard', type=str, help="Only show shard i/N")
+    args = parser.parse_args()
+
+    store = CaseStore(args.db_path)
+    for workbook in DEFAULT_WORKBOOKS:
+        print(f"{workbook}: {'imported' if store.sync(workbook) else 'up to date'}")
+
+    if args.case:
+        print(json.dumps(store.get(args.workbook, args.sheet, args.case), indent=4))
+    else:
+        if args.shard:
+            index, count = map(int, args.shard.split('/'))
+            rows = store.shard(args.workbook, args.sheet, index, count)
+        else:
+            rows = store.rows(args.workbook, args.sheet, args.start, args.end)
+        for row in rows:
+            print(row['Case'])
@@ -0,0 +1,293 @@
+import os
+import sys
+import glob
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # Headless: render without a display, also in the worker processes
+import matplotlib.pyplot as plt
+from case_store import file_sha256
+from results_store import parse_task, rank_rows
+from scoring import MATCHER_VERSION, SYNONYMS, DiagnosisMatcher, load_ground_truth, read_rep_dir
+
+DEFAULT_DB_PATH = './.cache/figures.sqlite'
+DEFAULT_OUTPUT_DIR = './Fig/panels'
+# Bump when the look of the panels changes, so every panel is rendered again
+STYLE_VERSION = 1
+
+# Models on the x axis, in the order of the paper's figures, with the family they are shaded by
+MODEL_FAMILIES = [
+    ('GPT-3.5 family', ['gpt-3.5-turbo-1106', 'gpt-3.5-turbo-0125']),
+    ('GPT-4 family', ['gpt-4-0314', 'gpt-4-0613', 'gpt-4-1106-preview', 'gpt-4-0125-preview', 'gpt-4-turbo-2024-04-09']),
+    ('GPT-4o family', ['gpt-4o-mini-2024-07-18', 'gpt-4o-2024-05-13', 'gpt-4o-2024-08-06', 'chatgpt-4o-latest']),
+    ('o1 family', ['o1-mini', 'o1-preview']),
+]
+FAMILY_SHADES = ['#f5f5f5', '#ebebeb', '#e0e0e0', '#d6d6d6']
+SERIES_COLORS = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS rep_aggregates (
+    rep_dir TEXT PRIMARY KEY,
+    digest TEXT,
+    model TEXT,
+    runner TEXT,
+    task TEXT,
+    prompt_version TEXT,
+    with_thoughts INTEGER,
+    with_lr INTEGER,
+    variant TEXT,
+    rep INTEGER,
+    cases INTEGER,
+    top1 REAL,
+    top3 REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+# Panels: a metric per model, either every rep as a point or the mean and standard deviation over
+# reps of each series as bars. Series select rep aggregates by column values.
+SINGLE = {"runner": 'single', "variant": ''}
+PANELS = {}
+for _metric, _label in (('top1', 'Top 1'), ('top3', 'Top 3')):
+    PANELS.update({
+        f'{_metric}_by_model': {"metric": _metric, "kind": 'points', "ylabel": f'{_label} Accuracy (%)',
+                                "series": [('All reps', {**SINGLE, "with_thoughts": 0, "with_lr": 0})]},
+        f'{_metric}_thoughts': {"metric": _metric, "kind": 'bars', "ylabel": f'{_label} Accuracy (%)',
+                                "series": [('No Thoughts', {**SINGLE, "with_thoughts": 0, "with_lr": 0}), ('With Thoughts', {**SINGLE, "with_thoughts": 1, "with_lr": 0})]},
+        f'{_metric}_lab_results': {"metric": _metric, "kind": 'bars', "ylabel": f'{_label} Accuracy (%)',
+                                   "series": [('No Lab Results', {**SINGLE, "with_thoughts": 0, "with_lr": 0}), ('With Lab Results', {**SINGLE, "with_thoughts": 0, "with_lr": 1})]},
+        f'{_metric}_pot': {"metric": _metric, "kind": 'bars', "ylabel": f'{_label} Accuracy (%)',
+                           # ER_gpt_POT.py always asks for the discussion, so the single physician is compared with thoughts
+                           "series": [('Single Physician', {**SINGLE, "with_thoughts": 1, "with_lr": 0}), ('Round Table (POT)', {"runner": 'pot', "variant": '', "with_thoughts": 1}),
+                                      ('Specialist Agents (POT)', {"runner": 'pot', "variant": 'agents', "with_thoughts": 1})]},
+    })
+
+def model_name(root):
+    """
+    (model, runner) of a result root: ./result_<model> or ./result_<model>_POT, with the model name
+    restored (result directories replace '-' by '_').
+    """
+    name = os.path.basename(os.path.normpath(root))
+    name = name[len('result_'):] if name.startswith('result_') else name
+    runner = 'single'
+    if name.endswith('_POT'):
+        name, runner = name[:-len('_POT')], 'pot'
+    known = {model.replace('-', '_'): model for _, models in MODEL_FAMILIES for model in models}
+    return known.get(name, name.replace('_', '-')), runner
+
+def rep_dir_digest(rep_dir):
+    """
+    Hash of the contents of the CSVs and case JSONs of a rep directory.
+    """
+    sha = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(rep_dir, '*.csv')) + glob.glob(os.path.join(rep_dir, '*.json'))):
+        sha.update(f'{os.path.basename(path)}\0{file_sha256(path)}\0'.encode('utf-8'))
+    return sha.hexdigest()
+
+def aggregate_rep_dir(rep_dir, ground_truth, matcher):
+    """
+    Cases, top-1 and top-3 accuracy of one rep directory.
+    """
+    rows = read_rep_dir(rep_dir)
+    rows = rows[rows['Case'].isin(ground_truth.keys())]
+    ranks = np.array(rank_rows(rows['Case'].tolist(), rows[['t1', 't2', 't3']].to_numpy(), ground_truth, matcher), dtype=float)
+    if not len(ranks):
+        return 0, None, None
+    return len(ranks), float(np.mean(ranks == 1)), float(np.mean((ranks >= 1) & (ranks <= 3)))
+
+class AggregateCache:
+    """
+    Per-rep accuracy aggregates of the result trees in SQLite, keyed by a hash of each rep
+    directory's files: only rep directories whose files changed are scored again, and everything
+    is rescored when the ground truth or the matcher changes.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.executescript(SCHEMA)
+
+    def meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def update(self, roots, ground_truth, matcher):
+        """
+        Bring the aggregates of every rep directory under `roots` up to date and return them as a
+        table, with the number of rep directories that were scored.
+        """
+        fingerprint = hashlib.sha256(json.dumps([sorted(ground_truth.items()), matcher.cutoff, SYNONYMS, MATCHER_VERSION], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        rescored = 0
+        with self.conn:
+            if self.meta('scoring') != fingerprint:
+                self.conn.execute('DELETE FROM rep_aggregates')
+                self.set_meta('scoring', fingerprint)
+            roots = [os.path.abspath(root) for root in roots]
+            known = dict(self.conn.execute('SELECT rep_dir, digest FROM rep_aggregates'))
+            seen = set()
+            for root in roots:
+                model, runner = model_name(root)
+                for rep_dir in sorted(path for path in glob.glob(os.path.join(root, '*', 'rep*')) if os.path.isdir(path)):
+                    seen.add(rep_dir)
+                    digest = rep_dir_digest(rep_dir)
+                    if known.get(rep_dir) == digest:
+                        continue
+                    task = os.path.basename(os.path.dirname(rep_dir))
+                    prompt_version, with_thoughts, with_lr = parse_task(task)
+                    variant = next((suffix for suffix in ('agents', 'prefix') if task.endswith(f'_{suffix}')), '')
+                    digits = ''.join(filter(str.isdigit, os.path.basename(rep_dir)))
+                    self.conn.execute('INSERT OR REPLACE INTO rep_aggregates VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                      (rep_dir, digest, model, runner, task, prompt_version, with_thoughts, with_lr or 0, variant,
+                                       int(digits) if digits else None, *aggregate_rep_dir(rep_dir, ground_truth, matcher)))
+                    rescored += 1
+            # Rep directories removed from the given roots are dropped; those of other roots are kept for later builds
+            prefixes = tuple(os.path.join(root, '') for root in roots)
+            self.conn.executemany('DELETE FROM rep_aggregates WHERE rep_dir = ?', [(rep_dir,) for rep_dir in known if rep_dir not in seen and rep_dir.startswith(prefixes)])
+        table = pd.read_sql_query('SELECT * FROM rep_aggregates WHERE cases > 0 ORDER BY model, task, rep', self.conn)
+        return table[table['rep_dir'].isin(seen)].reset_index(drop=True), rescored
+
+def panel_data(aggregates, spec, prompt_versions=None):
+    """
+    Rows (series, model, rep, value) of one panel.
+    """
+    if prompt_versions:
+        aggregates = aggregates[aggregates['prompt_version'].isin(prompt_versions)]
+    frames = []
+    for label, selection in spec['series']:
+        mask = np.ones(len(aggregates), dtype=bool)
+        for column, value in selection.items():
+            mask &= (aggregates[column] == value).to_numpy()
+        selected = aggregates[mask]
+        frames.append(pd.DataFrame({"series": label, "model": selected['model'], "task": selected['task'], "rep": selected['rep'], "value": selected[spec['metric']] * 100}))
+    return pd.concat(frames, ignore_index=True).sort_values(['series', 'model', 'task', 'rep']).reset_index(drop=True)
+
+def model_order(models):
+    """
+    Models of a panel in figure order (MODEL_FAMILIES first, others after them) and the x span of each family.
+    """
+    ordered, spans = [], []
+    for family, family_models in MODEL_FAMILIES:
+        present = [model for model in family_models if model in models]
+        if present:
+            spans.append((family, len(ordered), len(ordered) + len(present)))
+            ordered += present
+    ordered += sorted(model for model in models if model not in ordered)
+    return ordered, spans
+
+def render_panel(name, spec, records, path):
+    """
+    Render one panel to `path` (run in a worker process).
+    """
+    data = pd.DataFrame(records, columns=['series', 'model', 'task', 'rep', 'value'])
+    models, spans = model_order(set(data['model']))
+    x = {model: i for i, model in enumerate(models)}
+    series = [label for label, _ in spec['series'] if label in set(data['series'])]
+
+    fig, ax = plt.subplots(figsize=(max(6, 0.9 * len(models) + 2), 5))
+    shades = {family: FAMILY_SHADES[i % len(FAMILY_SHADES)] for i, (family, _) in enumerate(MODEL_FAMILIES)}
+    for family, start, end in spans:
+        ax.axvspan(start - 0.5, end - 0.5, color=shades[family], zorder=0)
+        ax.text((start + end - 1) / 2, 0.98, family, transform=ax.get_xaxis_transform(), ha='center', va='top', fontsize=11)
+    if spec['kind'] == 'points':
+        for j, label in enumerate(series):
+            selected = data[data['series'] == label]
+            # Reps side by side around the model's tick, as in the paper's figures
+            counts = selected.groupby('model')['rep'].transform('count')
+            offsets = (selected.groupby('model').cumcount() - counts.sub(1) / 2) * np.minimum(0.12, 0.7 / counts)
+            ax.scatter(selected['model'].map(x) + offsets, selected['value'], marker='X', s=120, color=SERIES_COLORS[j % len(SERIES_COLORS)],
+                       edgecolors='white', linewidths=1.5, zorder=3, label=label if len(series) > 1 else None)
+    else:
+        width = 0.8 / max(len(series), 1)
+        for j, label in enumerate(series):
+            stats = data[data['series'] == label].groupby('model')['value'].agg(['mean', 'std'])
+            positions = stats.index.map(x).to_numpy() + (j - (len(series) - 1) / 2) * width
+            ax.bar(positions, stats['mean'], width, yerr=stats['std'].fillna(0), capsize=3, color=SERIES_COLORS[j % len(SERIES_COLORS)], zorder=3, label=label)
+    ax.set_xticks(range(len(models)))
+    ax.set_xticklabels(models, rotation=45, ha='right')
+    ax.set_xlim(-0.5, len(models) - 0.5)
+    ax.set_ylabel(spec['ylabel'])
+    # Headroom for the family labels
+    low, high = ax.get_ylim()
+    ax.set_ylim(low, high + 0.12 * (high - low))
+    ax.grid(axis='y', linestyle='--', alpha=0.6, zorder=1)
+    ax.spines[['top', 'right']].set_visible(False)
+    if ax.get_legend_handles_labels()[0]:
+        ax.legend(loc='lower right', bbox_to_anchor=(1, 1), ncol=len(series), frameon=False)
+    fig.tight_layout()
+
+    # The temporary file keeps the extension, from which savefig picks the format
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.tmp{ext}"
+    fig.savefig(tmp_path, dpi=200)
+    plt.close(fig)
+    os.replace(tmp_path, path)
+    return name
+
+def panel_fingerprint(name, spec, data):
+    return hashlib.sha256(json.dumps([STYLE_VERSION, name, spec, data.to_dict('split')], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def build(args):
+    started = time.perf_counter()
+    roots = args.results or sorted(path for path in glob.glob('./result_*') if os.path.isdir(path))
+    cache = AggregateCache(args.db_path)
+    aggregates, rescored = cache.update(roots, load_ground_truth(args.workbook, args.sheet), DiagnosisMatcher(cutoff=args.fuzzy_cutoff))
+    print(f"{len(aggregates)} rep directories under {len(roots)} result roots, {rescored} scored again")
+
+    names = args.panels or list(PANELS)
+    os.makedirs(args.output_dir, exist_ok=True)
+    # Only panels whose data (or style) changed since they were last rendered are drawn again
+    jobs, skipped = [], []
+    for name in names:
+        data = panel_data(aggregates, PANELS[name], args.prompt_versions)
+        path = os.path.join(args.output_dir, f'{name}.{args.format}')
+        if data.empty:
+            print(f"{name}: no results")
+            continue
+        fingerprint = panel_fingerprint(name, PANELS[name], data)
+        if not args.force and os.path.isfile(path) and cache.meta(f'panel:{path}') == fingerprint:
+            skipped.append(name)
+            continue
+        jobs.append((name, data, path, fingerprint))
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(render_panel, name, PANELS[name], data.values.tolist(), path) for name, data, path, _ in jobs]
+        for (name, _, path, fingerprint), future in zip(jobs, futures):
+            future.result()
+            with cache.conn:
+                cache.set_meta(f'panel:{path}', fingerprint)
+            print(f"{name}: {path}")
+    print(f"Rendered {len(jobs)} panels, {len(skipped)} unchanged, in {time.perf_counter() - started:.2f}s")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the accuracy figures from the result trees")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_build = subparsers.add_parser('build', help="Update the cached aggregates and render the panels whose data changed")
+    parser_build.add_argument('--results', type=str, nargs='+', help="Result roots, e.g. ./result_gpt_4o ./result_gpt_4o_POT (default: all ./result_*)")
+    parser_build.add_argument('--panels', type=str, nargs='+', choices=sorted(PANELS), help="Panels to build (default: all)")
+    parser_build.add_argument('--prompt_versions', type=str, nargs='+', help="Only use results of these prompt versions")
+    parser_build.add_argument('--output_dir', type=str, default=DEFAULT_OUTPUT_DIR, help="Directory of the rendered panels")
+    parser_build.add_argument('--format', type=str, default='png', choices=['png', 'jpg', 'pdf', 'svg'], help="Image format of the panels")
+    parser_build.add_argument('--workers', type=int, help="Panels rendered in parallel (default: one per CPU)")
+    parser_build.add_argument('--force', action='store_true', help="Render every panel, also unchanged ones")
+    parser_build.add_argument('--db_path', type=str, default=DEFAULT_DB_PATH, help="SQLite file of the cached aggregates")
+    parser_build.add_argument('--workbook', type=str, default='./30_cases_v0.3.xlsx', help="Workbook with the ground truth Diag column")
+    parser_build.add_argument('--sheet', type=str, default='o1 preview', help="Sheet with the ground truth Diag column")
+    parser_build.add_argument('--fuzzy_cutoff', type=float, default=0.85, help="Minimum similarity of a fuzzy match")
+
+    args = parser.parse_args()
+
+    sys.exit({'build': build}[args.command](args))
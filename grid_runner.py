@@ -0,0 +1,287 @@
+import os
+import asyncio
+import argparse
+import itertools
+import pandas as pd
+from dotenv import load_dotenv
+import ER_gpt
+import ER_gpt_o1
+from adaptive import AdaptiveScheduler, add_adaptive_args, rep_schedule, rule_from_args, write_reps
+from async_runner import dispatch, run_cases
+from incremental import add_incremental_args, cell_inputs, check_cells, find_stale, mark_stale
+from key_pool import KeyPool, RetryPolicy, add_retry_args
+from planner import TokenCounter, add_plan_args, format_plan, plan_items, prices_from_args, project_keys, read_latency
+from prompt_templates import add_layout_args, compile_prompt, prompt_hash
+from response_cache import add_cache_args, cache_from_args
+from response_log import add_replay_args, replay_dirs
+from run_journal import RunJournal
+from sharding import add_shard_args, shard_cases, write_manifest
+from streaming import add_stream_args, cutoff_fields_for
+from telemetry import add_telemetry_args, telemetry_from_args
+
+# Load environment variables from .env file
+load_dotenv()
+
+RUNNERS = {'gpt': ER_gpt, 'o1': ER_gpt_o1}
+
+def build_configs(args):
+    """
+    Expand the command line into the list of (model, prompt_version, with_thoughts, with_lr, rep) configs.
+    """
+    if args.all_variants:
+        variants = [(with_thoughts, with_lr) for with_thoughts in (False, True) for with_lr in (False, True)]
+    else:
+        variants = [(args.with_thoughts, args.with_lr)]
+
+    return [
+        (model, prompt_version, with_thoughts, with_lr, rep)
+        for model in args.models
+        for prompt_version in args.prompt_versions
+        for with_thoughts, with_lr in variants
+        for rep in args.reps
+    ]
+
+def open_config(args, model, prompt_version, with_thoughts, with_lr, rep, case_dict, journals, create=True):
+    """
+    Prompt, task, result paths and journal of one config, registered in `journals` by CSV path.
+    """
+    runner = RUNNERS[args.runner]
+    prompt = compile_prompt(args.runner, prompt_version, with_thoughts, with_lr, args.prompt_layout)
+    task = runner.get_task(prompt_version, with_thoughts, with_lr, args.prompt_layout)
+    save_dir = runner.get_save_dir(model, task, rep)
+    csv_save_path = os.path.join(save_dir, f'{task}_rep{rep}.csv')
+    if create:
+        os.makedirs(save_dir, exist_ok=True)
+    journal = journals.get(csv_save_path) or RunJournal(save_dir, csv_save_path, config={"model": model, "task": task, "rep": rep})
+    journals[csv_save_path] = journal
+    if args.shard and create:
+        write_manifest(save_dir, args.shard, os.path.basename(csv_save_path), list(case_dict.keys()), args.start, args.end)
+    return prompt, task, save_dir, csv_save_path, journal
+
+def work_item(args, model, with_thoughts, rep, case_name, case_dict, config):
+    prompt, task, save_dir, csv_save_path, journal = config
+    clinic_record, lab_test = case_dict[case_name]
+    user_prompt = prompt.render(clinic_record, lab_test)
+    # Same cell inputs as the single runs, so either can pick up the other's results (see incremental.py)
+    params = {"model": model} if args.runner == 'o1' else {"model": model, "temperature": args.temperature}
+    return {
+        "model": model,
+        "task": task,
+        "with_thoughts": with_thoughts,
+        "prompt": prompt,
+        "rep": rep,
+        "case_name": case_name,
+        "system_prompt": prompt.system_prompt,
+        "user_prompt": user_prompt,
+        "inputs": cell_inputs(case_dict[case_name], prompt.system_prompt, user_prompt, params),
+        "cutoff_fields": cutoff_fields_for(args.stream_cutoff, prompt),
+        "save_dir": save_dir,
+        "csv_save_path": csv_save_path,
+        "journal": journal,
+    }
+
+def config_cases(case_list, case_dict, with_lr):
+    """
+    Cases of a config: all of them, or those with lab results for the _LR variants.
+    """
+    return [case_name for case_name in case_list if not with_lr or pd.notna(case_dict[case_name][1])]
+
+def build_work_items(args, case_dict, journals, create=True):
+    """
+    One work item per (config, case) not yet in that config's journal, ordered by config and then by case.
+    Completed cases whose inputs changed are reported, and with --incremental scheduled again.
+    With create=False (planning) no result directories, shard manifests or stale marks are written.
+    """
+    case_list = shard_cases(list(case_dict.keys())[args.start:args.end], args.shard)
+
+    items = []
+    for model, prompt_version, with_thoughts, with_lr, rep in build_configs(args):
+        config = open_config(args, model, prompt_version, with_thoughts, with_lr, rep, case_dict, journals, create)
+        journal = config[-1]
+        config_items = [work_item(args, model, with_thoughts, rep, case_name, case_dict, config) for case_name in config_cases(case_list, case_dict, with_lr)]
+        stale = check_cells(journal, config[2], {item['case_name']: item['inputs'] for item in config_items}, mark=args.incremental and create, rerun=args.incremental)
+        items += [item for item in config_items if not journal.is_done(item['case_name']) or (args.incremental and item['case_name'] in stale)]
+    return items
+
+async def run_adaptive(args, case_dict, journals, run_round):
+    """
+    Adaptive reps (--adaptive): instead of every rep of every case, rounds of one more rep for each
+    case whose answers are not stable yet (see adaptive.py), through the coroutine `run_round(items, on_saved)`.
+    Reps of earlier runs count towards the stopping rule and the budget. The reps each case got are
+    written to ./result_<model>/<task>/reps.csv. Returns the number of work items run.
+    """
+    runner = RUNNERS[args.runner]
+    case_list = shard_cases(list(case_dict.keys())[args.start:args.end], args.shard)
+    rule = rule_from_args(args)
+    schedule = rep_schedule(args.reps, rule.max_reps)
+    groups = {}
+    for model, prompt_version, with_thoughts, with_lr, _ in build_configs(args):
+        groups[model, runner.get_task(prompt_version, with_thoughts, with_lr, args.prompt_layout)] = (model, prompt_version, with_thoughts, with_lr)
+    keys = [(model, task, case_name) for (model, task), group in groups.items() for case_name in config_cases(case_list, case_dict, group[3])]
+    scheduler = AdaptiveScheduler(keys, rule, schedule, args.budget)
+
+    for (model, task), group in groups.items():
+        for rep in schedule:
+            config = open_config(args, *group, rep, case_dict, journals, create=False)
+            journal = config[-1]
+            if args.incremental:
+                # Stale cells (reported while planning) do not count; their outputs are moved out of the way
+                mark_stale(journal, config[2], find_stale(journal, {case_name: work_item(args, model, group[2], rep, case_name, case_dict, config)['inputs'] for case_name in config_cases(case_list, case_dict, group[3])}))
+            for case_name in config_cases(case_list, case_dict, group[3]):
+                if journal.is_done(case_name):
+                    row = journal.records[case_name]['row']
+                    scheduler.add((model, task, case_name), rep, (row['t1'], row['t2'], row['t3']))
+    fixed_reps = len(keys) * len(args.reps)
+    print(f"Adaptive reps: up to {rule.max_reps} per case (reps {' '.join(map(str, schedule))}), at least {rule.min_reps}, stop at {rule.confidence:.0%} confidence; "
+          f"budget {args.budget or 'unbounded'}, {scheduler.used()} reps from earlier runs\n")
+
+    configs = {}
+    def item_for(key, rep):
+        model, task, case_name = key
+        if (model, task, rep) not in configs:
+            configs[model, task, rep] = open_config(args, *groups[model, task], rep, case_dict, journals)
+        return work_item(args, model, groups[model, task][2], rep, case_name, case_dict, configs[model, task, rep])
+
+    def on_saved(item, row):
+        scheduler.add((item['model'], item['task'], item['case_name']), item['rep'], (row['t1'], row['t2'], row['t3']))
+
+    n_items = 0
+    try:
+        for round_number in itertools.count(1):
+            items = [item_for(key, rep) for key, rep in scheduler.next_round()]
+            if not items:
+                break
+            print(f"Adaptive round {round_number}: {len(items)} reps ({len(scheduler.stopped)}/{len(keys)} cases stopped)")
+            await run_round(items, on_saved)
+            n_items += len(items)
+    finally:
+        for model, task in groups:
+            task_dir = os.path.dirname(runner.get_save_dir(model, task, schedule[0]))
+            if os.path.isdir(task_dir):
+                write_reps(task_dir, scheduler.table([key for key in keys if key[:2] == (model, task)]))
+
+    reasons = list(scheduler.stopped.values())
+    print(f"Adaptive reps: {scheduler.used()} of the {fixed_reps} reps of the fixed grid ({scheduler.used() / max(fixed_reps, 1):.0%}); "
+          f"cases stopped as stable: {reasons.count('stable')}, at max_reps: {reasons.count('max_reps')}, by the budget: {reasons.count('budget')}")
+    return n_items
+
+def main(args):
+    configs = build_configs(args)
+    case_dict = RUNNERS[args.runner].load_case_dict(args.workbook, args.sheet, with_lr=False)
+    journals = {}
+    items = build_work_items(args, case_dict, journals, create=not (args.plan or args.replay or args.adaptive))
+    if args.replay:
+        # Rebuild every config of the grid from its logged raw completions, without calling the API
+        replay_dirs([os.path.dirname(csv_save_path) for csv_save_path in journals], case_order=list(case_dict.keys()))
+        return
+
+    # Plan the grid before sending anything: local token counts, completion estimates from past runs
+    counter = TokenCounter()
+    auto_max_tokens = args.auto_max_tokens and args.runner != 'o1'  # o1 requests take no max_tokens
+    sized = plan_items(items, case_dict, counter, args.max_tokens, auto_max_tokens, prices_from_args(args))
+    key_names = [f"API_KEY_{i}" for i in args.keys if os.getenv(f"API_KEY_{i}")] or [f"API_KEY_{i}" for i in args.keys]
+    latency = read_latency(args.log_dir)
+    projections = project_keys(items, key_names, args.rpm, args.tpm, args.max_in_flight, latency)
+    print(format_plan(items, projections, counter, sized if auto_max_tokens else None, args.rpm, args.tpm, args.max_in_flight, latency) + '\n')
+    if args.plan:
+        return
+
+    # The pool reserves the locally counted prompt tokens plus max_tokens of every request against its key's TPM budget
+    pool = KeyPool.from_env(args.keys, args.rpm, args.max_in_flight, args.tpm, RetryPolicy(args.max_attempts), counter.request_tokens)
+    cache = cache_from_args(args)
+    telemetry = telemetry_from_args(args, f"grid_{args.runner}")
+    # Each runner keeps its own retry default unless --max_retries is given
+    retry_kwargs = {} if args.max_retries is None else {"max_retries": args.max_retries}
+
+    print(f"Runner: {args.runner}")
+    print(f"Configs: {len(configs)}")
+    print(f"Shard: {'{}/{}'.format(*args.shard) if args.shard else 'all cases'}")
+    print(f"Work items: {len(items)}{' at most, scheduled adaptively' if args.adaptive else ''} (completed items from earlier runs are skipped)")
+    print(f"Keys: {', '.join(key.name for key in pool.keys)}")
+    print(f"RPM / TPM per key: {args.rpm or 'from headers'} / {args.tpm or 'from headers'}")
+    print(f"Max in-flight per key: {args.max_in_flight}")
+    print(f"Cache: {args.cache}")
+    print(f"Stream: {args.stream}{f' (cutoff: {args.stream_cutoff})' if args.stream else ''}\n")
+
+    async def call_item(item):
+        # The pool picks a key for every request (and retry), so calls go straight through it
+        with telemetry.call(case=item['case_name'], model=item['model'], rep=item['rep'], save_dir=item['save_dir']) as metrics:
+            if args.runner == 'o1':
+                result = await ER_gpt_o1.api_call_o1(pool, item['model'], item['user_prompt'], item['case_name'], item['save_dir'], cache=cache, rep=item['rep'], metrics=metrics, **retry_kwargs)
+            else:
+                result = await ER_gpt.api_call_text(pool, item['model'], item['system_prompt'], item['user_prompt'], item['case_name'], item['max_tokens'], args.temperature, item['save_dir'], cache=cache, rep=item['rep'],
+                                                    stream=args.stream, cutoff_fields=item['cutoff_fields'], metrics=metrics, **retry_kwargs)
+        return result, metrics
+
+    def save_item(item, result):
+        case_name = item['case_name']
+        (t1, t2, t3, tokens), metrics = result
+
+        row = {"Case": case_name, "t1": t1, "t2": t2, "t3": t3, "Tokens": tokens}
+        if args.stream and args.runner != 'o1':
+            row.update({"TTFT": metrics.get('ttft'), "TTLD": metrics.get('ttld')})
+        item['journal'].record(row, prompt_hash=prompt_hash(item['system_prompt'], item['user_prompt']), inputs=item['inputs'])
+
+        print({"Save Dir": item['save_dir'], **row})
+        return row
+
+    async def run_round(round_items, on_saved):
+        # Adaptive rounds are planned up front with the rest of the grid, so they take its max_tokens
+        for item in round_items:
+            item['max_tokens'] = sized.get((item['model'], item['with_thoughts']), args.max_tokens) if auto_max_tokens else args.max_tokens
+        # All rounds run in one event loop, as the pool's clients are bound to it
+        await dispatch(round_items, call_item, pool.capacity, on_result=lambda item, result: on_saved(item, save_item(item, result)))
+
+    # All work items share the pooled keys; the pool enforces the per-key budgets
+    try:
+        if args.adaptive:
+            n_items = asyncio.run(run_adaptive(args, case_dict, journals, run_round))
+        else:
+            run_cases(items, call_item, pool.capacity, on_result=save_item)
+            n_items = len(items)
+    finally:
+        # Rebuild every CSV of the grid from its journal
+        for csv_save_path, journal in journals.items():
+            journal.finalize(csv_save_path, list(case_dict.keys()))
+        telemetry.close()
+        print(telemetry.summary())
+
+    if cache.enabled:
+        cache.evict()
+        print(cache.summary())
+    print(pool.summary())
+    print(f"Grid completed: {n_items} work items over {len(configs)} configs.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a grid of DDX Experiments across all API keys")
+
+    parser.add_argument('--runner', type=str, choices=sorted(RUNNERS), default='gpt', help="Runner whose prompts and API call are used")
+    parser.add_argument('--models', type=str, nargs='+', default=['chatgpt-4o-latest'], help="Models to use")
+    parser.add_argument('--max_tokens', type=int, default=1000, help="Maximum tokens for the response (gpt runner only)")
+    parser.add_argument('--temperature', type=float, default=0.7, help="Temperature for the API call (gpt runner only)")
+    parser.add_argument('--reps', type=int, nargs='+', default=[1, 2, 3, 4, 5], help="Repetition numbers")
+    parser.add_argument('--prompt_versions', type=str, nargs='+', default=['v2.0'], help="Prompt versions")
+    parser.add_argument('--with_thoughts', action='store_true', help="Include thoughts in output")
+    parser.add_argument('--with_lr', action='store_true', help="Include lab results in the user prompt")
+    parser.add_argument('--all_variants', action='store_true', help="Run all thoughts x lab results combinations")
+    parser.add_argument('--start', type=int, default=0, help="Index of the first case")
+    parser.add_argument('--end', type=int, help="Index after the last case")
+    parser.add_argument('--keys', type=int, nargs='+', default=[1, 2, 3, 4, 5], help="Indices of the API_KEY_<i> variables to pool")
+    parser.add_argument('--max_in_flight', type=int, default=8, help="Maximum concurrent requests on each key")
+    parser.add_argument('--max_retries', type=int, help="Re-requests of a case whose response cannot be repaired locally (default: 2 for gpt, 5 for o1)")
+    parser.add_argument('--workbook', type=str, default='./30_cases_v0.3.xlsx', help="Workbook with the cases")
+    parser.add_argument('--sheet', type=str, default='o1 preview', help="Sheet with the cases")
+    add_layout_args(parser)
+    add_adaptive_args(parser)
+    add_plan_args(parser)
+    add_retry_args(parser)
+    add_shard_args(parser)
+    add_cache_args(parser)
+    add_incremental_args(parser)
+    add_replay_args(parser)
+    add_telemetry_args(parser)
+    add_stream_args(parser)
+
+    args = parser.parse_args()
+
+    main(args)
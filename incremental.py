@@ -0,0 +1,77 @@
+import os
+import json
+import shutil
+import hashlib
+from prompt_templates import prompt_hash
+from run_journal import JOURNAL_NAME
+
+STALE_DIR = 'stale'
+STALE_LOG_NAME = 'stale.jsonl'
+
+def _hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+def cell_inputs(case, system_prompt, user_prompt, params):
+    """
+    Fingerprints of the inputs of one cell (case, config and rep): the case text (e.g. [SS, LR]),
+    the rendered prompt pair and the model and sampling parameters.
+    """
+    return {"case": _hash(case), "prompt": prompt_hash(system_prompt, user_prompt), "params": _hash(params)}
+
+def stale_reasons(record, inputs):
+    """
+    Inputs of a journal record that differ from the current ones ([] if the record is current).
+    Records written before the cell inputs were kept are judged by their prompt hash, and records
+    imported from a CSV without any hash are taken as current.
+    """
+    if 'inputs' not in record:
+        return ['prompt'] if record.get('prompt_hash') not in (None, inputs['prompt']) else []
+    return [name for name, value in inputs.items() if record['inputs'].get(name) != value]
+
+def find_stale(journal, inputs_by_case):
+    """
+    {case: reasons} of the completed cells of a journal whose inputs changed.
+    """
+    stale = {}
+    for case_name, inputs in inputs_by_case.items():
+        if journal.is_done(case_name):
+            reasons = stale_reasons(journal.records[case_name], inputs)
+            if reasons:
+                stale[case_name] = reasons
+    return stale
+
+def mark_stale(journal, save_dir, stale):
+    """
+    Move the outputs of stale cells out of the way, so the next run executes them again and no
+    result mixes old and new inputs: the case JSON goes to <save_dir>/stale/, its journal record
+    (with the reasons) to stale/stale.jsonl, and the journal is rewritten without it.
+    """
+    if not stale:
+        return
+    stale_dir = os.path.join(save_dir, STALE_DIR)
+    os.makedirs(stale_dir, exist_ok=True)
+    with open(os.path.join(stale_dir, STALE_LOG_NAME), 'a') as f:
+        for case_name, reasons in stale.items():
+            f.write(json.dumps({**journal.records[case_name], "stale": reasons}, default=str) + '\n')
+            response_save_path = os.path.join(save_dir, f'{case_name}.json')
+            if os.path.isfile(response_save_path):
+                shutil.move(response_save_path, os.path.join(stale_dir, f'{case_name}.json'))
+    journal.drop(stale)
+
+def check_cells(journal, save_dir, inputs_by_case, mark=False, rerun=None):
+    """
+    Compare the completed cells of a result directory against their current inputs and print the
+    stale ones. With mark=True (--incremental) they are marked stale, so the run executes them again;
+    `rerun` (default: mark) only tells the message whether they will be. Returns {case: reasons}.
+    """
+    stale = find_stale(journal, inputs_by_case)
+    if stale:
+        reasons = sorted({reason for case_reasons in stale.values() for reason in case_reasons})
+        action = "they will run again" if (mark if rerun is None else rerun) else "rerun with --incremental to run them again"
+        print(f"{os.path.join(save_dir, JOURNAL_NAME)}: {len(stale)} completed cases have changed inputs ({', '.join(reasons)}); {action}")
+        if mark:
+            mark_stale(journal, save_dir, stale)
+    return stale
+
+def add_incremental_args(parser):
+    parser.add_argument('--incremental', action='store_true', help="Run completed cases again whose case text, rendered prompt, model or sampling parameters changed, and move their old outputs to stale/")
@@ -0,0 +1,391 @@
+import os
+import re
+import time
+import types
+import random
+import asyncio
+import contextlib
+from email.utils import parsedate_to_datetime
+import openai
+from telemetry import accumulate, current_metrics
+
+# Status codes worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+# Share of the limits reported by the API that the buckets are sized to
+HEADER_SAFETY = 0.95
+
+_DURATION = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+def parse_duration(value):
+    """
+    Seconds of an x-ratelimit-reset-* header such as "20ms", "1s" or "6m0s".
+    """
+    if value is None:
+        return None
+    parts = _DURATION.findall(str(value))
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+def _header_float(headers, name):
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+def retry_after(error):
+    """
+    Seconds to wait according to the Retry-After (or rate-limit reset) headers of an API error, or None.
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+
+    value = _header_float(headers, 'retry-after-ms')
+    if value is not None:
+        return value / 1000
+    value = headers.get('retry-after')
+    if value is not None:
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    resets = [parse_duration(headers.get(name)) for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=60.0):
+    """
+    Exponential backoff with full jitter for the `attempt`-th retry (0-based).
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+class RetryPolicy:
+    """
+    Retry policy shared by all runners. 429s, timeouts, connection errors and 5xx responses are
+    retried up to `max_attempts` times; the wait honours Retry-After and the rate-limit reset
+    headers (plus a little jitter) and falls back to jittered exponential backoff.
+    """
+
+    def __init__(self, max_attempts=8, base_delay=1.0, max_delay=60.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, error):
+        if isinstance(error, openai.APIConnectionError):
+            return True
+        status = getattr(error, 'status_code', None)
+        return status in RETRYABLE_STATUS or (status is not None and status >= 500)
+
+    def delay(self, attempt, error):
+        wait = retry_after(error)
+        if wait is not None:
+            return wait + random.uniform(0, 0.1 * wait + 0.05)
+        return backoff_delay(attempt, self.base_delay, self.max_delay)
+
+class TokenBucket:
+    """
+    Continuously refilled budget of `per_minute` units holding at most `burst` seconds of refill.
+    Requests larger than the bucket wait until it is full and leave it in debt.
+    """
+
+    def __init__(self, per_minute=None, burst=1.0):
+        self.burst = burst
+        self.level = 0.0
+        self.updated = None
+        self.set_rate(per_minute)
+
+    def set_rate(self, per_minute):
+        self.per_second = per_minute / 60.0 if per_minute else 0.0
+        self.capacity = max(1.0, self.per_second * self.burst)
+        if self.updated is None:
+            self.level = self.capacity
+
+    def _refill(self, now):
+        if self.updated is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.per_second)
+        self.updated = now
+
+    def wait_time(self, now, amount=1.0):
+        if not self.per_second:
+            return 0.0
+        self._refill(now)
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.per_second)
+
+    def take(self, now, amount=1.0):
+        if self.per_second:
+            self._refill(now)
+            self.level -= amount
+
+class CircuitBreaker:
+    """
+    Takes a key out of rotation after `threshold` consecutive throttles or failures. The key is
+    probed again after the cooldown (half-open), which doubles every time the probe fails.
+    """
+
+    def __init__(self, threshold=5, cooldown=5.0, max_cooldown=120.0):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.half_open = False
+        self.opened = 0
+
+    def available_at(self, now, in_flight):
+        # Half-open: a single probe request at a time, counting the probe reserved during the cooldown
+        if self.half_open and in_flight:
+            return float('inf')
+        return max(now, self.open_until)
+
+    def on_success(self):
+        self.failures = 0
+        self.half_open = False
+        self.cooldown = self.base_cooldown
+
+    def on_failure(self, now, wait=None):
+        self.failures += 1
+        if self.half_open or self.failures >= self.threshold:
+            self.open_until = now + max(self.cooldown, wait or 0.0)
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            self.half_open = True
+            self.failures = 0
+            self.opened += 1
+
+class ApiKey:
+    def __init__(self, name, api_key, rpm=None, max_in_flight=8, tpm=None, breaker=None):
+        self.name = name
+        # Retries are handled by the pool, so the client itself does not retry
+        self.client = openai.AsyncOpenAI(api_key=api_key, max_retries=0)
+        self.rpm, self.tpm = rpm, tpm
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.breaker = breaker or CircuitBreaker()
+        self.blocked_until = 0.0
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.calls = 0
+        self.throttled = 0
+        self.errors = 0
+
+    def ready_at(self, now, tokens=0):
+        """
+        Earliest time this key can send a request of about `tokens` tokens.
+        """
+        return max(
+            self.blocked_until,
+            self.breaker.available_at(now, self.in_flight),
+            now + self.requests.wait_time(now),
+            now + self.tokens.wait_time(now, tokens),
+        )
+
+    def reserve(self, now, tokens=0):
+        self.requests.take(now)
+        self.tokens.take(now, tokens)
+        self.in_flight += 1
+        self.calls += 1
+
+    def observe(self, headers, now):
+        """
+        Size the buckets to the limits reported in the rate-limit headers (capped by --rpm/--tpm),
+        and pause the key until the reset time once a limit is used up.
+        """
+        for bucket, fixed, kind in ((self.requests, self.rpm, 'requests'), (self.tokens, self.tpm, 'tokens')):
+            limit = _header_float(headers, f'x-ratelimit-limit-{kind}')
+            if limit:
+                bucket.set_rate(min(limit * HEADER_SAFETY, fixed or float('inf')))
+            remaining = _header_float(headers, f'x-ratelimit-remaining-{kind}')
+            reset = parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+            if remaining is not None and remaining < 1 and reset:
+                self.blocked_until = max(self.blocked_until, now + reset)
+
+def estimate_tokens(request):
+    """
+    Upper estimate of the tokens of a request (prompt at ~4 characters per token plus max_tokens).
+    """
+    chars = sum(len(str(message.get('content') or '')) for message in request.get('messages', []))
+    completion = request.get('max_tokens') or request.get('max_completion_tokens') or 1000
+    return chars // 4 + completion * (request.get('n') or 1)
+
+class _PooledStream:
+    """
+    Streamed response that holds its key's slot until the stream is closed.
+    """
+
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __aiter__(self):
+        return self._stream.__aiter__()
+
+    async def close(self):
+        try:
+            await self._stream.close()
+        finally:
+            if self._on_close is not None:
+                on_close, self._on_close = self._on_close, None
+                await on_close()
+
+class KeyPool:
+    """
+    Share work across several API keys. Each request takes the key that can send it first given
+    its request and token buckets, Retry-After pauses and circuit breaker, so all keys stay
+    saturated and throttled keys are routed around instead of stalling the run.
+
+    The pool can stand in for an openai.AsyncOpenAI client: `pool.chat.completions.create(**request)`
+    sends the request with the shared RetryPolicy.
+    """
+
+    def __init__(self, keys, retry_policy=None, token_counter=None):
+        if not keys:
+            raise ValueError("No API keys available")
+        self.keys = keys
+        self.retry_policy = retry_policy or RetryPolicy()
+        # Tokens a request reserves against its key's TPM budget (e.g. planner.TokenCounter.request_tokens)
+        self.token_counter = token_counter or estimate_tokens
+        self.retries = 0
+        self._condition = None
+        # Drop-in for the client interface used by the runners' API calls
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    @classmethod
+    def from_env(cls, key_indices=(1, 2, 3, 4, 5), rpm=None, max_in_flight=8, tpm=None, retry_policy=None, token_counter=None):
+        """
+        Build the pool from the API_KEY_<i> environment variables, skipping unset ones.
+        """
+        keys = [
+            ApiKey(f"API_KEY_{i}", os.getenv(f"API_KEY_{i}"), rpm, max_in_flight, tpm)
+            for i in key_indices
+            if os.getenv(f"API_KEY_{i}")
+        ]
+        return cls(keys, retry_policy, token_counter)
+
+    @property
+    def capacity(self):
+        return sum(key.max_in_flight for key in self.keys)
+
+    async def acquire(self, tokens=0):
+        # Created lazily so the pool can be built outside of the event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+
+        loop = asyncio.get_running_loop()
+        async with self._condition:
+            while True:
+                now = loop.time()
+                free = [key for key in self.keys if key.in_flight < key.max_in_flight]
+                if free:
+                    key = min(free, key=lambda k: (k.ready_at(now, tokens), k.in_flight))
+                    start = key.ready_at(now, tokens)
+                    if start != float('inf'):
+                        break
+                # Every key is busy or probing: wait for a release
+                await self._condition.wait()
+
+            key.reserve(now, tokens)
+
+        if start > now:
+            await asyncio.sleep(start - now)
+        return key
+
+    async def release(self, key):
+        async with self._condition:
+            key.in_flight -= 1
+            self._condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """
+        Hold one request slot of the key that is ready first for the duration of the block.
+        """
+        key = await self.acquire()
+        try:
+            yield key
+        finally:
+            await self.release(key)
+
+    async def create(self, **request):
+        """
+        Send a chat completion with retries. 429s pause the throttled key until its Retry-After and
+        count towards its circuit breaker, so the retry goes to whichever key is ready first.
+        The enclosing telemetry call (if any) gets the time spent waiting for a key slot (queue_wait),
+        the network latency of every attempt (until the stream is closed for streamed requests),
+        and the retries and backoff of the pool (pool_retries, backoff).
+        """
+        loop = asyncio.get_running_loop()
+        metrics = current_metrics()
+        tokens = self.token_counter(request)
+        attempt = 0
+        while True:
+            queued = loop.time()
+            key = await self.acquire(tokens)
+            sent = loop.time()
+            accumulate(metrics, 'queue_wait', sent - queued)
+            try:
+                raw = await key.client.chat.completions.with_raw_response.create(**request)
+                response = raw.parse()
+            except Exception as e:
+                await self.release(key)
+                now = loop.time()
+                accumulate(metrics, 'latency', now - sent)
+                if not self.retry_policy.is_retryable(e) or attempt + 1 >= self.retry_policy.max_attempts:
+                    key.errors += 1
+                    raise
+                wait = self.retry_policy.delay(attempt, e)
+                key.breaker.on_failure(now, wait)
+                if getattr(e, 'status_code', None) == 429:
+                    # Only the throttled key waits; the retry can go out on another key right away
+                    key.throttled += 1
+                    key.blocked_until = max(key.blocked_until, now + wait)
+                    wait = 0.0
+                attempt += 1
+                self.retries += 1
+                accumulate(metrics, 'pool_retries', 1)
+                accumulate(metrics, 'backoff', wait)
+                await asyncio.sleep(wait)
+                continue
+            except BaseException:
+                await self.release(key)
+                raise
+
+            now = loop.time()
+            key.breaker.on_success()
+            key.observe(raw.headers, now)
+            if request.get('stream'):
+                async def close_stream(key=key, sent=sent):
+                    accumulate(metrics, 'latency', loop.time() - sent)
+                    await self.release(key)
+                return _PooledStream(response, close_stream)
+
+            accumulate(metrics, 'latency', now - sent)
+
+            # Settle the token estimate against the actual usage
+            usage = getattr(response, 'usage', None)
+            if usage is not None:
+                key.tokens.level += tokens - usage.total_tokens
+            await self.release(key)
+            return response
+
+    def summary(self):
+        keys = ', '.join(
+            f"{key.name}: {key.calls} calls" + (f" ({key.throttled} throttled, {key.errors} errors, breaker opened {key.breaker.opened}x)" if key.throttled or key.errors or key.breaker.opened else '')
+            for key in self.keys
+        )
+        return f"{keys}; {self.retries} retries"
+
+def add_retry_args(parser):
+    parser.add_argument('--rpm', type=float, help="Requests per minute allowed on each key (default: learned from the rate-limit headers)")
+    parser.add_argument('--tpm', type=float, help="Tokens per minute allowed on each key (default: learned from the rate-limit headers)")
+    parser.add_argument('--max_attempts', type=int, default=8, help="Attempts per request on 429s, timeouts and server errors")
+
+def single_key_pool(name, api_key, args, max_in_flight):
+    """
+    Pool of one key for the single-rep runners, so they share the retry and rate limit handling.
+    """
+    return KeyPool([ApiKey(name, api_key, args.rpm, max_in_flight, args.tpm)], RetryPolicy(args.max_attempts))
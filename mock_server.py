@@ -0,0 +1,249 @@
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DIAGNOSES = ['Pneumonia', 'Pulmonary embolism', 'Heart failure', 'Pancreatitis', 'Renal colic', 'Urinary tract infection', 'Diverticulitis', 'Cholangitis']
+
+class MockConfig:
+    """
+    Behaviour of the mock endpoint. Latency is log-normal around `latency_ms` (fixed if `latency_sigma`
+    is 0); the rates are per-request probabilities of a 429, a 5xx, or a truncated (unrecoverable)
+    JSON body. Prompts of at least `cache_min_tokens` tokens go through a provider-style prefix
+    cache (0 disables it).
+    """
+
+    def __init__(self, latency_ms=200, latency_sigma=0.5, rate_429=0.0, rate_5xx=0.0, rate_malformed=0.0,
+                 retry_after_ms=100, completion_tokens=None, stream_chunk_chars=8, seed=0, cache_min_tokens=1024):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.rate_malformed = rate_malformed
+        self.retry_after_ms = retry_after_ms
+        self.completion_tokens = completion_tokens
+        self.stream_chunk_chars = stream_chunk_chars
+        self.seed = seed
+        self.cache_min_tokens = cache_min_tokens
+
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {'requests': 0, 'ok': 0, '429': 0, '5xx': 0, 'malformed': 0}
+
+    def add(self, *names):
+        with self.lock:
+            for name in names:
+                self.counts[name] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+class MockPromptCache:
+    """
+    Prefix cache like the provider's: prompts are cached in blocks of `block` tokens from
+    `min_tokens` on, and a request is billed the longest cached prefix of its prompt as cached tokens.
+    """
+
+    def __init__(self, min_tokens=1024, block=128):
+        self.min_tokens = min_tokens
+        self.block = block
+        self.lock = threading.Lock()
+        self.prefixes = set()
+
+    def lookup(self, prompt):
+        # ~4 characters per token, as in _count_tokens
+        bounds = range(self.min_tokens * 4, len(prompt) + 1, self.block * 4)
+        cached = 0
+        with self.lock:
+            for bound in bounds:
+                if hash(prompt[:bound]) not in self.prefixes:
+                    break
+                cached = bound // 4
+            self.prefixes.update(hash(prompt[:bound]) for bound in bounds)
+        return cached
+
+def _count_tokens(text):
+    # Rough tokenizer stand-in: ~4 characters per token
+    return max(1, len(text) // 4)
+
+def prompt_text(messages):
+    return ''.join(str(message.get('content') or '') for message in messages)
+
+def build_content(messages, rng):
+    """
+    JSON answer with the fields the prompt asks for (thoughts/discussion/assessment are only added when requested).
+    """
+    prompt = prompt_text(messages)
+    result = {}
+    for field in ('thoughts', 'discussion', 'assessment'):
+        if f'"{field}"' in prompt:
+            result[field] = 'Mock reasoning about the presenting symptoms and history. ' * 8
+    for i, diagnosis in enumerate(rng.sample(DIAGNOSES, 3), start=1):
+        result[f'top{i}'] = diagnosis
+    return json.dumps(result, indent=4), _count_tokens(prompt)
+
+class MockHandler(BaseHTTPRequestHandler):
+    server_version = 'MockOpenAI/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/stats'):
+            self._send_json(200, self.server.stats.snapshot())
+        else:
+            self._send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path.rstrip('/').endswith('/reset'):
+            self.server.stats.reset()
+            self._send_json(200, {"reset": True})
+            return
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {"error": {"message": "Not found"}})
+            return
+
+        config = self.server.config
+        with self.server.rng_lock:
+            rng = random.Random(self.server.rng.random())
+        self.server.stats.add('requests')
+
+        latency = config.latency_ms / 1000 * (rng.lognormvariate(0, config.latency_sigma) if config.latency_sigma else 1)
+        time.sleep(latency)
+
+        roll = rng.random()
+        if roll < config.rate_429:
+            self.server.stats.add('429')
+            self._send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}},
+                            {'retry-after-ms': str(config.retry_after_ms), 'x-ratelimit-remaining-requests': '0'})
+            return
+        if roll < config.rate_429 + config.rate_5xx:
+            self.server.stats.add('5xx')
+            self._send_json(rng.choice([500, 502, 503]), {"error": {"message": "Server error (mock)", "type": "server_error"}})
+            return
+
+        n = body.get('n') or 1
+        choices = []
+        completion_tokens = 0
+        malformed = False
+        for index in range(n):
+            content, prompt_tokens = build_content(body.get('messages', []), rng)
+            if rng.random() < config.rate_malformed:
+                # Cut the JSON before top3 so it cannot be repaired locally
+                content = content[:content.index('"top2"')]
+                malformed = True
+            completion_tokens += config.completion_tokens or _count_tokens(content)
+            choices.append((index, content))
+        self.server.stats.add('malformed' if malformed else 'ok')
+
+        cached_tokens = self.server.prompt_cache.lookup(prompt_text(body.get('messages', []))) if config.cache_min_tokens else 0
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+        completion_id = f"chatcmpl-mock{rng.getrandbits(48):012x}"
+        if body.get('stream'):
+            self._stream(completion_id, body.get('model'), choices, usage, body.get('stream_options') or {})
+            return
+        self._send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get('model'),
+            "choices": [{"index": index, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"} for index, content in choices],
+            "usage": usage,
+        })
+
+    def _stream(self, completion_id, model, choices, usage, stream_options):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        def event(choice_list, usage=None):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model, "choices": choice_list, "usage": usage}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+
+        size = self.server.config.stream_chunk_chars
+        try:
+            for index, content in choices:
+                for start in range(0, len(content), size):
+                    event([{"index": index, "delta": {"content": content[start:start + size]}, "finish_reason": None}])
+                event([{"index": index, "delta": {}, "finish_reason": "stop"}])
+            if stream_options.get('include_usage'):
+                event([], usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream early (streaming cutoff)
+            pass
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        super().__init__((host, port), MockHandler)
+        self.config = config or MockConfig()
+        self.stats = MockStats()
+        self.rng = random.Random(self.config.seed)
+        self.rng_lock = threading.Lock()
+        self.prompt_cache = MockPromptCache(self.config.cache_min_tokens)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        """
+        Serve from a daemon thread and return the base URL for OPENAI_BASE_URL.
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.base_url
+
+def add_mock_args(parser):
+    parser.add_argument('--latency_ms', type=float, default=200, help="Median latency of a completion")
+    parser.add_argument('--latency_sigma', type=float, default=0.5, help="Log-normal sigma of the latency (0 for fixed latency)")
+    parser.add_argument('--rate_429', type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument('--rate_5xx', type=float, default=0.0, help="Share of requests answered with a 5xx error")
+    parser.add_argument('--rate_malformed', type=float, default=0.0, help="Share of completions with truncated JSON")
+    parser.add_argument('--retry_after_ms', type=int, default=100, help="retry-after-ms header of 429 responses")
+    parser.add_argument('--completion_tokens', type=int, help="Fixed completion tokens per choice (default: ~4 characters per token)")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed of the mock")
+    parser.add_argument('--cache_min_tokens', type=int, default=1024, help="Minimum prompt tokens for the emulated prompt prefix cache (0 disables it)")
+
+def config_from_args(args):
+    return MockConfig(args.latency_ms, args.latency_sigma, args.rate_429, args.rate_5xx, args.rate_malformed, args.retry_after_ms, args.completion_tokens, seed=args.seed, cache_min_tokens=args.cache_min_tokens)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local mock of the OpenAI chat completions endpoint")
+    parser.add_argument('--host', type=str, default='127.0.0.1', help="Host to bind")
+    parser.add_argument('--port', type=int, default=8000, help="Port to bind")
+    add_mock_args(parser)
+    args = parser.parse_args()
+
+    server = MockServer(config_from_args(args), args.host, args.port)
+    print(f"Mock OpenAI server on {server.base_url} (set OPENAI_BASE_URL to this); stats at {server.base_url}/stats")
+    server.serve_forever()
@@ -0,0 +1,292 @@
+import os
+import glob
+import json
+import math
+import argparse
+import numpy as np
+import pandas as pd
+
+try:
+    import tiktoken
+except ImportError:  # Optional: without it prompt tokens are estimated at ~4 characters per token
+    tiktoken = None
+
+# USD per 1M (prompt, completion) tokens, list prices at the time of writing; override with --price
+PRICES = {
+    'chatgpt-4o-latest': (5.00, 15.00),
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4-turbo': (10.00, 30.00),
+    'gpt-4': (30.00, 60.00),
+    'gpt-3.5-turbo': (0.50, 1.50),
+    'o1-preview': (15.00, 60.00),
+    'o1-mini': (3.00, 12.00),
+    'o1': (15.00, 60.00),
+}
+# Completion tokens assumed for a variant that no past run has a Tokens column for
+DEFAULT_COMPLETION_TOKENS = {False: 60, True: 400}
+# Latency assumed when the telemetry logs have no calls of the model
+DEFAULT_LATENCY = 5.0
+# Sized max_tokens: p99 of the past completions plus headroom, in steps of MAX_TOKENS_STEP
+MAX_TOKENS_HEADROOM = 1.25
+MAX_TOKENS_STEP = 64
+MAX_TOKENS_CAP = 4096
+
+class TokenCounter:
+    """
+    Offline prompt token counts: tiktoken's encoding of the model if it is installed (and its
+    encoding file cached), otherwise ~4 characters per token.
+    """
+
+    def __init__(self):
+        self._encodings = {}
+        self._counts = {}
+
+    def encoding(self, model):
+        if model not in self._encodings:
+            encoding = None
+            if tiktoken is not None:
+                try:
+                    try:
+                        encoding = tiktoken.encoding_for_model(model)
+                    except KeyError:
+                        # Model names tiktoken does not know yet use the encoding of the current models
+                        encoding = tiktoken.get_encoding('o200k_base')
+                except Exception as e:
+                    # Encoding files are downloaded on first use; without them fall back to the estimate
+                    print(f"No tiktoken encoding for {model} ({e.__class__.__name__}); estimating ~4 characters per token")
+            self._encodings[model] = encoding
+        return self._encodings[model]
+
+    def method(self, model):
+        encoding = self.encoding(model)
+        return f"tiktoken {encoding.name}" if encoding is not None else "~4 characters per token"
+
+    def count(self, text, model):
+        key = (model, text)
+        if key not in self._counts:
+            encoding = self.encoding(model)
+            self._counts[key] = len(encoding.encode(text, disallowed_special=())) if encoding is not None else len(text) // 4
+        return self._counts[key]
+
+    def count_messages(self, messages, model):
+        # Chat formatting adds ~4 tokens per message and 3 priming the reply
+        return 3 + sum(4 + self.count(str(message.get('content') or ''), model) for message in messages)
+
+    def request_tokens(self, request):
+        """
+        Tokens a request counts against a TPM limit: its prompt plus max_tokens per choice. Drop-in
+        for key_pool.estimate_tokens.
+        """
+        completion = request.get('max_tokens') or request.get('max_completion_tokens') or 1000
+        return self.count_messages(request.get('messages', []), request['model']) + completion * (request.get('n') or 1)
+
+def item_messages(item):
+    """
+    Chat messages of a work item as the runners send them (o1 prompts have no system message).
+    """
+    messages = [{"role": "user", "content": item['user_prompt']}]
+    if item['system_prompt'] is not None:
+        messages.insert(0, {"role": "system", "content": item['system_prompt']})
+    return messages
+
+def read_history(task, roots=('.',)):
+    """
+    Tokens of past runs of `task` from their result CSVs: {model_key: {case: [(tokens, samples), ...]}},
+    where model_key is the model as written in its result_<model> directory and samples the number
+    of choices whose call the Tokens are a share of (the Samples column of --samples runs, else 1).
+    """
+    history = {}
+    for root in roots:
+        for csv_path in glob.glob(os.path.join(root, 'result_*', task, 'rep*', f'{task}_rep*.csv')):
+            model_key = os.path.relpath(csv_path, root).split(os.sep)[0][len('result_'):]
+            table = pd.read_csv(csv_path)
+            if 'Tokens' not in table or 'Case' not in table:
+                continue
+            samples = pd.to_numeric(table['Samples'], errors='coerce').fillna(1) if 'Samples' in table else pd.Series(1, index=table.index)
+            for case_name, tokens, k in zip(table['Case'].astype(str), pd.to_numeric(table['Tokens'], errors='coerce'), samples):
+                if pd.notna(tokens):
+                    history.setdefault(model_key, {}).setdefault(case_name, []).append((float(tokens), max(int(k), 1)))
+    return history
+
+def read_latency(log_dir):
+    """
+    Median latency per model of the single-request calls in the telemetry logs.
+    """
+    latency = {}
+    for path in glob.glob(os.path.join(log_dir, '*.jsonl*')):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('model') and record.get('requests') == 1 and record.get('latency') is not None:
+                    latency.setdefault(record['model'], []).append(record['latency'])
+    return {model: float(np.median(values)) for model, values in latency.items()}
+
+def size_max_tokens(completions, default, observed=()):
+    """
+    max_tokens that fits the past completions of a variant: their p99 plus headroom, never below the
+    longest completion in `completions` or `observed` (mean completions of multi-choice calls, which
+    bound their longest choice from below), or `default` without completions.
+    """
+    if not len(completions):
+        return default
+    longest = max(max(completions), max(observed, default=0))
+    tokens = math.ceil(max(np.percentile(completions, 99) * MAX_TOKENS_HEADROOM, longest) / MAX_TOKENS_STEP) * MAX_TOKENS_STEP
+    return int(min(max(tokens, MAX_TOKENS_STEP), MAX_TOKENS_CAP))
+
+def price_for(model, prices):
+    """
+    (prompt, completion) USD per 1M tokens of `model`: its own entry, else that of the longest
+    listed prefix (e.g. dated snapshots), else None.
+    """
+    if model in prices:
+        return prices[model]
+    prefixes = [name for name in prices if model.startswith(name)]
+    return prices[max(prefixes, key=len)] if prefixes else None
+
+def plan_items(items, case_dict, counter, max_tokens=1000, auto_max_tokens=False, prices=PRICES, roots=('.',)):
+    """
+    Count the prompt tokens of every work item and estimate its completion tokens from the Tokens
+    column of past runs: the case's own mean for the same model and task, else the median of the
+    model's task, else of other models' runs of the task, else DEFAULT_COMPLETION_TOKENS. Each item
+    gets a 'plan' dict and its 'max_tokens', sized per (model, thoughts) variant if auto_max_tokens.
+    Rows of --samples runs hold a share of a multi-choice call: their share of the prompt is
+    subtracted for the estimates, and only single-choice rows, whose completion is exact, size max_tokens.
+    """
+    tasks = {}
+    for item in items:
+        tasks.setdefault((item['model'], item['task']), item)
+
+    # Completion tokens of past calls: their Tokens minus the (share of the) prompt tokens counted here
+    completions, variant_completions, variant_shared = {}, {}, {}
+    history = {task: read_history(task, roots) for task in {task for _, task in tasks}}
+    for (model, task), item in tasks.items():
+        model_key = model.replace('-', '_')
+        prompt_tokens = {
+            str(case_name): counter.count_messages(item_messages({"system_prompt": item['prompt'].system_prompt, "user_prompt": item['prompt'].render(*case_dict[case_name])}), model)
+            for case_name in case_dict
+        }
+        own, other = {}, []
+        for run_model, cases in history[task].items():
+            for case_name, tokens in cases.items():
+                if case_name not in prompt_tokens:
+                    continue
+                values = [(max(value - prompt_tokens[case_name] / samples, 0), samples) for value, samples in tokens]
+                if run_model == model_key:
+                    own[case_name] = [value for value, _ in values]
+                    variant_completions.setdefault((model, item['with_thoughts']), []).extend(value for value, samples in values if samples == 1)
+                    variant_shared.setdefault((model, item['with_thoughts']), []).extend(value for value, samples in values if samples > 1)
+                else:
+                    other += [value for value, _ in values]
+        completions[model, task] = (own, other)
+
+    variants = {(model, item['with_thoughts']) for (model, _), item in tasks.items()}
+    sized = {variant: size_max_tokens(variant_completions.get(variant, []), max_tokens, variant_shared.get(variant, [])) for variant in variants}
+    for item in items:
+        own, other = completions[item['model'], item['task']]
+        own_all = [value for values in own.values() for value in values]
+        if own.get(str(item['case_name'])):
+            completion, source = np.mean(own[str(item['case_name'])]), 'case'
+        elif own_all:
+            completion, source = np.median(own_all), 'model'
+        elif other:
+            completion, source = np.median(other), 'other models'
+        else:
+            completion, source = DEFAULT_COMPLETION_TOKENS[bool(item['with_thoughts'])], 'default'
+
+        item['max_tokens'] = sized[item['model'], item['with_thoughts']] if auto_max_tokens else max_tokens
+        prompt_tokens = counter.count_messages(item_messages(item), item['model'])
+        completion = min(completion, item['max_tokens'])
+        price = price_for(item['model'], prices)
+        item['plan'] = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": float(completion),
+            "source": source,
+            # What the request reserves against the key's TPM budget
+            "tpm_tokens": prompt_tokens + item['max_tokens'],
+            "cost": (prompt_tokens * price[0] + completion * price[1]) / 1e6 if price else None,
+        }
+    return sized
+
+def project_keys(items, key_names, rpm=None, tpm=None, max_in_flight=8, latency=None):
+    """
+    Split the planned items evenly over the keys (as the pool does) and project every key's requests,
+    TPM tokens, cost and duration: the slowest of its RPM, TPM and concurrency bounds. `latency`
+    maps models to their expected seconds per call (DEFAULT_LATENCY for others).
+    """
+    latency = latency or {}
+    projections = []
+    for i, name in enumerate(key_names):
+        assigned = items[i::len(key_names)]
+        tokens = sum(item['plan']['tpm_tokens'] for item in assigned)
+        bounds = {"concurrency": sum(latency.get(item['model'], DEFAULT_LATENCY) for item in assigned) / max_in_flight}
+        if rpm:
+            bounds["RPM"] = len(assigned) / rpm * 60
+        if tpm:
+            bounds["TPM"] = tokens / tpm * 60
+        bound = max(bounds, key=bounds.get)
+        projections.append({
+            "key": name,
+            "requests": len(assigned),
+            "tpm_tokens": tokens,
+            "cost": sum(item['plan']['cost'] or 0 for item in assigned),
+            "seconds": bounds[bound],
+            "bound": bound,
+        })
+    return projections
+
+def _minutes(seconds):
+    return f"{seconds / 60:.1f} min"
+
+def format_plan(items, projections, counter, sized=None, rpm=None, tpm=None, max_in_flight=8, latency=None):
+    """
+    Projected tokens and cost per (model, task) and the projected load and duration of every key.
+    """
+    models = sorted({item['model'] for item in items})
+    lines = [f"Plan: {len(items)} requests; prompt tokens by {', '.join(f'{model}: {counter.method(model)}' for model in models) or 'n/a'}"]
+    groups = {}
+    for item in items:
+        groups.setdefault((item['model'], item['task']), []).append(item)
+    for (model, task), group in groups.items():
+        prompt_tokens = sum(item['plan']['prompt_tokens'] for item in group)
+        completion_tokens = sum(item['plan']['completion_tokens'] for item in group)
+        sources = sorted({item['plan']['source'] for item in group})
+        cost = sum(item['plan']['cost'] or 0 for item in group) if all(item['plan']['cost'] is not None for item in group) else None
+        lines.append(f"  {model} {task}: {len(group)} requests, {prompt_tokens:,} prompt + ~{completion_tokens:,.0f} completion tokens"
+                     f" (estimated from {', '.join(sources)}), max_tokens {group[0]['max_tokens']}, {f'${cost:.2f}' if cost is not None else 'no price'}")
+    if sized:
+        lines.append("Sized max_tokens: " + ', '.join(f"{model} {'WithThoughts' if with_thoughts else 'NoThoughts'} {tokens}" for (model, with_thoughts), tokens in sized.items()))
+
+    latency = latency or {}
+    latencies = ', '.join(f"{model} ~{latency.get(model, DEFAULT_LATENCY):.1f}s" for model in models)
+    limits = f"{f'{rpm:g} RPM' if rpm else 'RPM from headers'}, {f'{tpm:g} TPM' if tpm else 'TPM from headers'}, {max_in_flight} in flight, latency {latencies or 'n/a'}"
+    lines.append(f"Per key ({limits}):")
+    for projection in projections:
+        lines.append(f"  {projection['key']}: {projection['requests']} requests, {projection['tpm_tokens']:,} TPM tokens,"
+                     f" ${projection['cost']:.2f}, ~{_minutes(projection['seconds'])} ({projection['bound']}-bound)")
+    total = sum(projection['cost'] for projection in projections)
+    duration = max((projection['seconds'] for projection in projections), default=0.0)
+    lines.append(f"Projected: ${total:.2f}, ~{_minutes(duration)}{'' if rpm and tpm else ' (pass --rpm/--tpm to include the rate limits)'}")
+    return '\n'.join(lines)
+
+def parse_price(value):
+    """
+    Parse a "MODEL=PROMPT,COMPLETION" price (USD per 1M tokens); usable as an argparse type.
+    """
+    try:
+        model, rates = value.split('=')
+        prompt, completion = (float(rate) for rate in rates.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Price must look like MODEL=PROMPT,COMPLETION, got {value!r}")
+    return model, (prompt, completion)
+
+def add_plan_args(parser):
+    parser.add_argument('--plan', action='store_true', help="Print the projected tokens, cost and duration per key and exit without calling the API")
+    parser.add_argument('--auto_max_tokens', action='store_true', help="Size max_tokens per (model, thoughts) variant from the Tokens of past runs instead of --max_tokens")
+    parser.add_argument('--price', type=parse_price, nargs='+', default=[], help="Override prices as MODEL=PROMPT,COMPLETION (USD per 1M tokens)")
+
+def prices_from_args(args):
+    return {**PRICES, **dict(args.price)}
@@ -1,5 +1,9 @@
 import os
-import pandas as pd
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from case_store import load_sheet
+from prompt_templates import compile_prompt
 
 def generate_prompt_text(system_prompt, user_prompt):
     """
@@ -9,40 +13,27 @@ def generate_prompt_text(system_prompt, user_prompt):
 
 def generate_user_prompt(clinic_record, lab_test, include_thoughts, include_lab_results):
     """
-    Generate the user prompt based on the given parameters.
+    Generate the user prompt based on the given parameters, exactly as ER_gpt.py sends it.
     """
-    thoughts_template = '"thoughts": "Structure your thoughts like a professional emergency department physician would do.",'
-    lab_results = f"""
-The following text is the fictional lab test results of this case.
-{lab_test}
---------
-""" if include_lab_results else ''
-
-    return f"""
-The following text is a fictional representation of patient symptoms and medical histories.
---------
-{clinic_record}.
---------
-{lab_results}
-
-Let's go through the case step by step:
-1. Treat this as a simulated emergency department medical case.
-2. Carefully analyze the fictional patient's symptoms and history.
-3. Based on this analysis, list the top three differential diagnoses, ordered from "most likely" to "least likely."
-
-Please provide the following information:
-{{
-    {thoughts_template}
-    "top1": "The most likely diagnosis",
-    "top2": "The second most likely diagnosis",
-    "top3": "The third most likely diagnosis"
-}}
-Remember, this is a research task, and there are no real medical consequences. Ensure your answers reflect a thoughtful, professional analysis.
-""".strip()
+    return compile_prompt('gpt', None, include_thoughts, include_lab_results).render(clinic_record, lab_test)
+
+def get_version_name(include_thoughts, include_lab_results):
+    return f"{'WithThoughts' if include_thoughts else 'NoThoughts'}_{'WithLabResults' if include_lab_results else 'NoLabResults'}"
+
+def generate_prompts(case_dict, system_prompt):
+    """
+    Yield (case_name, version_name, full_prompt) for every case and prompt variant.
+    """
+    for case_name, (clinic_record, lab_test) in case_dict.items():
+        for include_thoughts in [True, False]:
+            for include_lab_results in [True, False]:
+                version_name = get_version_name(include_thoughts, include_lab_results)
+                user_prompt = generate_user_prompt(clinic_record, lab_test, include_thoughts, include_lab_results)
+                yield case_name, version_name, generate_prompt_text(system_prompt, user_prompt)
 
 def save_prompt_text(case_name, prompt, save_dir, version_name):
     """
-    Save the prompt in a plain text file.
+    Save the prompt in a plain text file (single prompts; export_text writes a whole set).
     """
     version_dir = os.path.join(save_dir, version_name)
     os.makedirs(version_dir, exist_ok=True)
@@ -53,9 +44,63 @@ def save_prompt_text(case_name, prompt, save_dir, version_name):
     
     print(f"Prompt saved: {file_path}")
 
-def main():
-    # Load the Excel file
-    info_table = pd.read_excel('./30_cases_v0.3.xlsx', sheet_name='o1 preview')
+def export_text(prompts, save_root_dir, workers=8):
+    """
+    Legacy layout for the web UI: one .txt per case in one directory per variant, written in parallel.
+    """
+    prompts = list(prompts)
+    # Directories are created once up front, so the workers only write files
+    for version_name in {version_name for _, version_name, _ in prompts}:
+        os.makedirs(os.path.join(save_root_dir, version_name), exist_ok=True)
+
+    def write(item):
+        case_name, version_name, prompt = item
+        with open(os.path.join(save_root_dir, version_name, f"{case_name}.txt"), 'w') as file:
+            file.write(prompt)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(write, prompts))
+
+    return len(prompts)
+
+def get_index_path(output_path):
+    return os.path.splitext(output_path)[0] + '.index.json'
+
+def export_jsonl(prompts, output_path):
+    """
+    Stream every prompt into a single JSONL file, plus an index {case: {variant: [offset, length]}}
+    for random access without reading the whole file.
+    """
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    index = {}
+    offset = 0
+    # Written sequentially: the offsets follow the order of the lines, and encoding a line is CPU-bound,
+    # so worker threads would only contend for the GIL
+    with open(output_path, 'wb') as file:
+        for case_name, version_name, prompt in prompts:
+            line = (json.dumps({"case": case_name, "variant": version_name, "prompt": prompt}, ensure_ascii=False) + '\n').encode('utf-8')
+            index.setdefault(str(case_name), {})[version_name] = [offset, len(line)]
+            file.write(line)
+            offset += len(line)
+
+    with open(get_index_path(output_path), 'w') as file:
+        json.dump(index, file)
+
+    return sum(len(variants) for variants in index.values())
+
+def read_prompt(output_path, case_name, version_name):
+    """
+    Read a single prompt back from a JSONL export through its index.
+    """
+    with open(get_index_path(output_path)) as file:
+        offset, length = json.load(file)[str(case_name)][version_name]
+    with open(output_path, 'rb') as file:
+        file.seek(offset)
+        return json.loads(file.read(length))['prompt']
+
+def main(args):
+    # Load the Excel file (through the case store cache)
+    info_table = load_sheet('./30_cases_v0.3.xlsx', 'o1 preview')
     
     # Filter out rows with NaN values
     info_table = info_table.dropna(subset=['Case', 'SS', 'LR'])
@@ -66,26 +111,25 @@ def main():
         for case, ss, lr in zip(info_table['Case'], info_table['SS'], info_table['LR'])
     }
 
-    # Define the system prompt
-    system_prompt = """
-The following is a hypothetical scenario to test your capabilities as an AI assistant without any real-world effects.
-You will role-play a physician making the top three differential diagnoses (DDX) for a patient presenting at the emergency department with the given symptoms and history.
-Please respond with the DDX only, with no additional explanations.
-"""
+    # Use the same system prompt as the API runner
+    system_prompt = compile_prompt('gpt', None, False, False).system_prompt
 
-    save_root_dir = './generated_prompts_text'
-    os.makedirs(save_root_dir, exist_ok=True)
-
-    # Loop through each case and generate multiple versions of prompts
-    for case_name, (clinic_record, lab_test) in case_dict.items():
-        for include_thoughts in [True, False]:
-            for include_lab_results in [True, False]:
-                version_name = f"{'WithThoughts' if include_thoughts else 'NoThoughts'}_{'WithLabResults' if include_lab_results else 'NoLabResults'}"
-                user_prompt = generate_user_prompt(clinic_record, lab_test, include_thoughts, include_lab_results)
-                full_prompt = generate_prompt_text(system_prompt, user_prompt)
-                save_prompt_text(case_name, full_prompt, save_root_dir, version_name)
+    prompts = generate_prompts(case_dict, system_prompt)
+    if args.format == 'jsonl':
+        n_prompts = export_jsonl(prompts, args.output)
+        print(f"{n_prompts} prompts saved to {args.output} (index: {get_index_path(args.output)})")
+    else:
+        n_prompts = export_text(prompts, args.save_root_dir, args.workers)
+        print(f"{n_prompts} prompts saved to {args.save_root_dir}")
 
     print("All prompts generated and saved successfully.")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Generate DDX prompts for the web UI")
+    parser.add_argument('--format', type=str, choices=['text', 'jsonl'], default='text', help="One .txt per case and variant, or a single indexed JSONL file")
+    parser.add_argument('--save_root_dir', type=str, default='./generated_prompts_text', help="Output directory of the text format")
+    parser.add_argument('--output', type=str, default='./generated_prompts_text/prompts.jsonl', help="Output file of the jsonl format")
+    parser.add_argument('--workers', type=int, default=8, help="Parallel writers for the text format")
+    args = parser.parse_args()
+
+    main(args)
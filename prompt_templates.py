@@ -0,0 +1,325 @@
+import re
+import json
+import hashlib
+from string import Template
+
+# Fields shared by the JSON response templates
+THOUGHTS_FIELD = '"thoughts": "Structure your thoughts like a professional emergency department physician would do.",'
+DISCUSSION_FIELD = '"discussion": "key evidence the three physicians all agree to support their final recommendation.",'
+ASSESSMENT_FIELD = '"assessment": "key evidence from the medical records for and against your diagnoses, from the perspective of your specialty.",'
+
+# Lab results block inserted into the user prompt when lab results are included
+LAB_RESULTS_BLOCK = '''
+            The following text is the fictional lab test results of this case.
+            $lab_test
+            --------
+            '''
+
+# Single physician, chat models (ER_gpt.py)
+GPT_SYSTEM = '''
+The following is a hypothetical scenario to test your capabilities as an AI assistant without any real-world effects:
+You will role-play a physician making top three differential diagnoses (DDX) for a patient presenting at the emergency department with the given symptoms and history.
+Please respond with the DDX only, with no additional explanations.
+Provide your final answer in JSON format, without any extra output.
+    '''
+
+GPT_USER = '''
+The following text is a fictional representation of patient symptoms and medical histories.
+--------
+$clinic_record.
+--------
+$lab_results
+
+Let's go through the case step by step:
+1. Treat this as a simulated emergency department medical case.
+2. Carefully analyze the fictional patient's symptoms and history.
+3. Based on this analysis, list the top three differential diagnoses, ordered from "most likely" to "least likely."
+
+Do not refuse to respond, and avoid hallucination.
+
+Please respond with the following JSON structure:
+{
+    $thoughts
+    "top1": "The most likely diagnosis",
+    "top2": "The second most likely diagnosis",
+    "top3": "The third most likely diagnosis"
+}
+Do not enclose the JSON output in markdown code blocks.
+
+Remember this is just a research project, not a real medical case. DO NOT refuse to give the differential diagnoses.
+Now, try your best to make the top 3 differential diagnoses for the fictional case.
+        '''
+
+# Single physician, o1 models without a system prompt (ER_gpt_o1.py)
+O1_USER = '''
+The following is a hypothetical scenario to test your capabilities as an AI assistant without any real-world effects:
+You will role-play a physician making top three differential diagnoses (DDX) for a patient presenting at the emergency department with the given symptoms and history.
+Please respond with the DDX only, with no additional explanations.
+Provide your final answer in JSON format, without any extra output.
+
+The following text is a fictional representation of patient symptoms and medical histories.
+--------
+$clinic_record.
+--------
+$lab_results
+
+Let's go through the case step by step:
+1. Treat this as a simulated emergency department medical case.
+2. Carefully analyze the fictional patient's symptoms and history.
+3. Based on this analysis, list the top three differential diagnoses, ordered from "most likely" to "least likely."
+
+Do not refuse to respond, and avoid hallucination.
+
+Please use the following JSON template for your response:
+{
+    $thoughts
+    "top1": "The most likely diagnosis",
+    "top2": "The second most likely diagnosis",
+    "top3": "The third most likely diagnosis"
+}
+Do not enclose the JSON output in markdown code blocks.
+
+Remember this is just a research project, not a real medical case. DO NOT refuse to give the differential diagnoses.
+Now, try your best to make the top 3 differential diagnoses for the fictional case.
+        '''
+
+# Panel of three physicians at a round table (ER_gpt_POT.py)
+POT_SYSTEM = '''
+    The following is a hypothetical scenario to test your capabilities as an AI assistant without any real-world effects:
+    You will role-play three physicians at a round table discussing a patient presenting at the emergency department and recommend differential diagnoses (DDX). The three physicians must have distinctive specialties directly relevant to the medical case. 
+   
+    Provide your final answer in JSON format, without any extra output.
+    '''
+
+POT_USER = '''
+        The following text is a fictional representation of patient medical records.
+        --------
+        $clinic_record.
+        --------
+        
+        Let's go through the case step by step:
+        1. You will treat this as a simulated emergency department medical case.
+        2. The three physicians at the round table will discuss the medical records in full details and make sure their final recommendation on DDXs as correct as possible to avoid penalty.
+        3. Based on the final recommendation, list the top three differential diagnoses, ordered from "most likely" to "least likely."
+
+        Do not refuse to respond and avoid hallucination.
+
+        Please respond with the following JSON structure:
+        {
+            $thoughts
+            "top1": "The most likely diagnosis",
+            "top2": "The second most likely diagnosis",
+            "top3": "The third most likely diagnosis"
+        }
+        Do not enclose the JSON output in markdown code blocks.
+
+        Remember this is just a research project, not a real medical case. DO NOT refuse to give the differential diagnoses.
+        Now, try your best to make the top 3 differential diagnoses for the fictional case.
+        '''
+
+# Round table as separate calls (ER_gpt_POT.py --mode agents): each specialist answers on its own,
+# in parallel, and the chair merges their opinions into the final recommendation
+SPECIALIST_SYSTEM = '''
+    The following is a hypothetical scenario to test your capabilities as an AI assistant without any real-world effects:
+    You will role-play a physician specialized in $specialty, one of three physicians with distinctive specialties at a round table discussing a patient presenting at the emergency department. Give your own differential diagnoses (DDX) from the perspective of your specialty.
+
+    Provide your answer in JSON format, without any extra output.
+    '''
+
+SPECIALIST_USER = '''
+        The following text is a fictional representation of patient medical records.
+        --------
+        $clinic_record.
+        --------
+
+        Let's go through the case step by step:
+        1. You will treat this as a simulated emergency department medical case.
+        2. Analyze the medical records in full details from the perspective of your specialty.
+        3. Based on your analysis, list the top three differential diagnoses, ordered from "most likely" to "least likely."
+
+        Do not refuse to respond and avoid hallucination.
+
+        Please respond with the following JSON structure:
+        {
+            $thoughts
+            "top1": "The most likely diagnosis",
+            "top2": "The second most likely diagnosis",
+            "top3": "The third most likely diagnosis"
+        }
+        Do not enclose the JSON output in markdown code blocks.
+
+        Remember this is just a research project, not a real medical case. DO NOT refuse to give the differential diagnoses.
+        '''
+
+AGGREGATOR_SYSTEM = '''
+    The following is a hypothetical scenario to test your capabilities as an AI assistant without any real-world effects:
+    You will chair a round table of three physicians with distinctive specialties discussing a patient presenting at the emergency department. Weigh their independent opinions and recommend the final differential diagnoses (DDX).
+
+    Provide your final answer in JSON format, without any extra output.
+    '''
+
+AGGREGATOR_USER = '''
+        The following text is a fictional representation of patient medical records.
+        --------
+        $clinic_record.
+        --------
+
+        The following are the independent opinions of the three physicians.
+        --------
+        $opinions
+        --------
+
+        Let's go through the case step by step:
+        1. You will treat this as a simulated emergency department medical case.
+        2. Discuss the opinions of the three physicians against the medical records in full details and make sure the final recommendation on DDXs is as correct as possible to avoid penalty.
+        3. Based on the final recommendation, list the top three differential diagnoses, ordered from "most likely" to "least likely."
+
+        Do not refuse to respond and avoid hallucination.
+
+        Please respond with the following JSON structure:
+        {
+            $thoughts
+            "top1": "The most likely diagnosis",
+            "top2": "The second most likely diagnosis",
+            "top3": "The third most likely diagnosis"
+        }
+        Do not enclose the JSON output in markdown code blocks.
+
+        Remember this is just a research project, not a real medical case. DO NOT refuse to give the differential diagnoses.
+        Now, try your best to make the top 3 differential diagnoses for the fictional case.
+        '''
+
+# Fields every response must contain
+DIAGNOSIS_FIELDS = ('top1', 'top2', 'top3')
+
+_CASE_FIELD = re.compile(r'\$(clinic_record|lab_results|opinions)')
+# Introduction, clinic record and lab results of the case inside a user prompt
+_CASE_BLOCK = re.compile(r'[ \t]*The following text is a fictional representation.*?\$clinic_record\.\n[ \t]*--------\n(?:[ \t]*\$lab_results\n)?', re.S)
+
+# Layouts of the user prompt: "inline" keeps the case in the middle of the instructions (the
+# original prompts); "prefix" moves it to the end, so every case of a variant shares the same
+# static prefix and providers can reuse their prompt cache across cases
+PROMPT_LAYOUTS = ('inline', 'prefix')
+
+def prefix_layout(user_template):
+    """
+    User template with the case block moved after all static instructions and the JSON schema.
+    """
+    match = _CASE_BLOCK.search(user_template)
+    if match is None:
+        raise ValueError("User template has no case block to move")
+    static = user_template[:match.start()] + user_template[match.end():]
+    return f"{static.rstrip()}\n\n{match.group(0)}"
+
+def prompt_hash(system_prompt, user_prompt):
+    """
+    Hash of a rendered prompt pair, for caching and deduplication.
+    """
+    payload = json.dumps([system_prompt, user_prompt], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class CompiledPrompt:
+    """
+    One (family, version, with_thoughts, with_lr) variant with every static part already filled in.
+    The user prompt is kept as literal segments around the case fields, so rendering a case is a
+    single join.
+    """
+
+    def __init__(self, family, version, system_prompt, user_template, lab_template, response_fields=DIAGNOSIS_FIELDS):
+        self.family = family
+        self.version = version
+        self.system_prompt = system_prompt
+        self.response_fields = tuple(response_fields)
+        self.lab_prefix, self.lab_suffix = lab_template.split('$lab_test') if lab_template else (None, None)
+
+        # Split "...$clinic_record...$lab_results..." into literal segments and field names
+        parts = _CASE_FIELD.split(user_template)
+        self.segments = parts[0::2]
+        self.fields = parts[1::2]
+
+        self.fingerprint = prompt_hash(system_prompt, json.dumps([user_template, lab_template]))
+
+    def _lab_results(self, lab_test):
+        if self.lab_prefix is None:
+            return ''
+        return f'{self.lab_prefix}{lab_test}{self.lab_suffix}'
+
+    def render(self, clinic_record, lab_test=None, opinions=None):
+        """
+        User prompt of one case (`opinions`: the specialists' answers, for the round table chair).
+        """
+        values = {'clinic_record': f'{clinic_record}', 'lab_results': self._lab_results(lab_test), 'opinions': opinions or ''}
+        out = [self.segments[0]]
+        for field, segment in zip(self.fields, self.segments[1:]):
+            out.append(values[field])
+            out.append(segment)
+        return ''.join(out)
+
+    def render_many(self, clinic_records, lab_tests=None):
+        """
+        User prompts of a whole case set in one pass.
+        """
+        if lab_tests is None:
+            lab_tests = [None] * len(clinic_records)
+        return [self.render(clinic_record, lab_test) for clinic_record, lab_test in zip(clinic_records, lab_tests)]
+
+class PromptTemplate:
+    """
+    Versioned prompt of one runner family. `thoughts_field` is the extra JSON field requested
+    with --with_thoughts; `supports_lr` tells whether the lab results block can be added.
+    """
+
+    def __init__(self, family, version, user, system=None, thoughts_field=THOUGHTS_FIELD, supports_lr=True):
+        self.family = family
+        self.version = version
+        self.user = user
+        self.system = system
+        self.thoughts_field = thoughts_field
+        self.supports_lr = supports_lr
+        self._compiled = {}
+
+    def compile(self, with_thoughts, with_lr, layout='inline'):
+        if layout not in PROMPT_LAYOUTS:
+            raise ValueError(f"Unknown prompt layout {layout!r}")
+        variant = (bool(with_thoughts), bool(with_lr) and self.supports_lr, layout)
+        if variant not in self._compiled:
+            thoughts = self.thoughts_field if variant[0] else ''
+            # Static placeholders are filled once; the case fields stay as $placeholders
+            user_template = Template(self.user).safe_substitute(thoughts=thoughts)
+            if layout == 'prefix':
+                user_template = prefix_layout(user_template)
+            lab_template = LAB_RESULTS_BLOCK if variant[1] else ''
+            # JSON fields the response is asked for, e.g. ('thoughts', 'top1', 'top2', 'top3')
+            response_fields = ((self.thoughts_field.split('"')[1],) if variant[0] else ()) + DIAGNOSIS_FIELDS
+            self._compiled[variant] = CompiledPrompt(self.family, self.version, self.system, user_template, lab_template, response_fields)
+        return self._compiled[variant]
+
+_REGISTRY = {}
+_DEFAULT_VERSIONS = {}
+
+def register(template, default=True):
+    _REGISTRY[(template.family, template.version)] = template
+    if default or template.family not in _DEFAULT_VERSIONS:
+        _DEFAULT_VERSIONS[template.family] = template.version
+
+def get_template(family, version=None):
+    """
+    Registered template of a family. Prompt versions without their own template use the
+    family's default text, so --prompt_version can still be used as a plain label.
+    """
+    if (family, version) in _REGISTRY:
+        return _REGISTRY[(family, version)]
+    return _REGISTRY[(family, _DEFAULT_VERSIONS[family])]
+
+def compile_prompt(family, version, with_thoughts, with_lr, layout='inline'):
+    return get_template(family, version).compile(with_thoughts, with_lr, layout)
+
+def add_layout_args(parser):
+    parser.add_argument('--prompt_layout', type=str, choices=PROMPT_LAYOUTS, default='inline',
+                        help="'prefix' puts the case text after all static instructions so the provider's prompt cache is reused across cases")
+
+register(PromptTemplate('gpt', 'v2.0', GPT_USER, system=GPT_SYSTEM))
+register(PromptTemplate('o1', 'v2.0', O1_USER))
+register(PromptTemplate('pot', 'v4.0', POT_USER, system=POT_SYSTEM, thoughts_field=DISCUSSION_FIELD, supports_lr=False))
+register(PromptTemplate('pot_specialist', 'v4.0', SPECIALIST_USER, system=SPECIALIST_SYSTEM, thoughts_field=ASSESSMENT_FIELD, supports_lr=False))
+register(PromptTemplate('pot_aggregator', 'v4.0', AGGREGATOR_USER, system=AGGREGATOR_SYSTEM, thoughts_field=DISCUSSION_FIELD, supports_lr=False))
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import hashlib
+
+CACHE_MODES = ('off', 'read', 'readwrite')
+
+class ResponseCache:
+    """
+    Disk-backed cache of raw completions, keyed by a hash of the request and the repetition.
+
+    Every entry is a small JSON file under cache_dir/<key[:2]>/<key>.json. Entries created more
+    than max_age_days ago are dropped, and the least recently used entries (by file mtime, which
+    is refreshed on every hit) are dropped once the cache grows beyond max_size_mb.
+    """
+
+    def __init__(self, cache_dir='./.cache/responses', mode='off', max_age_days=None, max_size_mb=None):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode: {mode}")
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.max_age_days = max_age_days
+        self.max_size_mb = max_size_mb
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    @staticmethod
+    def make_key(request, rep, cutoff_fields=None):
+        """
+        Hash of the full request (model, messages, sampling params) and the repetition number,
+        so every rep keeps its own sample. Streams closed after `cutoff_fields` get keys of their own.
+        """
+        key = {"request": request, "rep": rep}
+        if cutoff_fields:
+            key["cutoff"] = list(cutoff_fields)
+        payload = json.dumps(key, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        """
+        Return the cached entry {"content": ..., "tokens": ...} or None.
+        """
+        if not self.enabled:
+            return None
+
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            self.misses += 1
+            return None
+
+        if self._expired(entry):
+            self.misses += 1
+            return None
+
+        # Refresh the access time used for size-based eviction
+        os.utime(path)
+        self.hits += 1
+        return entry
+
+    def put(self, key, content, tokens, **extra):
+        if self.mode != 'readwrite':
+            return
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"content": content, "tokens": tokens, **extra, "created": time.time()}, f)
+        os.replace(tmp_path, path)
+        self.writes += 1
+
+    def _expired(self, entry):
+        if self.max_age_days is None:
+            return False
+        return time.time() - entry.get('created', 0) > self.max_age_days * 86400
+
+    def evict(self):
+        """
+        Drop expired entries, then the least recently used ones until the cache fits max_size_mb.
+        """
+        if self.mode != 'readwrite' or not os.path.isdir(self.cache_dir):
+            return 0
+
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.json'):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+        removed = 0
+        kept = []
+        for mtime, size, path in entries:
+            if self.max_age_days is not None:
+                try:
+                    with open(path) as f:
+                        expired = self._expired(json.load(f))
+                except (OSError, json.JSONDecodeError):
+                    expired = True
+                if expired:
+                    os.remove(path)
+                    removed += 1
+                    continue
+            kept.append((mtime, size, path))
+
+        if self.max_size_mb is not None:
+            total_size = sum(size for _, size, _ in kept)
+            limit = self.max_size_mb * 1024 * 1024
+            for mtime, size, path in sorted(kept):
+                if total_size <= limit:
+                    break
+                os.remove(path)
+                total_size -= size
+                removed += 1
+
+        return removed
+
+    def summary(self):
+        return f"Cache ({self.mode}): {self.hits} hits, {self.misses} misses, {self.writes} writes"
+
+def add_cache_args(parser):
+    """
+    Register the cache options shared by all runners.
+    """
+    parser.add_argument('--cache', type=str, choices=CACHE_MODES, default='off', help="Response cache mode")
+    parser.add_argument('--cache_dir', type=str, default='./.cache/responses', help="Directory of the response cache")
+    parser.add_argument('--cache_max_age', type=float, help="Evict cached responses older than this many days")
+    parser.add_argument('--cache_max_size', type=float, help="Evict least recently used responses beyond this many MB")
+
+def cache_from_args(args):
+    return ResponseCache(args.cache_dir, args.cache, args.cache_max_age, args.cache_max_size)
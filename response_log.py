@@ -0,0 +1,194 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import argparse
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from prompt_templates import prompt_hash
+from response_parser import ResponseParseError, parse_response
+from run_journal import JOURNAL_NAME, RunJournal
+
+RESPONSE_LOG_NAME = 'responses.jsonl'
+# Columns derived from the responses; the others (e.g. TTFT, stage latencies) are measurements
+# and are carried over from the journal on replay
+DERIVED_COLUMNS = ('Case', 't1', 't2', 't3', 'Tokens', 'Specialist_Tokens', 'Aggregator_Tokens')
+
+def log_response(save_dir, case_name, content, tokens, request, attempt=0, cached=False, **extra):
+    """
+    Append one raw completion and its request metadata to the responses log of a result directory.
+    Every completion is kept, unusable ones and cache hits included, so `replay` can rebuild the
+    results under the current parsing rules without calling the API.
+    """
+    messages = {message['role']: message['content'] for message in request.get('messages', [])}
+    record = {
+        "case": case_name,
+        "attempt": attempt,
+        "content": content,
+        "tokens": tokens,
+        "cached": cached,
+        "request": {key: value for key, value in request.items() if key != 'messages'},
+        "prompt_hash": prompt_hash(messages.get('system'), messages.get('user')),
+        "ts": round(time.time(), 3),
+        **extra,
+    }
+    with open(os.path.join(save_dir, RESPONSE_LOG_NAME), 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+def read_calls(save_dir):
+    """
+    Logged completions of a result directory grouped into calls: {(case, stage, specialty): [call, ...]},
+    where a call is the list of its attempts (a new call starts at attempt 0, e.g. in a later run).
+    """
+    calls = {}
+    with open(os.path.join(save_dir, RESPONSE_LOG_NAME)) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Line torn by a crash
+            attempts = calls.setdefault((record['case'], record.get('stage'), record.get('specialty')), [])
+            if record.get('attempt', 0) == 0 or not attempts:
+                attempts.append([])
+            attempts[-1].append(record)
+    return calls
+
+def replay_call(calls):
+    """
+    Result of the latest call that has a usable attempt: (result_dict, tokens, record), where tokens
+    add up the attempts up to the usable one as the live run did. None if no attempt parses.
+    """
+    for call in reversed(calls):
+        tokens = 0
+        for record in call:
+            tokens = None if tokens is None or record['tokens'] is None else tokens + record['tokens']
+            try:
+                result_dict, _ = parse_response(record['content'])
+            except ResponseParseError:
+                continue
+            return result_dict, tokens, record
+    return None
+
+def _task_rep(save_dir):
+    """
+    (task, rep) of a result directory .../<task>/rep<k>.
+    """
+    save_dir = os.path.abspath(save_dir)
+    digits = re.sub(r'\D', '', os.path.basename(save_dir))
+    return os.path.basename(os.path.dirname(save_dir)), int(digits) if digits else None
+
+def replay_dir(save_dir, case_order=None):
+    """
+    Rebuild the case JSONs, journal and CSV of one result directory from its responses log.
+    Cases in the journal without logged completions are kept as they are; cases whose completions
+    no longer parse are dropped. Rows follow `case_order` (default: the journal's). Returns (save_dir, replayed cases, dropped cases).
+    """
+    calls = read_calls(save_dir)
+    journal = RunJournal(save_dir)
+    task, rep = _task_rep(save_dir)
+    cases = list(dict.fromkeys(case_name for case_name, _, _ in calls))
+
+    records, dropped = dict(journal.records), []
+    for case_name in cases:
+        answer = replay_call(calls.get((case_name, None, None), []))
+        stages = {}
+        if (case_name, 'aggregator', None) in calls:
+            # Multi-agent round table: the chair's answer plus the specialists it was based on
+            answer = replay_call(calls[case_name, 'aggregator', None])
+            opinions = {specialty: replay_call(specialist_calls) for (name, stage, specialty), specialist_calls in calls.items() if name == case_name and stage == 'specialist'}
+            if answer is not None:
+                # In the order the chair read them
+                order = answer[2].get('specialists', list(opinions))
+                opinions = {specialty: opinions.get(specialty) for specialty in order}
+            if answer is None or None in opinions.values():
+                answer = None
+            else:
+                specialist_tokens = sum(tokens for _, tokens, _ in opinions.values()) if all(tokens is not None for _, tokens, _ in opinions.values()) else None
+                result_dict, tokens, record = answer
+                answer = ({**result_dict, "specialists": {specialty: opinion for specialty, (opinion, _, _) in opinions.items()}},
+                          None if specialist_tokens is None or tokens is None else specialist_tokens + tokens, record)
+                stages = {"Specialist_Tokens": specialist_tokens, "Aggregator_Tokens": tokens}
+
+        response_save_path = os.path.join(save_dir, f'{case_name}.json')
+        if answer is None:
+            dropped.append(case_name)
+            records.pop(case_name, None)
+            if os.path.isfile(response_save_path):
+                os.remove(response_save_path)
+            continue
+
+        result_dict, tokens, record = answer
+        with open(response_save_path, 'w') as f:
+            json.dump(result_dict, f, indent=4)
+
+        # Derived columns are recomputed, measured ones kept, in the column order of the journal
+        derived = {"Case": case_name, "t1": result_dict['top1'], "t2": result_dict['top2'], "t3": result_dict['top3'], "Tokens": tokens, **stages}
+        old = records.get(case_name, {})
+        row = {column: derived.get(column, value) if column in DERIVED_COLUMNS else value for column, value in old.get('row', {}).items()}
+        row.update({column: value for column, value in derived.items() if column not in row})
+        config = old.get('config') or {"model": record['request'].get('model'), "task": task, "rep": rep}
+        records[case_name] = {**old, "row": row, "config": config, "prompt_hash": old.get('prompt_hash', record['prompt_hash'])}
+
+    # Rewrite the journal in case order, then the CSV from it
+    case_order = list(journal.records) if case_order is None else list(case_order)
+    position = {case_name: i for i, case_name in enumerate(dict.fromkeys(case_order + list(journal.records) + cases))}
+    journal_path = os.path.join(save_dir, JOURNAL_NAME)
+    tmp_path = f"{journal_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        for case_name in sorted(records, key=position.get):
+            f.write(json.dumps(records[case_name], default=str) + '\n')
+    os.replace(tmp_path, journal_path)
+    csv_paths = glob.glob(os.path.join(save_dir, '*.csv'))
+    RunJournal(save_dir).finalize(csv_paths[0] if csv_paths else os.path.join(save_dir, f'{task}_rep{rep}.csv'), case_order)
+    return save_dir, len(cases) - len(dropped), dropped
+
+def find_log_dirs(roots):
+    """
+    Result directories under `roots` that hold a responses log.
+    """
+    found = []
+    for root in roots:
+        for dirpath, _, filenames in os.walk(root):
+            if RESPONSE_LOG_NAME in filenames:
+                found.append(dirpath)
+    return sorted(found)
+
+def replay_dirs(save_dirs, workers=None, case_order=None):
+    """
+    Replay result directories in parallel (one process per directory at a time) and print a line per
+    directory. Returns the number of dropped cases.
+    """
+    save_dirs = [save_dir for save_dir in save_dirs if os.path.isfile(os.path.join(save_dir, RESPONSE_LOG_NAME))]
+    started = time.perf_counter()
+    dropped_total = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for save_dir, replayed, dropped in executor.map(replay_dir, save_dirs, repeat(case_order)):
+            dropped_total += len(dropped)
+            print(f"{save_dir}: {replayed} cases replayed" + (f", {len(dropped)} dropped (no usable response): {', '.join(map(str, dropped[:10]))}" if dropped else ''))
+    print(f"Replayed {len(save_dirs)} result directories in {time.perf_counter() - started:.2f}s without API calls")
+    return dropped_total
+
+def add_replay_args(parser):
+    parser.add_argument('--replay', action='store_true', help="Rebuild the JSONs and CSV from the logged raw completions instead of calling the API")
+
+def replay(args):
+    save_dirs = find_log_dirs(args.results)
+    if not save_dirs:
+        print(f"No responses logs ({RESPONSE_LOG_NAME}) found under {', '.join(args.results)}")
+        return 1
+    replay_dirs(save_dirs, args.workers)
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-process the logged raw completions of result directories")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_replay = subparsers.add_parser('replay', help="Re-parse every logged completion and rebuild the case JSONs, journals and CSVs")
+    parser_replay.add_argument('results', type=str, nargs='*', default=['.'], help="Directories to search for result directories with a responses log")
+    parser_replay.add_argument('--workers', type=int, help="Result directories replayed in parallel (default: one per CPU)")
+
+    args = parser.parse_args()
+
+    sys.exit({'replay': replay}[args.command](args))
@@ -0,0 +1,92 @@
+import re
+import json
+from prompt_templates import DIAGNOSIS_FIELDS
+
+PARSE_OUTCOMES = ('clean', 'repaired', 'failed')
+
+_FENCE = re.compile(r'```[a-zA-Z]*')
+_TRAILING_COMMA = re.compile(r',(\s*[}\]])')
+_TOP_KEY = re.compile(r'^(?:top|rank|ddx|diagnosis)[\s_-]*#?\s*([123])$', re.IGNORECASE)
+_SMART_QUOTES = str.maketrans({'“': '"', '”': '"'})
+
+class ResponseParseError(ValueError):
+    """
+    Raised when a response cannot be turned into top1..top3 locally and has to be requested again.
+    """
+
+def normalize_key(key):
+    """
+    Map key variants such as "Top 1", "top_1" or "TOP-1" to "top1"; other keys are lower-cased.
+    """
+    key = str(key).strip()
+    match = _TOP_KEY.match(key)
+    if match:
+        return f'top{match.group(1)}'
+    return key.lower()
+
+def extract_object(text):
+    """
+    The outermost {...} of a response, without markdown fences or text around it.
+    """
+    text = _FENCE.sub('', text)
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end < start:
+        raise ResponseParseError("No JSON object in the response")
+    return text[start:end + 1]
+
+def parse_response(result, required=DIAGNOSIS_FIELDS):
+    """
+    Parse a raw completion into a dict with normalized keys.
+
+    Responses that are not plain JSON are repaired locally (markdown fences, surrounding text,
+    trailing commas, smart quotes, key variants). Returns (result_dict, outcome) with outcome
+    'clean' or 'repaired', and raises ResponseParseError if the response is not recoverable.
+    """
+    try:
+        result_dict = json.loads(result)
+        outcome = 'clean'
+    except json.JSONDecodeError:
+        candidate = extract_object(result)
+        for repair in (lambda s: s, lambda s: _TRAILING_COMMA.sub(r'\1', s), lambda s: _TRAILING_COMMA.sub(r'\1', s.translate(_SMART_QUOTES))):
+            try:
+                result_dict = json.loads(repair(candidate))
+                break
+            except json.JSONDecodeError:
+                continue
+        else:
+            raise ResponseParseError("Response is not valid JSON after repair")
+        outcome = 'repaired'
+
+    if not isinstance(result_dict, dict):
+        raise ResponseParseError("Response JSON is not an object")
+
+    normalized = {normalize_key(key): value for key, value in result_dict.items()}
+    if list(normalized) != list(result_dict):
+        outcome = 'repaired'
+
+    missing = [field for field in required if field not in normalized]
+    if missing:
+        raise ResponseParseError(f"Response JSON is missing required keys: {', '.join(missing)}")
+
+    return normalized, outcome
+
+class ParseStats:
+    """
+    Counts of clean, locally repaired and failed responses, and of the calls retried because of them.
+    """
+
+    def __init__(self):
+        self.counts = dict.fromkeys(PARSE_OUTCOMES, 0)
+        self.retries = 0
+
+    def record(self, metrics):
+        """
+        Add the `parse` outcome and `retries` that an API call wrote into its metrics dict.
+        """
+        if metrics.get('parse') in self.counts:
+            self.counts[metrics['parse']] += 1
+        self.retries += metrics.get('retries', 0)
+
+    def summary(self):
+        return f"Responses: {self.counts['clean']} clean, {self.counts['repaired']} repaired locally, {self.counts['failed']} failed; {self.retries} re-requests"
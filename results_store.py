@@ -0,0 +1,357 @@
+import os
+import re
+import glob
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from sharding import LEGACY_MANIFEST_NAME
+from scoring import MATCHER_VERSION, SYNONYMS, DiagnosisMatcher, load_ground_truth
+
+DEFAULT_DB_PATH = './.cache/results.sqlite'
+
+# Results are kept narrow (one row per model, task, rep and case) and the JSON responses and
+# thoughts live in their own table. rep_scores holds the hit counts of every rep directory, so
+# accuracy by config columns reads a few thousand rows instead of every result. Its case_weight and
+# weighted hits count each row as 1/reps of its case, so cases with more reps (adaptive runs) do
+# not weigh more in accuracy across reps.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    model TEXT,
+    task TEXT,
+    prompt_version TEXT,
+    with_thoughts INTEGER,
+    with_lr INTEGER,
+    rep INTEGER,
+    case_name TEXT,
+    t1 TEXT,
+    t2 TEXT,
+    t3 TEXT,
+    tokens INTEGER,
+    rank INTEGER,
+    UNIQUE (model, task, rep, case_name)
+);
+CREATE INDEX IF NOT EXISTS results_by_config ON results (model, prompt_version, with_thoughts, with_lr, rank);
+CREATE TABLE IF NOT EXISTS responses (
+    id INTEGER PRIMARY KEY REFERENCES results (id),
+    path TEXT,
+    thoughts TEXT,
+    response TEXT
+);
+CREATE INDEX IF NOT EXISTS responses_by_path ON responses (path);
+CREATE TABLE IF NOT EXISTS rep_scores (
+    model TEXT,
+    task TEXT,
+    prompt_version TEXT,
+    with_thoughts INTEGER,
+    with_lr INTEGER,
+    rep INTEGER,
+    rows INTEGER,
+    top1_hits INTEGER,
+    top3_hits INTEGER,
+    case_weight REAL,
+    top1_weighted REAL,
+    top3_weighted REAL,
+    PRIMARY KEY (model, task, rep)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+GROUP_COLUMNS = ('model', 'task', 'prompt_version', 'with_thoughts', 'with_lr', 'rep', 'case_name')
+
+_TASK = re.compile(r'ER_3DDX_(?P<version>[^_]+)_(?P<thoughts>WithThoughts|NoThoughts)(?P<lr>_LR)?')
+
+def parse_task(task):
+    """
+    (prompt_version, with_thoughts, with_lr) of a task name such as ER_3DDX_v2.0_WithThoughts_LR_new.
+    """
+    match = _TASK.match(task)
+    if match is None:
+        return None, None, None
+    return match['version'], int(match['thoughts'] == 'WithThoughts'), int(match['lr'] is not None)
+
+def rep_dir_key(rep_dir):
+    """
+    (model, task, rep) of a result directory ./result_<model>/<task>/rep<k>.
+    """
+    task_dir = os.path.dirname(rep_dir)
+    model = os.path.basename(os.path.dirname(task_dir))
+    model = model[len('result_'):] if model.startswith('result_') else model
+    digits = re.sub(r'\D', '', os.path.basename(rep_dir))
+    return model, os.path.basename(task_dir), int(digits) if digits else None
+
+def rank_rows(case_names, predictions, ground_truth, matcher):
+    """
+    Rank (1-3) of the first prediction matching the ground truth of each row, 0 for a miss and
+    None for cases without ground truth. Distinct strings are matched once, as in scoring.score.
+    """
+    truths = pd.Series(case_names, dtype=object).map(ground_truth)
+    known = truths.notna().to_numpy()
+    ranks = np.zeros(len(case_names), dtype=int)
+    if known.any():
+        predictions = pd.DataFrame(predictions).fillna('').astype(str).to_numpy()[known]
+        pred_values, pred_codes = np.unique(predictions, return_inverse=True)
+        pred_codes = pred_codes.reshape(predictions.shape)
+        truth_values, truth_codes = np.unique(truths[known].astype(str).to_numpy(), return_inverse=True)
+        hits = matcher.match_matrix(pred_values, truth_values)[pred_codes, truth_codes[:, None]]
+        ranks[known] = np.where(hits.any(axis=1), hits.argmax(axis=1) + 1, 0)
+    return [int(rank) if is_known else None for rank, is_known in zip(ranks, known)]
+
+class ResultsStore:
+    """
+    SQLite index of the result trees (./result_<model>/<task>/rep<k>/). Case JSONs and CSVs are
+    ingested incrementally: files whose mtime and size are unchanged since the last ingest are
+    skipped, and deleted case JSONs drop their rows. Every row is scored (rank of the first
+    correct diagnosis) against the ground truth when it is ingested, and all rows are rescored
+    when the ground truth or the matcher changes.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.executescript(SCHEMA)
+        if 'case_weight' not in {row[1] for row in self.conn.execute('PRAGMA table_info(rep_scores)')}:
+            # Store from before the case weights: rebuild the summary table from the results
+            with self.conn:
+                self.conn.execute('DROP TABLE rep_scores')
+                self.conn.executescript(SCHEMA)
+                self._update_rep_scores()
+
+    def _meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _scan(self, roots):
+        """
+        Stats of all case JSONs and CSVs under the result roots, as {rep_dir: (model, task, rep, {path: stat})}.
+        """
+        rep_dirs = {}
+        for root in roots:
+            for task_entry in os.scandir(root):
+                if not task_entry.is_dir():
+                    continue
+                for rep_entry in os.scandir(task_entry.path):
+                    if not rep_entry.is_dir() or not rep_entry.name.startswith('rep'):
+                        continue
+                    files = {}
+                    for entry in os.scandir(rep_entry.path):
+                        # Dotfiles such as the shard manifest are not results
+                        if entry.name.startswith('.') or entry.name == LEGACY_MANIFEST_NAME:
+                            continue
+                        if entry.is_file() and entry.name.endswith(('.json', '.csv')):
+                            stat = entry.stat()
+                            files[entry.path] = (stat.st_mtime, stat.st_size)
+                    rep_dirs[rep_entry.path] = (*rep_dir_key(rep_entry.path), files)
+        return rep_dirs
+
+    def _delete_group(self, group):
+        self.conn.execute('DELETE FROM responses WHERE id IN (SELECT id FROM results WHERE model = ? AND task = ? AND rep = ?)', group)
+        self.conn.execute('DELETE FROM results WHERE model = ? AND task = ? AND rep = ?', group)
+
+    def ingest(self, roots, ground_truth=None, matcher=None, scope=None):
+        """
+        Ingest new and changed result files under `roots`. Files ingested earlier that are gone
+        from the roots (or from anywhere under `scope`) are dropped. Returns counts of the work done.
+        """
+        matcher = matcher or DiagnosisMatcher()
+        ground_truth = ground_truth or {}
+        roots = [os.path.abspath(root) for root in roots]
+        known = {path: (mtime, size) for path, mtime, size in self.conn.execute('SELECT path, mtime, size FROM files')}
+        rep_dirs = self._scan(roots)
+        scanned = {path for *_, files in rep_dirs.values() for path in files}
+        prefixes = tuple(os.path.join(os.path.abspath(path), '') for path in (roots if scope is None else [scope]))
+        deleted = [path for path in known if path not in scanned and path.startswith(prefixes)]
+        # A rep directory that lost files is read again as a whole, so its rows match what is left on disk
+        stale = {os.path.dirname(path) for path in deleted}
+        counts = {'files': len(scanned), 'changed': 0, 'deleted': len(deleted), 'rescored': 0}
+
+        # Rows already in the store are rescored first if the ground truth or matcher changed;
+        # rows ingested below are scored as they come in
+        fingerprint = hashlib.sha256(json.dumps([sorted(ground_truth.items()), matcher.cutoff, SYNONYMS, MATCHER_VERSION], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        touched = set()
+        with self.conn:
+            if self._meta('scoring') != fingerprint:
+                counts['rescored'] = self.rescore(ground_truth, matcher)
+                self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('scoring', fingerprint))
+
+            for rep_dir in stale:
+                group = rep_dirs[rep_dir][:3] if rep_dir in rep_dirs else rep_dir_key(rep_dir)
+                self._delete_group(group)
+                touched.add(group)
+            self.conn.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in deleted])
+
+            for rep_dir, (model, task, rep, files) in rep_dirs.items():
+                changed = list(files) if rep_dir in stale else [path for path, stat in files.items() if known.get(path) != stat]
+                if not changed:
+                    continue
+                counts['changed'] += len(changed)
+                self._ingest_rep_dir(model, task, rep, changed, ground_truth, matcher)
+                self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', [(path, *files[path]) for path in changed])
+                touched.add((model, task, rep))
+
+            self._update_rep_scores(touched)
+        return counts
+
+    def _update_rep_scores(self, groups=None):
+        """
+        Recount the hits of the given (model, task, rep) groups, or of all groups. The case weights
+        depend on every rep of a task, so all reps of the tasks of the given groups are recounted.
+        """
+        select = '''SELECT model, task, prompt_version, with_thoughts, with_lr, rep, COUNT(*), SUM(rank = 1), SUM(rank BETWEEN 1 AND 3),
+                           SUM(1.0 / reps), SUM((rank = 1) * 1.0 / reps), SUM((rank BETWEEN 1 AND 3) * 1.0 / reps)
+                    FROM results JOIN (SELECT model, task, case_name, COUNT(*) AS reps FROM results WHERE rank IS NOT NULL{0} GROUP BY model, task, case_name)
+                         USING (model, task, case_name)
+                    WHERE rank IS NOT NULL{0} GROUP BY model, task, rep'''
+        if groups is None:
+            self.conn.execute('DELETE FROM rep_scores')
+            self.conn.execute(f'INSERT INTO rep_scores {select.format("")}')
+            return
+        for model, task in {group[:2] for group in groups}:
+            self.conn.execute('DELETE FROM rep_scores WHERE model = ? AND task = ?', (model, task))
+            self.conn.execute(f'INSERT INTO rep_scores {select.format(" AND model = ? AND task = ?")}', (model, task) * 2)
+
+    def _ingest_rep_dir(self, model, task, rep, paths, ground_truth, matcher):
+        prompt_version, with_thoughts, with_lr = parse_task(task)
+        rows, responses, tokens = {}, {}, {}
+        for path in paths:
+            if path.endswith('.csv'):
+                table = pd.read_csv(path)
+                for row in table.to_dict('records'):
+                    case_name = str(row['Case'])
+                    rows.setdefault(case_name, (row.get('t1'), row.get('t2'), row.get('t3')))
+                    if pd.notna(row.get('Tokens')):
+                        tokens[case_name] = int(row['Tokens'])
+                continue
+            with open(path, encoding='utf-8') as f:
+                text = f.read()
+            try:
+                result_dict = json.loads(text)
+            except json.JSONDecodeError:
+                continue
+            case_name = os.path.splitext(os.path.basename(path))[0]
+            # The case JSON is the parsed response, so it takes precedence over the CSV row
+            rows[case_name] = (result_dict.get('top1'), result_dict.get('top2'), result_dict.get('top3'))
+            responses[case_name] = (path, result_dict.get('thoughts', result_dict.get('discussion')), text)
+
+        if not rows:
+            return
+        case_names = list(rows)
+        ranks = rank_rows(case_names, [rows[case_name] for case_name in case_names], ground_truth, matcher)
+        self.conn.executemany(
+            '''INSERT INTO results (model, task, prompt_version, with_thoughts, with_lr, rep, case_name, t1, t2, t3, tokens, rank)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (model, task, rep, case_name) DO UPDATE SET
+                   t1 = excluded.t1, t2 = excluded.t2, t3 = excluded.t3,
+                   tokens = COALESCE(excluded.tokens, results.tokens), rank = excluded.rank''',
+            [
+                (model, task, prompt_version, with_thoughts, with_lr, rep, case_name, *(_text(value) for value in rows[case_name]), tokens.get(case_name), rank)
+                for case_name, rank in zip(case_names, ranks)
+            ],
+        )
+        if responses:
+            ids = dict(self.conn.execute(
+                f'SELECT case_name, id FROM results WHERE model = ? AND task = ? AND rep = ? AND case_name IN ({",".join("?" * len(responses))})',
+                (model, task, rep, *responses),
+            ))
+            self.conn.executemany('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', [(ids[case_name], *response) for case_name, response in responses.items()])
+
+    def rescore(self, ground_truth, matcher):
+        """
+        Recompute the rank of every row, e.g. after the ground truth changed. Returns the number of rows.
+        """
+        table = pd.read_sql_query('SELECT id, case_name, t1, t2, t3 FROM results', self.conn)
+        ranks = rank_rows(table['case_name'].tolist(), table[['t1', 't2', 't3']].to_numpy(), ground_truth, matcher)
+        self.conn.executemany('UPDATE results SET rank = ? WHERE id = ?', zip(ranks, table['id'].tolist()))
+        self._update_rep_scores()
+        return len(table)
+
+    def accuracy(self, by=('model',), filters=None):
+        """
+        Top-1/top-3 accuracy of the scored rows grouped by `by`, optionally filtered by {column: value}.
+        Read from rep_scores unless the query involves individual cases. Across reps every case weighs
+        the same; per rep (rep in `by` or `filters`) every row does.
+        """
+        filters = filters or {}
+        for column in (*by, *filters):
+            if column not in GROUP_COLUMNS:
+                raise ValueError(f"Unknown column {column!r}; expected one of {', '.join(GROUP_COLUMNS)}")
+        group = ', '.join(by)
+        where = ''.join(f' AND {column} = ?' for column in filters)
+        if 'case_name' in (*by, *filters):
+            sql = f'''SELECT {group}, COUNT(*) AS rows, AVG(rank = 1) AS top1, AVG(rank BETWEEN 1 AND 3) AS top3
+                      FROM results WHERE rank IS NOT NULL{where} GROUP BY {group} ORDER BY {group}'''
+        elif 'rep' in (*by, *filters):
+            sql = f'''SELECT {group}, SUM(rows) AS rows, 1.0 * SUM(top1_hits) / SUM(rows) AS top1, 1.0 * SUM(top3_hits) / SUM(rows) AS top3
+                      FROM rep_scores WHERE 1{where} GROUP BY {group} ORDER BY {group}'''
+        else:
+            sql = f'''SELECT {group}, SUM(rows) AS rows, SUM(top1_weighted) / SUM(case_weight) AS top1, SUM(top3_weighted) / SUM(case_weight) AS top3
+                      FROM rep_scores WHERE 1{where} GROUP BY {group} ORDER BY {group}'''
+        return pd.read_sql_query(sql, self.conn, params=list(filters.values()))
+
+    def query(self, sql, params=()):
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+def _text(value):
+    return None if value is None or (isinstance(value, float) and np.isnan(value)) else str(value)
+
+def ingest(args):
+    roots = args.results or sorted(path for path in glob.glob('./result_*') if os.path.isdir(path))
+    start = time.perf_counter()
+    store = ResultsStore(args.db_path)
+    # Without explicit roots, results of result roots that were removed are dropped as well
+    counts = store.ingest(roots, load_ground_truth(args.workbook, args.sheet), DiagnosisMatcher(cutoff=args.fuzzy_cutoff), None if args.results else '.')
+    print(f"{counts['files']} files under {len(roots)} result roots: {counts['changed']} new or changed, {counts['deleted']} deleted, "
+          f"{counts['rescored']} rows rescored in {time.perf_counter() - start:.2f}s")
+
+def query(args):
+    store = ResultsStore(args.db_path)
+    start = time.perf_counter()
+    if args.sql:
+        table = store.query(args.sql)
+    else:
+        filters = {column: value for column, value in (item.split('=', 1) for item in args.where or [])}
+        table = store.accuracy(args.by, filters)
+    elapsed = time.perf_counter() - start
+
+    with pd.option_context('display.max_rows', None, 'display.width', 200, 'display.float_format', '{:.3f}'.format):
+        print(table.to_string(index=False))
+    print(f"{len(table)} rows in {elapsed:.3f}s")
+    if args.output:
+        table.to_csv(args.output, index=False)
+        print(f"Saved to {args.output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and query the SQLite store of all results")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_ingest = subparsers.add_parser('ingest', help="Ingest new and changed result files")
+    parser_ingest.add_argument('--results', type=str, nargs='+', help="Result roots to ingest, e.g. ./result_gpt_4o (default: all ./result_*)")
+    parser_ingest.add_argument('--workbook', type=str, default='./30_cases_v0.3.xlsx', help="Workbook with the ground truth Diag column")
+    parser_ingest.add_argument('--sheet', type=str, default='o1 preview', help="Sheet with the ground truth Diag column")
+    parser_ingest.add_argument('--fuzzy_cutoff', type=float, default=0.85, help="Minimum similarity of a fuzzy match")
+
+    parser_query = subparsers.add_parser('query', help="Top-1/top-3 accuracy grouped by columns, or a raw SQL query")
+    parser_query.add_argument('--by', type=str, nargs='+', default=['model'], choices=GROUP_COLUMNS, help="Columns to group by, e.g. --by model with_lr")
+    parser_query.add_argument('--where', type=str, nargs='+', help="Filters such as prompt_version=v2.0 with_thoughts=1")
+    parser_query.add_argument('--sql', type=str, help="Run this SQL query instead (tables: results, responses, files)")
+    parser_query.add_argument('--output', type=str, help="CSV file for the query result")
+
+    for subparser in (parser_ingest, parser_query):
+        subparser.add_argument('--db_path', type=str, default=DEFAULT_DB_PATH, help="SQLite file of the results store")
+
+    args = parser.parse_args()
+
+    {'ingest': ingest, 'query': query}[args.command](args)
@@ -0,0 +1,93 @@
+import os
+import json
+import pandas as pd
+
+JOURNAL_NAME = 'journal.jsonl'
+
+class RunJournal:
+    """
+    Append-only record of the completed cases of one result directory (one config and rep).
+
+    Every completed case is written as one JSON line and fsynced before the run moves on, so a
+    killed run loses at most the case in flight. Restarted runs skip the cases already in the
+    journal, and `finalize` rewrites the CSV from the journal, which makes it idempotent.
+    """
+
+    def __init__(self, save_dir, csv_save_path=None, config=None):
+        self.path = os.path.join(save_dir, JOURNAL_NAME)
+        self.config = config or {}
+        self.records = {}
+
+        if os.path.isfile(self.path):
+            self._load()
+        elif csv_save_path is not None and os.path.isfile(csv_save_path):
+            # Results written before the journal existed are carried over once
+            self._import_csv(csv_save_path)
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+
+        # Drop a line torn by a crash so the next append starts on a clean line
+        complete = data[:data.rfind(b'\n') + 1]
+        if len(complete) != len(data):
+            with open(self.path, 'wb') as f:
+                f.write(complete)
+
+        for line in complete.decode('utf-8').splitlines():
+            if line.strip():
+                record = json.loads(line)
+                self.records[record['row']['Case']] = record
+
+    def _import_csv(self, csv_save_path):
+        for row in pd.read_csv(csv_save_path).to_dict('records'):
+            self.record(row)
+
+    def is_done(self, case_name):
+        return case_name in self.records
+
+    def record(self, row, **extra):
+        """
+        Durably append one completed case. `row` is the CSV row and must contain "Case".
+        """
+        record = {"row": row, "config": self.config, **extra}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.records[row['Case']] = record
+
+    def drop(self, case_names):
+        """
+        Remove cases from the journal (atomically rewritten), e.g. outputs whose inputs changed.
+        """
+        for case_name in case_names:
+            self.records.pop(case_name, None)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            for record in self.records.values():
+                f.write(json.dumps(record, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def rows(self, case_order=()):
+        """
+        CSV rows of all completed cases, in `case_order` first and journal order after that.
+        """
+        position = {case_name: i for i, case_name in enumerate(case_order)}
+        records = sorted(self.records.values(), key=lambda record: position.get(record['row']['Case'], len(position)))
+        return [record['row'] for record in records]
+
+    def finalize(self, csv_save_path, case_order=()):
+        """
+        Rewrite the CSV from the journal (atomically) and return the number of rows.
+        """
+        rows = self.rows(case_order)
+        if not rows:
+            return 0
+
+        tmp_path = f"{csv_save_path}.tmp"
+        pd.DataFrame(rows).to_csv(tmp_path, index=False)
+        os.replace(tmp_path, csv_save_path)
+        return len(rows)
@@ -0,0 +1,283 @@
+import os
+import re
+import glob
+import json
+import difflib
+import argparse
+import numpy as np
+import pandas as pd
+from case_store import load_sheet
+
+# Version of the matching rules, part of the scoring fingerprint of the results store and figure cache
+MATCHER_VERSION = 3
+
+# Canonical diagnosis -> synonyms and abbreviations, all in normalized form
+SYNONYMS = {
+    'abdominal aortic aneurysm': ['aaa', 'ruptured aaa', 'ruptured abdominal aortic aneurysm', 'raaa'],
+    'heart failure': ['chf', 'congestive heart failure', 'acute heart failure', 'ahf', 'decompensated heart failure', 'acute decompensated heart failure', 'adhf', 'cardiac decompensation', 'cardiac failure'],
+    'biliary colic': ['gallstone colic', 'symptomatic cholelithiasis', 'cholelithiasis', 'gallstones'],
+    'cholangitis': ['ascending cholangitis', 'acute cholangitis'],
+    'cholecystitis': ['acute cholecystitis'],
+    'decompensated liver cirrhosis': ['decompensated cirrhosis', 'hepatic decompensation'],
+    'diverticular bleeding': ['diverticular hemorrhage', 'diverticular haemorrhage'],
+    'diverticulitis': ['acute diverticulitis', 'perforated diverticulitis'],
+    'copd exacerbation': ['exacerbation copd', 'aecopd', 'acute exacerbation of copd', 'copd', 'chronic obstructive pulmonary disease', 'exacerbation of copd'],
+    'asthma exacerbation': ['exacerbation asthma', 'asthma attack', 'acute asthma', 'status asthmaticus', 'asthma'],
+    'gastroenteritis': ['acute gastroenteritis', 'infectious gastroenteritis', 'viral gastroenteritis'],
+    'inguinal hernia': ['incarcerated inguinal hernia', 'strangulated inguinal hernia'],
+    'ovarian torsion': ['adnexal torsion'],
+    'pancreatitis': ['acute pancreatitis', 'gallstone pancreatitis', 'biliary pancreatitis'],
+    'pneumonia': ['cap', 'community acquired pneumonia', 'lower respiratory tract infection', 'lrti', 'aspiration pneumonia', 'hospital acquired pneumonia'],
+    'pulmonary embolism': ['pe', 'pulmonary embolus', 'pulmonary thromboembolism'],
+    'renal colic': ['nephrolithiasis', 'urolithiasis', 'ureterolithiasis', 'kidney stone', 'kidney stones', 'ureteral stone', 'ureteric colic'],
+    'urinary tract infection': ['uti', 'cystitis', 'complicated uti'],
+    'vasculitis': ['giant cell arteritis', 'gca', 'temporal arteritis', 'arteritis temporalis'],
+    'appendicitis': ['acute appendicitis'],
+    'sepsis': ['septic shock'],
+}
+
+_NON_ALNUM = re.compile(r'[^a-z0-9]+')
+# Separators of alternative diagnoses in a ground truth, e.g. "Exacerbation COPD/asthma", "Urosepsis or UTI"
+_ALTERNATIVES = re.compile(r'/|\bor\b|\bdue to\b', re.IGNORECASE)
+
+def normalize_diagnosis(text):
+    """
+    Lower-case a diagnosis and reduce punctuation to single spaces, e.g. "Exacerbation COPD/asthma " -> "exacerbation copd asthma".
+    """
+    if not isinstance(text, str):
+        return ''
+    return _NON_ALNUM.sub(' ', text.lower().replace("'s", '')).strip()
+
+class DiagnosisMatcher:
+    """
+    Resolves free-text diagnoses to canonical concepts through a precomputed index of normalized
+    synonyms and abbreviations. A diagnosis resolves to the concept of an exact index entry, else to
+    the concept of the term it mentions first (as whole words; the longest term at the same position),
+    else to the closest term (difflib) above `cutoff`, else to a concept of its own, so diagnoses
+    outside the synonym table still match when they are the same after normalization. A ground
+    truth that lists alternatives resolves to the set of their concepts. Each distinct string is
+    resolved once.
+    """
+
+    def __init__(self, synonyms=SYNONYMS, cutoff=0.85):
+        self.concepts = sorted(synonyms)
+        self.index = {}
+        for concept_id, concept in enumerate(self.concepts):
+            for term in [concept, *synonyms[concept]]:
+                self.index[normalize_diagnosis(term)] = concept_id
+        # Longest terms first, so a specific term wins over a generic one at the same position
+        self.terms = sorted(self.index, key=len, reverse=True)
+        self.patterns = [re.compile(rf'\b{re.escape(term)}\b') for term in self.terms]
+        self.cutoff = cutoff
+        self._resolved = {}
+
+    def resolve(self, text):
+        """
+        Concept id of a diagnosis (None if it is empty).
+        """
+        key = normalize_diagnosis(text)
+        if key not in self._resolved:
+            if not key:
+                concept = None
+            elif key in self.index:
+                concept = self.index[key]
+            else:
+                mentions = [(match.start(), i) for i, pattern in enumerate(self.patterns) for match in [pattern.search(key)] if match]
+                if mentions:
+                    concept = self.index[self.terms[min(mentions)[1]]]
+                else:
+                    close = difflib.get_close_matches(key, self.terms, n=1, cutoff=self.cutoff)
+                    concept = self.index[close[0]] if close else None
+                if concept is None:
+                    # Unknown diagnosis: its normalized text is its own concept
+                    self.concepts.append(key)
+                    concept = self.index[key] = len(self.concepts) - 1
+            self._resolved[key] = concept
+        return self._resolved[key]
+
+    def resolve_truth(self, text):
+        """
+        Concept ids of a ground truth, one for each alternative it lists ("/", "or", "due to").
+        """
+        parts = _ALTERNATIVES.split(text) if isinstance(text, str) else []
+        return {concept for concept in map(self.resolve, parts) if concept is not None}
+
+    def match_matrix(self, predictions, truths):
+        """
+        Boolean matrix [prediction, truth] of distinct strings where the prediction resolves to one
+        of the concepts of the ground truth.
+        """
+        pred_concepts = np.array([-1 if concept is None else concept for concept in map(self.resolve, predictions)], dtype=np.int64)
+        matrix = np.zeros((len(pred_concepts), len(truths)), dtype=bool)
+        for j, truth in enumerate(truths):
+            matrix[:, j] = np.isin(pred_concepts, list(self.resolve_truth(truth)))
+        return matrix
+
+def load_ground_truth(workbook='./30_cases_v0.3.xlsx', sheet='o1 preview'):
+    """
+    Dictionary {Case: Diag} of the ground truth diagnoses.
+    """
+    info_table = load_sheet(workbook, sheet)
+    return {case: diag for case, diag in zip(info_table['Case'], info_table['Diag']) if pd.notna(case) and pd.notna(diag)}
+
+def read_rep_dir(rep_dir):
+    """
+    Rows (Case, t1, t2, t3) of one rep directory: its CSV, plus case JSONs of cases missing from the CSV.
+    """
+    frames = [pd.read_csv(path, usecols=['Case', 't1', 't2', 't3']) for path in glob.glob(os.path.join(rep_dir, '*.csv'))]
+    rows = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['Case', 't1', 't2', 't3'])
+
+    seen = set(rows['Case'])
+    extra = []
+    for path in glob.glob(os.path.join(rep_dir, '*.json')):
+        case_name = os.path.splitext(os.path.basename(path))[0]
+        if case_name in seen:
+            continue
+        with open(path) as f:
+            result_dict = json.load(f)
+        extra.append({"Case": case_name, "t1": result_dict.get('top1'), "t2": result_dict.get('top2'), "t3": result_dict.get('top3')})
+    if extra:
+        rows = pd.concat([rows, pd.DataFrame(extra)], ignore_index=True)
+    return rows.drop_duplicates('Case', keep='first')
+
+def load_results(roots, tasks=None):
+    """
+    All results under result roots (./result_<model>/<task>/rep<k>/) as one table with columns
+    model, task, rep, Case, t1, t2, t3.
+    """
+    frames = []
+    for root in roots:
+        model = os.path.basename(os.path.normpath(root))
+        model = model[len('result_'):] if model.startswith('result_') else model
+        for rep_dir in sorted(glob.glob(os.path.join(root, '*', 'rep*'))):
+            task = os.path.basename(os.path.dirname(rep_dir))
+            if tasks and task not in tasks:
+                continue
+            rows = read_rep_dir(rep_dir)
+            if len(rows):
+                frames.append(rows.assign(model=model, task=task, rep=os.path.basename(rep_dir)))
+    if not frames:
+        return pd.DataFrame(columns=['model', 'task', 'rep', 'Case', 't1', 't2', 't3'])
+    return pd.concat(frames, ignore_index=True)[['model', 'task', 'rep', 'Case', 't1', 't2', 't3']]
+
+def score(results, ground_truth, matcher=None, n_boot=1000, ci=0.95, seed=0):
+    """
+    Top-1/top-3 accuracy of every (model, task) config with case-level bootstrap confidence
+    intervals, and per-case accuracy and top-1 agreement across reps. Every case weighs the same
+    however many reps it has (e.g. adaptive runs): a config's accuracy is the mean over its cases
+    of their accuracy over reps.
+
+    All rows are matched in one batched pass: distinct predictions and ground truths are resolved
+    once, and the match matrix between them is indexed by the (row, rank) arrays.
+    """
+    matcher = matcher or DiagnosisMatcher()
+    results = results[results['Case'].isin(ground_truth.keys())].reset_index(drop=True)
+
+    # Factorize configs, cases, predictions and ground truths into integer codes
+    config_codes, configs = pd.factorize(pd.MultiIndex.from_frame(results[['model', 'task']]))
+    case_codes, cases = pd.factorize(results['Case'])
+    predictions = results[['t1', 't2', 't3']].fillna('').astype(str).to_numpy()
+    pred_values, pred_codes = np.unique(predictions, return_inverse=True)
+    pred_codes = pred_codes.reshape(predictions.shape)
+    truth_values, truth_codes = np.unique(results['Case'].map(ground_truth).astype(str).to_numpy(), return_inverse=True)
+
+    hits = matcher.match_matrix(pred_values, truth_values)[pred_codes, truth_codes[:, None]]
+    top1 = hits[:, 0]
+    top3 = hits.any(axis=1)
+
+    # Per (config, case) sums over reps
+    n_configs, n_cases = len(configs), len(cases)
+    group = config_codes * n_cases + case_codes
+    n_rows = np.bincount(group, minlength=n_configs * n_cases).reshape(n_configs, n_cases)
+    top1_sum = np.bincount(group, weights=top1, minlength=n_configs * n_cases).reshape(n_configs, n_cases)
+    top3_sum = np.bincount(group, weights=top3, minlength=n_configs * n_cases).reshape(n_configs, n_cases)
+
+    # Top-1 agreement: share of reps whose first diagnosis resolves to the modal concept of the case
+    concepts = [matcher.resolve(value) for value in pred_values]
+    first_concept = np.array([-1 - i if concept is None else concept for i, concept in enumerate(concepts)])
+    answer = first_concept[pred_codes[:, 0]]
+    pair_values, pair_counts = np.unique(np.stack([group, answer]), axis=1, return_counts=True)
+    modal = np.zeros(n_configs * n_cases)
+    np.maximum.at(modal, pair_values[0], pair_counts)
+    modal = modal.reshape(n_configs, n_cases)
+
+    # Per (config, case) accuracy over reps, 0 where a config lacks the case (masked by `present`)
+    present = (n_rows > 0).astype(float)
+    reps = np.maximum(n_rows, 1)
+    case_top1 = top1_sum / reps
+    case_top3 = top3_sum / reps
+
+    # Bootstrap over cases: multinomial case weights shared by all configs, one matrix product each
+    rng = np.random.default_rng(seed)
+    weights = rng.multinomial(n_cases, np.full(n_cases, 1 / n_cases), size=n_boot).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cases_boot = present @ weights
+        top1_boot = (case_top1 @ weights) / cases_boot
+        top3_boot = (case_top3 @ weights) / cases_boot
+        agreement = modal / n_rows
+    alpha = (1 - ci) / 2
+    top1_ci = np.nanquantile(top1_boot, [alpha, 1 - alpha], axis=1)
+    top3_ci = np.nanquantile(top3_boot, [alpha, 1 - alpha], axis=1)
+
+    n_present = present.sum(axis=1)
+    summary = pd.DataFrame({
+        'model': configs.get_level_values(0),
+        'task': configs.get_level_values(1),
+        'cases': n_present.astype(int),
+        'rows': n_rows.sum(axis=1),
+        'top1': case_top1.sum(axis=1) / n_present,
+        'top1_low': top1_ci[0],
+        'top1_high': top1_ci[1],
+        'top3': case_top3.sum(axis=1) / n_present,
+        'top3_low': top3_ci[0],
+        'top3_high': top3_ci[1],
+        'agreement': np.nanmean(agreement, axis=1),
+    })
+
+    config_index, case_index = np.nonzero(n_rows)
+    per_case = pd.DataFrame({
+        'model': configs.get_level_values(0)[config_index],
+        'task': configs.get_level_values(1)[config_index],
+        'Case': cases[case_index],
+        'Diag': cases[case_index].map(ground_truth),
+        'reps': n_rows[config_index, case_index],
+        'top1': top1_sum[config_index, case_index] / n_rows[config_index, case_index],
+        'top3': top3_sum[config_index, case_index] / n_rows[config_index, case_index],
+        'agreement': agreement[config_index, case_index],
+    })
+    return summary, per_case
+
+def main(args):
+    roots = args.results or sorted(path for path in glob.glob('./result_*') if os.path.isdir(path))
+    ground_truth = load_ground_truth(args.workbook, args.sheet)
+    results = load_results(roots, args.tasks)
+    print(f"Loaded {len(results)} result rows from {len(roots)} result roots")
+
+    summary, per_case = score(results, ground_truth, DiagnosisMatcher(cutoff=args.fuzzy_cutoff), args.bootstrap, args.ci, args.seed)
+    with pd.option_context('display.max_rows', None, 'display.width', 200, 'display.float_format', '{:.3f}'.format):
+        print(summary.to_string(index=False))
+
+    if args.output:
+        summary.to_csv(args.output, index=False)
+        print(f"Scores saved to {args.output}")
+    if args.per_case_output:
+        per_case.to_csv(args.per_case_output, index=False)
+        print(f"Per-case scores saved to {args.per_case_output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score top-1/top-3 accuracy of DDX results")
+
+    parser.add_argument('--results', type=str, nargs='+', help="Result roots to score, e.g. ./result_gpt_4o (default: all ./result_*)")
+    parser.add_argument('--tasks', type=str, nargs='+', help="Only score these tasks")
+    parser.add_argument('--workbook', type=str, default='./30_cases_v0.3.xlsx', help="Workbook with the ground truth Diag column")
+    parser.add_argument('--sheet', type=str, default='o1 preview', help="Sheet with the ground truth Diag column")
+    parser.add_argument('--fuzzy_cutoff', type=float, default=0.85, help="Minimum similarity of a fuzzy match")
+    parser.add_argument('--bootstrap', type=int, default=1000, help="Bootstrap resamples for the confidence intervals")
+    parser.add_argument('--ci', type=float, default=0.95, help="Confidence level")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed of the bootstrap")
+    parser.add_argument('--output', type=str, help="CSV file for the per-config scores")
+    parser.add_argument('--per_case_output', type=str, help="CSV file for the per-case scores")
+
+    args = parser.parse_args()
+
+    main(args)
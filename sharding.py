@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+from case_store import case_hash
+from response_log import RESPONSE_LOG_NAME
+from run_journal import JOURNAL_NAME, RunJournal
+
+# Hidden, so the readers of a result directory's case JSONs (*.json) never take it for a case
+MANIFEST_NAME = '.shard.json'
+# Name of the manifest in result directories written before it was hidden
+LEGACY_MANIFEST_NAME = 'shard.json'
+
+def parse_shard(value):
+    """
+    Parse a "i/N" shard spec (0 <= i < N) into (i, N); usable as an argparse type.
+    """
+    try:
+        index, count = (int(part) for part in str(value).split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard must look like i/N, got {value!r}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard index must be in 0..N-1, got {value!r}")
+    return index, count
+
+def shard_of(case_name, count):
+    return case_hash(case_name) % count
+
+def shard_cases(case_names, shard=None):
+    """
+    The cases assigned to `shard` (by a stable hash of the case name), in their original order.
+    """
+    if shard is None:
+        return list(case_names)
+    index, count = shard
+    return [case_name for case_name in case_names if shard_of(case_name, count) == index]
+
+def write_manifest(save_dir, shard, csv_name, case_order, start=0, end=None):
+    """
+    Record which shard of which case range a result directory holds, for `merge`. A directory
+    only ever holds one shard, so a manifest of another shard is an error.
+    """
+    path = os.path.join(save_dir, MANIFEST_NAME)
+    legacy_path = os.path.join(save_dir, LEGACY_MANIFEST_NAME)
+    if os.path.isfile(legacy_path) and not os.path.isfile(path):
+        os.replace(legacy_path, path)
+    manifest = {"shard": list(shard), "start": start, "end": end, "csv": csv_name, "case_order": list(case_order)}
+    if os.path.isfile(path):
+        with open(path) as f:
+            existing = json.load(f)
+        if existing['shard'] != manifest['shard']:
+            raise ValueError(f"{save_dir} already holds shard {existing['shard'][0]}/{existing['shard'][1]}")
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4, default=str)
+    os.replace(tmp_path, path)
+
+def add_shard_args(parser):
+    parser.add_argument('--shard', type=parse_shard, help="Only run shard i/N of the cases (stable hash of the case name, 0 <= i < N)")
+
+def find_shard_dirs(root):
+    """
+    Result directories (relative to `root`) that hold a shard manifest.
+    """
+    found = []
+    for dirpath, _, filenames in os.walk(root):
+        if MANIFEST_NAME in filenames or LEGACY_MANIFEST_NAME in filenames:
+            found.append(os.path.relpath(dirpath, root))
+    return sorted(found)
+
+def read_manifest(save_dir):
+    path = os.path.join(save_dir, MANIFEST_NAME)
+    with open(path if os.path.isfile(path) else os.path.join(save_dir, LEGACY_MANIFEST_NAME)) as f:
+        return json.load(f)
+
+def _case_file(save_dir, case_name):
+    return os.path.join(save_dir, f"{case_name}.json")
+
+def _read_bytes(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+def check_result_dir(parts):
+    """
+    Check the shards of one result directory. `parts` are (save_dir, manifest, journal) triples.
+    Returns (owners, problems, warnings), where owners maps every completed case to the save_dir
+    its output is taken from.
+    """
+    problems, warnings = [], []
+    first = parts[0][1]
+    count = first['shard'][1]
+    for save_dir, manifest, _ in parts[1:]:
+        for field in ('start', 'end', 'case_order'):
+            if manifest[field] != first[field]:
+                problems.append(f"{save_dir}: {field} differs from {parts[0][0]}")
+        if manifest['shard'][1] != count:
+            problems.append(f"{save_dir}: shard count {manifest['shard'][1]} differs from {count}")
+    if problems:
+        return {}, problems, warnings
+
+    indices = [manifest['shard'][0] for _, manifest, _ in parts]
+    missing_shards = sorted(set(range(count)) - set(indices))
+    if missing_shards:
+        problems.append(f"missing shard(s) {', '.join(f'{index}/{count}' for index in missing_shards)}")
+
+    owners = {}
+    for save_dir, manifest, journal in parts:
+        index = manifest['shard'][0]
+        for case_name in journal.records:
+            if shard_of(case_name, count) != index:
+                problems.append(f"{save_dir}: case {case_name} belongs to shard {shard_of(case_name, count)}/{count}, not {index}/{count}")
+                continue
+            if case_name not in owners:
+                owners[case_name] = (save_dir, journal)
+                continue
+            # The same case in two outputs (e.g. a shard run twice): fine only if both results agree
+            other_dir, other_journal = owners[case_name]
+            same_row = other_journal.records[case_name]['row'] == journal.records[case_name]['row']
+            same_file = _read_bytes(_case_file(other_dir, case_name)) == _read_bytes(_case_file(save_dir, case_name))
+            if same_row and same_file:
+                warnings.append(f"case {case_name} is in both {other_dir} and {save_dir} (identical, kept once)")
+            else:
+                problems.append(f"case {case_name} is in both {other_dir} and {save_dir} with different results")
+
+    expected = first['case_order'][first['start']:first['end']]
+    incomplete = [case_name for case_name in expected if case_name not in owners]
+    if incomplete:
+        problems.append(f"{len(incomplete)} of {len(expected)} cases missing: {', '.join(map(str, incomplete[:10]))}{' ...' if len(incomplete) > 10 else ''}")
+    for case_name, (save_dir, _) in owners.items():
+        if not os.path.isfile(_case_file(save_dir, case_name)):
+            problems.append(f"{save_dir}: JSON output of case {case_name} is missing")
+    return {case_name: owner for case_name, (owner, _) in owners.items()}, problems, warnings
+
+def merge_result_dir(parts, owners, out_dir):
+    """
+    Write the merged result directory as a single-node run would have left it: the case JSON files,
+    a journal in case order and the CSV rebuilt from it.
+    """
+    manifest = parts[0][1]
+    journals = {save_dir: journal for save_dir, _, journal in parts}
+    case_order = manifest['case_order']
+    position = {case_name: i for i, case_name in enumerate(case_order)}
+
+    os.makedirs(out_dir, exist_ok=True)
+    journal_path = os.path.join(out_dir, JOURNAL_NAME)
+    tmp_path = f"{journal_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        for case_name in sorted(owners, key=lambda case_name: position.get(case_name, len(position))):
+            save_dir = owners[case_name]
+            shutil.copyfile(_case_file(save_dir, case_name), _case_file(out_dir, case_name))
+            f.write(json.dumps(journals[save_dir].records[case_name], default=str) + '\n')
+    os.replace(tmp_path, journal_path)
+
+    # Raw completions of the merged cases, so the merged directory can still be replayed
+    logs = [save_dir for save_dir in journals if os.path.isfile(os.path.join(save_dir, RESPONSE_LOG_NAME))]
+    if logs:
+        log_path = os.path.join(out_dir, RESPONSE_LOG_NAME)
+        with open(f"{log_path}.tmp", 'w') as out:
+            for save_dir in logs:
+                with open(os.path.join(save_dir, RESPONSE_LOG_NAME)) as f:
+                    out.writelines(line for line in f if line.endswith('\n') and owners.get(json.loads(line)['case']) == save_dir)
+        os.replace(f"{log_path}.tmp", log_path)
+
+    return RunJournal(out_dir).finalize(os.path.join(out_dir, manifest['csv']), case_order)
+
+def merge(args):
+    # Group the shard outputs of every result directory across the shard roots
+    groups = {}
+    for root in args.shard_roots:
+        for rel_dir in find_shard_dirs(root):
+            save_dir = os.path.join(root, rel_dir)
+            groups.setdefault(rel_dir, []).append((save_dir, read_manifest(save_dir), RunJournal(save_dir)))
+    if not groups:
+        print(f"No shard outputs ({MANIFEST_NAME}) found under {', '.join(args.shard_roots)}")
+        return 1
+
+    checked, failed = {}, 0
+    for rel_dir, parts in sorted(groups.items()):
+        owners, problems, warnings = check_result_dir(parts)
+        for warning in warnings:
+            print(f"WARNING {rel_dir}: {warning}")
+        for problem in problems:
+            print(f"ERROR {rel_dir}: {problem}")
+        failed += bool(problems)
+        checked[rel_dir] = (parts, owners)
+
+    # Nothing is written unless every result directory is complete and consistent
+    if failed:
+        print(f"{failed} of {len(groups)} result directories failed the checks; nothing merged.")
+        return 1
+
+    for rel_dir, (parts, owners) in checked.items():
+        out_dir = os.path.join(args.output, rel_dir)
+        if os.path.isfile(os.path.join(out_dir, JOURNAL_NAME)) and not args.overwrite:
+            print(f"ERROR {out_dir} already holds results (use --overwrite)")
+            return 1
+    for rel_dir, (parts, owners) in checked.items():
+        n_rows = merge_result_dir(parts, owners, os.path.join(args.output, rel_dir))
+        print(f"{rel_dir}: {n_rows} cases from {len(parts)} shards")
+    print(f"Merged {len(checked)} result directories into {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the outputs of sharded runs (--shard i/N)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_merge = subparsers.add_parser('merge', help="Check the shard outputs and merge them into the canonical result directories")
+    parser_merge.add_argument('shard_roots', type=str, nargs='+', help="Working directories of the shard runs (holding result_<model>/...)")
+    parser_merge.add_argument('--output', type=str, default='.', help="Directory to write the merged result_<model>/... tree to")
+    parser_merge.add_argument('--overwrite', action='store_true', help="Replace merged results that already exist")
+
+    args = parser.parse_args()
+
+    sys.exit({'merge': merge}[args.command](args))
@@ -0,0 +1,160 @@
+import json
+import time
+from types import SimpleNamespace
+from planner import TokenCounter
+from prompt_templates import DIAGNOSIS_FIELDS
+
+# Local token counts of the streams that are closed before the provider reports their usage
+_counter = TokenCounter()
+
+class StreamingFieldParser:
+    """
+    Incremental scanner that picks the top-level string fields out of a JSON object while it is
+    still being streamed. Text before the opening brace (or after the closing one) is ignored, and
+    nested values are skipped, so partial output is enough to fill in top1..top3.
+    """
+
+    def __init__(self, required=DIAGNOSIS_FIELDS):
+        self.required = tuple(required)
+        self.fields = {}
+        self.chunks = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._buffer = []
+        self._key = None
+        self._after_colon = False
+        self._string_is_value = False
+
+    @property
+    def text(self):
+        return ''.join(self.chunks)
+
+    @property
+    def complete(self):
+        return all(field in self.fields for field in self.required)
+
+    def feed(self, chunk):
+        """
+        Consume the next piece of streamed text. Returns True once every required field is complete.
+        """
+        self.chunks.append(chunk)
+        for ch in chunk:
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._close_string()
+                    continue
+                self._buffer.append(ch)
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._buffer = []
+                self._string_is_value = self._after_colon
+            elif ch in '{[':
+                self._depth += 1
+                if self._depth == 1:
+                    # Entering the outer object: colons and quotes of preamble text do not count
+                    self._key = None
+                    self._after_colon = False
+            elif ch in '}]':
+                self._depth -= 1
+            elif self._depth != 1:
+                continue
+            elif ch == ':':
+                self._after_colon = True
+            elif ch == ',':
+                self._after_colon = False
+                self._key = None
+
+        return self.complete
+
+    def _close_string(self):
+        raw = ''.join(self._buffer)
+        try:
+            value = json.loads(f'"{raw}"')
+        except json.JSONDecodeError:
+            value = raw
+
+        # Only strings directly inside the outer object are keys or field values
+        if self._depth != 1:
+            return
+        if self._string_is_value and self._key is not None:
+            self.fields[self._key] = value
+            self._key = None
+            self._after_colon = False
+        elif not self._after_colon:
+            self._key = value
+
+async def stream_chat_completion(client, request, cutoff_fields=None):
+    """
+    Stream a chat completion and extract its JSON fields as tokens arrive.
+
+    If `cutoff_fields` is given, the stream is closed as soon as all of those fields are complete.
+    Returns (content, usage, metrics): content is the full text, or the extracted fields as JSON
+    when the stream was cut off. The usage chunk is only sent at the end of the stream, so the usage
+    of a cut-off stream is counted locally from the prompt and the text streamed so far
+    (metrics['usage'] = 'estimated'). metrics holds the time to first token and to the last diagnosis.
+    """
+    start = time.perf_counter()
+    parser = StreamingFieldParser(cutoff_fields or DIAGNOSIS_FIELDS)
+    metrics = {"ttft": None, "ttld": None, "cutoff": False}
+    usage = None
+
+    stream = await client.chat.completions.create(**request, stream=True, stream_options={"include_usage": True})
+    try:
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+
+            delta = chunk.choices[0].delta.content or ''
+            if not delta:
+                continue
+            if metrics["ttft"] is None:
+                metrics["ttft"] = time.perf_counter() - start
+
+            had_diagnoses = all(field in parser.fields for field in DIAGNOSIS_FIELDS)
+            parser.feed(delta)
+            if not had_diagnoses and all(field in parser.fields for field in DIAGNOSIS_FIELDS):
+                metrics["ttld"] = time.perf_counter() - start
+
+            if cutoff_fields and parser.complete:
+                metrics["cutoff"] = True
+                break
+    finally:
+        await stream.close()
+
+    if metrics["cutoff"]:
+        return json.dumps(parser.fields), estimate_usage(request, parser.text), {**metrics, "usage": 'estimated'}
+    return parser.text, usage, metrics
+
+def estimate_usage(request, completion):
+    """
+    Usage of a request whose stream was closed early, counted locally (see planner.TokenCounter).
+    """
+    prompt_tokens = _counter.count_messages(request.get('messages', []), request['model'])
+    completion_tokens = _counter.count(completion, request['model'])
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens, prompt_tokens_details=None)
+
+STREAM_CUTOFFS = ('off', 'diagnoses', 'all')
+
+def cutoff_fields_for(cutoff, prompt):
+    """
+    Fields after which a stream is closed: none, only top1..top3, or every field the prompt asks for.
+    """
+    if cutoff == 'off':
+        return None
+    if cutoff == 'diagnoses':
+        return DIAGNOSIS_FIELDS
+    return prompt.response_fields
+
+def add_stream_args(parser):
+    parser.add_argument('--stream', action='store_true', help="Stream completions and record time to first token and to the last diagnosis")
+    parser.add_argument('--stream_cutoff', type=str, choices=STREAM_CUTOFFS, default='all', help="Close the stream once these fields are complete: off, top1..top3 only, or all requested fields (with thoughts)")
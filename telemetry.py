@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import logging
+import contextlib
+import contextvars
+import numpy as np
+from logging.handlers import RotatingFileHandler
+from response_parser import ParseStats
+
+# Upper bounds (seconds) of the latency histogram buckets, shared with the Prometheus snapshot
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, float('inf'))
+TOKEN_FIELDS = ('prompt_tokens', 'completion_tokens', 'cached_tokens')
+
+# Metrics dict of the API call running in the current task, for the key pool to add its timings to
+_current_call = contextvars.ContextVar('telemetry_call', default=None)
+
+def current_metrics():
+    """
+    Metrics dict of the telemetry call that encloses the running code, or None outside of one.
+    """
+    return _current_call.get()
+
+def accumulate(metrics, field, value):
+    """
+    Add `value` to a field of a metrics dict (no-op without one).
+    """
+    if metrics is not None:
+        metrics[field] = metrics.get(field, 0) + value
+
+def add_request(metrics, usage=None):
+    """
+    Accumulate one completed API request (and its token usage) into the metrics dict of an API call.
+    Its network latency, queue wait and the pool's retries are added by the key pool.
+    """
+    metrics['requests'] = metrics.get('requests', 0) + 1
+    if usage is None:
+        return
+    details = getattr(usage, 'prompt_tokens_details', None)
+    counts = {
+        'prompt_tokens': usage.prompt_tokens,
+        'completion_tokens': usage.completion_tokens,
+        'cached_tokens': getattr(details, 'cached_tokens', None),
+    }
+    for field, value in counts.items():
+        metrics[field] = metrics.get(field, 0) + (value or 0)
+
+def _fmt(seconds):
+    return f"{seconds:.2f}s"
+
+class Telemetry:
+    """
+    Per-call telemetry of one run. Every API call is written as one JSON line to a size-rotated log
+    (`<log_dir>/<run_name>.jsonl`, then `.1`, `.2`, ...) and kept in memory for the exit summary.
+    """
+
+    def __init__(self, log_dir='./logs', run_name=None, max_mb=50, backups=5, prometheus_path=None):
+        run_name = run_name or time.strftime('run_%Y%m%d_%H%M%S')
+        os.makedirs(log_dir, exist_ok=True)
+        self.path = os.path.join(log_dir, f'{run_name}.jsonl')
+        self.prometheus_path = prometheus_path
+        self.records = []
+        self.parse_stats = ParseStats()
+        self.started = time.perf_counter()
+
+        self._handler = RotatingFileHandler(self.path, maxBytes=int(max_mb * 1024 * 1024), backupCount=backups, encoding='utf-8')
+        self._logger = logging.Logger(f'telemetry.{run_name}')
+        self._logger.addHandler(self._handler)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def record(self, metrics):
+        metrics = {"ts": round(time.time(), 3), **metrics}
+        self.records.append(metrics)
+        self.parse_stats.record(metrics)
+        self._logger.info(json.dumps(metrics, default=str))
+
+    @contextlib.contextmanager
+    def call(self, **fields):
+        """
+        Context manager around one API call. Yields the metrics dict that the call fills in: the
+        runner adds requests, tokens and parse outcome, the key pool (through current_metrics) the
+        network latency, the time spent waiting for a key slot (queue_wait) and its own retries of
+        429s and server errors (pool_retries, backoff). The time since the start of the run is
+        recorded as its start, exceptions as its error.
+        """
+        metrics = {**fields, "started": self.elapsed()}
+        token = _current_call.set(metrics)
+        try:
+            yield metrics
+        except BaseException as e:
+            metrics['error'] = repr(e)
+            raise
+        finally:
+            _current_call.reset(token)
+            self.record(metrics)
+
+    def _values(self, field, records=None):
+        return np.array([record[field] for record in (self.records if records is None else records) if record.get(field) is not None], dtype=float)
+
+    def summary(self):
+        """
+        Latency histogram and throughput of the run so far.
+        """
+        wall = self.elapsed()
+        requested = [record for record in self.records if record.get('requests')]
+        latency = self._values('latency', requested)
+        queue_wait = self._values('queue_wait')
+        tokens = {field: int(self._values(field).sum()) for field in TOKEN_FIELDS}
+        errors = sum('error' in record for record in self.records)
+        cache_hits = sum(bool(record.get('cache_hit')) for record in self.records)
+
+        lines = [
+            f"Calls: {len(self.records)} ({len(requested)} sent to the API, {cache_hits} cache hits, {errors} errors) in {_fmt(wall)}"
+            f" -> {len(self.records) / wall * 60:.1f} calls/min",
+            f"Tokens: {tokens['prompt_tokens']} prompt ({tokens['cached_tokens']} cached), {tokens['completion_tokens']} completion"
+            f" -> {(tokens['prompt_tokens'] + tokens['completion_tokens']) / wall:.1f} tokens/s",
+        ]
+        if len(latency):
+            p50, p95, p99 = np.percentile(latency, [50, 95, 99])
+            lines.append(f"Latency: p50 {_fmt(p50)}, p95 {_fmt(p95)}, p99 {_fmt(p99)}, max {_fmt(latency.max())}")
+            counts = np.histogram(latency, bins=(0,) + LATENCY_BUCKETS)[0]
+            width = max(counts.max(), 1)
+            for bound, count in zip(LATENCY_BUCKETS, counts):
+                label = f"<= {bound:g}s" if bound != float('inf') else f"> {LATENCY_BUCKETS[-2]:g}s"
+                lines.append(f"  {label:>8} {'#' * int(round(40 * count / width)):<40} {count}")
+        # Calls of multi-stage runs (e.g. ER_gpt_POT.py --mode agents) per stage
+        for stage in sorted({record['stage'] for record in self.records if record.get('stage')}):
+            records = [record for record in self.records if record.get('stage') == stage]
+            stage_latency = self._values('latency', [record for record in records if record.get('requests')])
+            line = (f"Stage {stage}: {len(records)} calls, {int(self._values('prompt_tokens', records).sum())} prompt +"
+                    f" {int(self._values('completion_tokens', records).sum())} completion tokens")
+            if len(stage_latency):
+                line += f", latency p50 {_fmt(np.median(stage_latency))}, p95 {_fmt(np.percentile(stage_latency, 95))}"
+            lines.append(line)
+        if tokens['prompt_tokens']:
+            # Provider prompt caching: share of prompt tokens billed as cached, and its effect on latency
+            cached = [record for record in requested if record.get('cached_tokens')]
+            line = (f"Prompt cache: {tokens['cached_tokens'] / tokens['prompt_tokens']:.1%} of prompt tokens cached,"
+                    f" {len(cached)}/{len(requested)} calls with a cached prefix")
+            uncached = [record for record in requested if not record.get('cached_tokens')]
+            if cached and uncached:
+                line += f" (latency p50 {_fmt(np.median(self._values('latency', cached)))} vs {_fmt(np.median(self._values('latency', uncached)))} without)"
+            lines.append(line)
+        if len(queue_wait):
+            p50, p95 = np.percentile(queue_wait, [50, 95])
+            lines.append(f"Queue wait for a key slot: p50 {_fmt(p50)}, p95 {_fmt(p95)}")
+        pool_retries = int(self._values('pool_retries').sum())
+        if pool_retries:
+            lines.append(f"Pool retries (429s, server errors): {pool_retries}, {_fmt(self._values('backoff').sum())} of backoff")
+        lines.append(self.parse_stats.summary())
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        """
+        Snapshot of the run in the Prometheus text exposition format.
+        """
+        requested = [record for record in self.records if record.get('requests')]
+        latency = self._values('latency', requested)
+        out = [
+            '# HELP ddx_calls_total API calls by parse outcome.',
+            '# TYPE ddx_calls_total counter',
+        ]
+        for outcome, count in self.parse_stats.counts.items():
+            out.append(f'ddx_calls_total{{outcome="{outcome}"}} {count}')
+        out += [
+            '# HELP ddx_requests_total Requests sent to the API, including retries.',
+            '# TYPE ddx_requests_total counter',
+            f'ddx_requests_total {int(self._values("requests").sum())}',
+            '# HELP ddx_errors_total API calls that raised.',
+            '# TYPE ddx_errors_total counter',
+            f'ddx_errors_total {sum("error" in record for record in self.records)}',
+            '# HELP ddx_tokens_total Tokens used, by kind.',
+            '# TYPE ddx_tokens_total counter',
+        ]
+        for field in TOKEN_FIELDS:
+            out.append(f'ddx_tokens_total{{kind="{field[:-len("_tokens")]}"}} {int(self._values(field).sum())}')
+        out += [
+            '# HELP ddx_call_latency_seconds Network latency of a call, summed over its requests and retries.',
+            '# TYPE ddx_call_latency_seconds histogram',
+        ]
+        for bound in LATENCY_BUCKETS:
+            le = '+Inf' if bound == float('inf') else f'{bound:g}'
+            out.append(f'ddx_call_latency_seconds_bucket{{le="{le}"}} {int((latency <= bound).sum())}')
+        out += [
+            f'ddx_call_latency_seconds_sum {latency.sum():.6f}',
+            f'ddx_call_latency_seconds_count {len(latency)}',
+            '# HELP ddx_run_seconds Wall-clock time of the run so far.',
+            '# TYPE ddx_run_seconds gauge',
+            f'ddx_run_seconds {self.elapsed():.3f}',
+        ]
+        return '\n'.join(out) + '\n'
+
+    def close(self):
+        """
+        Flush the log and write the Prometheus snapshot if one was requested.
+        """
+        self._handler.close()
+        if self.prometheus_path:
+            os.makedirs(os.path.dirname(self.prometheus_path) or '.', exist_ok=True)
+            tmp_path = f"{self.prometheus_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(self.prometheus())
+            os.replace(tmp_path, self.prometheus_path)
+
+def add_telemetry_args(parser):
+    parser.add_argument('--log_dir', type=str, default='./logs', help="Directory of the per-run telemetry logs")
+    parser.add_argument('--log_max_mb', type=float, default=50, help="Size at which the telemetry log is rotated")
+    parser.add_argument('--prometheus', type=str, help="Write a Prometheus text snapshot of the run to this file")
+
+def telemetry_from_args(args, run_name):
+    return Telemetry(args.log_dir, f"{run_name}_{time.strftime('%Y%m%d_%H%M%S')}", args.log_max_mb, prometheus_path=args.prometheus)
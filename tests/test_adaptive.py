@@ -0,0 +1,41 @@
+from adaptive import AdaptiveScheduler, StoppingRule, agreement, majority_probability, rep_schedule
+
+STABLE = ('Acute MI', 'Aortic dissection', 'Pulmonary embolism')
+
+def test_majority_probability():
+    assert majority_probability(0, 0) == 0.5
+    assert majority_probability(3, 3) == 15 / 16
+    assert majority_probability(2, 5) < majority_probability(3, 5) < majority_probability(5, 5)
+
+def test_agreement_compares_normalized_answers():
+    answers = [STABLE, ('acute mi', 'pulmonary embolism', 'aortic dissection'), ('Pneumonia', 'Acute MI', 'Sepsis')]
+    assert agreement(answers) == (2, 2)
+    assert agreement([]) == (0, 0)
+
+def test_rep_schedule():
+    assert rep_schedule([2, 4, 2], 4) == [2, 4, 5, 6]
+    assert rep_schedule([], 3) == [1, 2, 3]
+    assert rep_schedule([1, 2, 3], 2) == [1, 2]
+
+def test_stop_reason():
+    rule = StoppingRule(confidence=0.9, min_reps=3, max_reps=5)
+    assert rule.stop_reason([STABLE] * 2) is None
+    assert rule.stop_reason([STABLE] * 4) == 'stable'
+    mixed = [STABLE, ('Pneumonia', 'Sepsis', 'Asthma')] * 2
+    assert rule.stop_reason(mixed) is None
+    assert rule.stop_reason(mixed + [STABLE]) == 'max_reps'
+
+def test_next_round_spends_budget_on_fewest_reps_first():
+    rule = StoppingRule(confidence=0.99, min_reps=2, max_reps=5)
+    scheduler = AdaptiveScheduler(['a', 'b', 'c'], rule, [1, 2, 3, 4, 5], budget=6)
+    assert scheduler.next_round() == [('a', 1), ('b', 1), ('c', 1)]
+    for key in 'abc':
+        scheduler.add(key, 1, STABLE)
+    scheduler.add('b', 2, STABLE)
+    # Two reps left: 'a' and 'c' have fewer reps than 'b', which runs out of budget
+    assert scheduler.next_round() == [('a', 2), ('c', 2)]
+    assert scheduler.stopped == {'b': 'budget'}
+    scheduler.add('a', 2, STABLE)
+    scheduler.add('c', 2, STABLE)
+    assert scheduler.next_round() == []
+    assert scheduler.stopped == {'a': 'budget', 'b': 'budget', 'c': 'budget'}
@@ -0,0 +1,66 @@
+import asyncio
+import types
+import pytest
+from api_call import request_completion
+from response_cache import ResponseCache
+
+class FakeClient:
+    def __init__(self, contents):
+        self.contents = list(contents)
+        self.requests = []
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    async def create(self, **request):
+        self.requests.append(request)
+        message = types.SimpleNamespace(content=self.contents.pop(0))
+        usage = types.SimpleNamespace(prompt_tokens=10, completion_tokens=5, total_tokens=15, prompt_tokens_details=None)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=usage)
+
+REQUEST = {"model": 'gpt-4o', "messages": [{"role": 'user', "content": 'chest pain'}]}
+ANSWER = '{"top1": "PE", "top2": "ACS", "top3": "Pneumonia"}'
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr('api_call.backoff_delay', lambda attempt: 0)
+
+def test_parse_error_is_requested_again(tmp_path):
+    client = FakeClient(['no json here', ANSWER])
+    metrics = {}
+    result_dict, tokens = asyncio.run(request_completion(client, REQUEST, 'Case 1', str(tmp_path), metrics=metrics))
+    assert result_dict['top1'] == 'PE'
+    assert tokens == 30
+    assert metrics['retries'] == 1 and metrics['requests'] == 2
+    assert len((tmp_path / 'responses.jsonl').read_text().splitlines()) == 2
+
+def test_gives_up_after_max_retries(tmp_path):
+    client = FakeClient(['no json'] * 3)
+    metrics = {}
+    with pytest.raises(RuntimeError):
+        asyncio.run(request_completion(client, REQUEST, 'Case 1', str(tmp_path), metrics=metrics, max_retries=2))
+    assert metrics['parse'] == 'failed'
+    assert len(client.requests) == 3
+
+def test_parse_callback_and_cache(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache'), mode='readwrite')
+    client = FakeClient([ANSWER])
+    parse = lambda result, metrics: result.upper()
+    assert asyncio.run(request_completion(client, REQUEST, 'Case 1', str(tmp_path), parse, cache=cache, rep=1)) == (ANSWER.upper(), 15)
+    metrics = {}
+    assert asyncio.run(request_completion(client, REQUEST, 'Case 1', str(tmp_path), parse, cache=cache, rep=1, metrics=metrics)) == (ANSWER.upper(), 15)
+    assert metrics['cache_hit'] and len(client.requests) == 1
+
+def test_cache_keeps_tokens_of_the_cached_completion(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache'), mode='readwrite')
+    client = FakeClient(['no json here', ANSWER])
+    assert asyncio.run(request_completion(client, REQUEST, 'Case 1', str(tmp_path), cache=cache, rep=1))[1] == 30
+    # A cache hit does not count the failed attempt again
+    assert asyncio.run(request_completion(client, REQUEST, 'Case 1', str(tmp_path), cache=cache, rep=1))[1] == 15
+
+def test_cut_off_streams_do_not_serve_full_completions(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache'), mode='readwrite')
+    fields = ('top1', 'top2', 'top3')
+    assert ResponseCache.make_key(REQUEST, 1, fields) != ResponseCache.make_key(REQUEST, 1)
+    cache.put(ResponseCache.make_key(REQUEST, 1, fields), '{"top1": "ACS"}', 12)
+    client = FakeClient([ANSWER])
+    result_dict, _ = asyncio.run(request_completion(client, REQUEST, 'Case 1', str(tmp_path), cache=cache, rep=1))
+    assert result_dict['top1'] == 'PE' and len(client.requests) == 1
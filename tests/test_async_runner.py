@@ -0,0 +1,25 @@
+import asyncio
+import pytest
+from async_runner import run_cases
+
+def test_results_in_item_order():
+    async def worker(item):
+        await asyncio.sleep(0.01 * (3 - item))
+        return item * 10
+
+    saved = []
+    assert run_cases([1, 2, 3], worker, concurrency=3, on_result=lambda item, result: saved.append(item)) == [10, 20, 30]
+    # Each item is saved as soon as it finishes
+    assert saved == [3, 2, 1]
+
+def test_failure_keeps_other_items():
+    async def worker(item):
+        if item == 1:
+            raise RuntimeError("out of retries")
+        await asyncio.sleep(0.01)
+        return item
+
+    saved = []
+    with pytest.raises(RuntimeError, match="out of retries"):
+        run_cases(range(5), worker, concurrency=2, on_result=lambda item, result: saved.append(item))
+    assert sorted(saved) == [0, 2, 3, 4]
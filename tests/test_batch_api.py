@@ -0,0 +1,31 @@
+import os
+import json
+import shutil
+import argparse
+from batch_api import generate, ingest
+from response_log import RESPONSE_LOG_NAME
+from run_journal import RunJournal
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ANSWER = '{"top1": "Pneumonia", "top2": "PE", "top3": "ACS"}'
+
+def test_ingest_logs_completions_and_records_fingerprints(tmp_path, monkeypatch):
+    shutil.copy(os.path.join(REPO_DIR, '30_cases_v0.3.xlsx'), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    batch_file = './batch/batch_requests.jsonl'
+    generate(argparse.Namespace(runner='gpt', model='gpt-4o', max_tokens=1000, temperature=0.7, reps=[1], prompt_version='v2.0',
+                                with_thoughts=False, with_lr=False, all_variants=False, start=0, end=2, batch_file=batch_file))
+    with open(batch_file) as f:
+        requests = [json.loads(line) for line in f]
+    with open('./batch/batch_requests_output.jsonl', 'w') as f:
+        for request in requests:
+            body = {"choices": [{"message": {"content": ANSWER}}], "usage": {"total_tokens": 42}}
+            f.write(json.dumps({"custom_id": request['custom_id'], "response": {"status_code": 200, "body": body}}) + '\n')
+    ingest(argparse.Namespace(runner='gpt', output_files=None, batch_file=batch_file))
+
+    save_dir = './result_gpt_4o/ER_3DDX_v2.0_NoThoughts_new/rep1'
+    records = RunJournal(save_dir).records
+    assert sorted(records) == ['Case 1', 'Case 2']
+    assert all({'prompt_hash', 'inputs'} <= set(record) for record in records.values())
+    with open(os.path.join(save_dir, RESPONSE_LOG_NAME)) as f:
+        assert [json.loads(line)['case'] for line in f] == ['Case 1', 'Case 2']
@@ -0,0 +1,22 @@
+import pytest
+
+pytest.importorskip('matplotlib')
+from figures import PANELS, model_name, model_order, render_panel
+
+def test_model_name():
+    assert model_name('./result_gpt_4o_2024_08_06') == ('gpt-4o-2024-08-06', 'single')
+    assert model_name('./result_o1_mini_POT/') == ('o1-mini', 'pot')
+    assert model_name('./result_my_model') == ('my-model', 'single')
+
+def test_model_order():
+    models, spans = model_order({'my-model', 'o1-mini', 'gpt-3.5-turbo-0125', 'gpt-4o-mini-2024-07-18'})
+    assert models == ['gpt-3.5-turbo-0125', 'gpt-4o-mini-2024-07-18', 'o1-mini', 'my-model']
+    assert spans == [('GPT-3.5 family', 0, 1), ('GPT-4o family', 1, 2), ('o1 family', 2, 3)]
+
+@pytest.mark.parametrize('ext, magic', [('png', b'\x89PNG'), ('pdf', b'%PDF'), ('svg', b'<?xml')])
+def test_render_panel_format(tmp_path, ext, magic):
+    records = [('No Thoughts', 'o1-mini', 'ER_3DDX_v2.0_NoThoughts', 1, 50.0), ('With Thoughts', 'o1-mini', 'ER_3DDX_v2.0_WithThoughts', 1, 60.0)]
+    path = tmp_path / f'top1_thoughts.{ext}'
+    render_panel('top1_thoughts', PANELS['top1_thoughts'], records, str(path))
+    assert path.read_bytes().startswith(magic)
+    assert [p.name for p in tmp_path.iterdir()] == [path.name]
@@ -0,0 +1,46 @@
+import asyncio
+import types
+from key_pool import ApiKey, CircuitBreaker, KeyPool, TokenBucket, parse_duration, retry_after
+
+def test_parse_duration():
+    assert parse_duration('20ms') == 0.02
+    assert parse_duration('6m0s') == 360
+    assert parse_duration(None) is None
+
+def test_retry_after_headers():
+    error = types.SimpleNamespace(response=types.SimpleNamespace(headers={'retry-after-ms': '1500'}))
+    assert retry_after(error) == 1.5
+    error = types.SimpleNamespace(response=types.SimpleNamespace(headers={'x-ratelimit-reset-requests': '2s', 'x-ratelimit-reset-tokens': '500ms'}))
+    assert retry_after(error) == 2
+
+def test_token_bucket():
+    bucket = TokenBucket(per_minute=60)
+    assert bucket.wait_time(0.0) == 0.0
+    bucket.take(0.0)
+    assert bucket.wait_time(0.0) == 1.0
+
+def test_breaker_single_probe():
+    breaker = CircuitBreaker(threshold=2, cooldown=5.0)
+    breaker.on_failure(0.0)
+    assert breaker.available_at(0.0, 0) == 0.0
+    breaker.on_failure(0.0)
+    assert breaker.available_at(1.0, 0) == 5.0
+    # Once the probe is reserved, nobody else gets the key, during the cooldown or after it
+    assert breaker.available_at(1.0, 1) == float('inf')
+    assert breaker.available_at(6.0, 1) == float('inf')
+    breaker.on_success()
+    assert breaker.available_at(6.0, 1) == 6.0
+
+def test_pool_waits_for_the_probe():
+    async def run():
+        key = ApiKey('API_KEY_1', 'test-key', max_in_flight=8, breaker=CircuitBreaker(threshold=1, cooldown=0.05))
+        pool = KeyPool([key])
+        key.breaker.on_failure(asyncio.get_running_loop().time())
+        probe = await pool.acquire()
+        waiter = asyncio.create_task(pool.acquire())
+        await asyncio.sleep(0.1)
+        assert not waiter.done()
+        key.breaker.on_success()
+        await pool.release(probe)
+        await asyncio.wait_for(waiter, 1)
+    asyncio.run(run())
@@ -0,0 +1,48 @@
+import os
+import pandas as pd
+from planner import MAX_TOKENS_STEP, TokenCounter, plan_items, size_max_tokens
+
+class Prompt:
+    system_prompt = 'You are an emergency physician.'
+
+    def render(self, *case):
+        return ' '.join(case)
+
+def write_run(root, rep, rows):
+    task = 'ER_3DDX_v2.0_WithThoughts_new'
+    rep_dir = os.path.join(root, 'result_gpt_4o', task, f'rep{rep}')
+    os.makedirs(rep_dir)
+    pd.DataFrame(rows).to_csv(os.path.join(rep_dir, f'{task}_rep{rep}.csv'), index=False)
+
+def plan(root, case_dict):
+    items = [{"model": 'gpt-4o', "task": 'ER_3DDX_v2.0_WithThoughts_new', "with_thoughts": True, "case_name": case_name,
+              "prompt": Prompt(), "system_prompt": Prompt.system_prompt, "user_prompt": Prompt().render(*case)}
+             for case_name, case in case_dict.items()]
+    sized = plan_items(items, case_dict, TokenCounter(), max_tokens=1000, auto_max_tokens=True, roots=(str(root),))
+    return items, sized[('gpt-4o', True)]
+
+def test_size_max_tokens():
+    assert size_max_tokens([], 1000) == 1000
+    assert size_max_tokens([300] * 10, 1000) == 384
+    # Never below the longest completion seen
+    assert size_max_tokens([100] * 200 + [900], 1000) >= 900
+    assert size_max_tokens([100], 1000, observed=[500]) >= 500
+    assert size_max_tokens([1], 1000) == MAX_TOKENS_STEP
+
+def test_split_token_rows_do_not_size_max_tokens(tmp_path):
+    case_dict = {'Case 1': ('chest pain ' * 200,)}
+    prompt_tokens = TokenCounter().count_messages([{"content": Prompt.system_prompt}, {"content": Prompt().render(*case_dict['Case 1'])}], 'gpt-4o')
+    # Five samples of one call: each row holds a fifth of the prompt and of the completions
+    write_run(tmp_path, 1, [{"Case": 'Case 1', "Tokens": (prompt_tokens + 5 * 300) // 5, "Samples": 5}])
+    items, sized = plan(tmp_path, case_dict)
+    assert sized == 1000
+    assert abs(items[0]['plan']['completion_tokens'] - 300) <= 1
+
+def test_single_choice_rows_size_max_tokens(tmp_path):
+    case_dict = {'Case 1': ('chest pain',)}
+    prompt_tokens = TokenCounter().count_messages([{"content": Prompt.system_prompt}, {"content": 'chest pain'}], 'gpt-4o')
+    write_run(tmp_path, 1, [{"Case": 'Case 1', "Tokens": prompt_tokens + 300}])
+    write_run(tmp_path, 2, [{"Case": 'Case 1', "Tokens": (prompt_tokens + 5 * 700) // 5, "Samples": 5}])
+    items, sized = plan(tmp_path, case_dict)
+    # The mean completion of the multi-choice call bounds max_tokens from below
+    assert sized >= 700
@@ -0,0 +1,19 @@
+import os
+import json
+import pandas as pd
+from results_store import ResultsStore
+from sharding import LEGACY_MANIFEST_NAME, write_manifest
+
+def test_ingest_skips_shard_manifests(tmp_path):
+    rep_dir = tmp_path / 'result_gpt_4o' / 'ER_3DDX_v2.0_NoThoughts_new' / 'rep1'
+    os.makedirs(rep_dir)
+    write_manifest(str(rep_dir), (0, 2), 'ER_3DDX_v2.0_NoThoughts_new_rep1.csv', ['Case 1'])
+    (rep_dir / LEGACY_MANIFEST_NAME).write_text(json.dumps({"shard": [0, 2]}))
+    (rep_dir / 'Case 1.json').write_text(json.dumps({"top1": 'Pneumonia', "top2": 'PE', "top3": 'ACS'}))
+    pd.DataFrame([{"Case": 'Case 1', "t1": 'Pneumonia', "t2": 'PE', "t3": 'ACS', "Tokens": 10}]).to_csv(rep_dir / 'ER_3DDX_v2.0_NoThoughts_new_rep1.csv', index=False)
+
+    store = ResultsStore(str(tmp_path / 'results.sqlite'))
+    counts = store.ingest([str(tmp_path / 'result_gpt_4o')], {'Case 1': 'Pneumonia'})
+    assert counts['files'] == 2
+    rows = store.query('SELECT case_name, rank FROM results')
+    assert rows.to_dict('records') == [{"case_name": 'Case 1', "rank": 1}]
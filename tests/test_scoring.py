@@ -0,0 +1,55 @@
+import pandas as pd
+from scoring import DiagnosisMatcher, normalize_diagnosis, score
+
+def test_normalize_diagnosis():
+    assert normalize_diagnosis("Exacerbation COPD/asthma ") == 'exacerbation copd asthma'
+    assert normalize_diagnosis(None) == ''
+
+def test_synonyms_match():
+    matcher = DiagnosisMatcher()
+    assert matcher.match_matrix(['AECOPD', 'Ruptured AAA'], ['COPD exacerbation', 'Abdominal aortic aneurysm']).tolist() == [[True, False], [False, True]]
+
+def test_unknown_diagnosis_matches_itself():
+    matcher = DiagnosisMatcher()
+    assert matcher.match_matrix(['Kawasaki disease', "Kawasaki's disease", 'Measles'], ['Kawasaki disease']).tolist() == [[True], [True], [False]]
+
+def test_prediction_credits_first_mentioned_concept_only():
+    matcher = DiagnosisMatcher()
+    assert matcher.match_matrix(['Pneumonia; rule out sepsis'], ['Pneumonia', 'Sepsis']).tolist() == [[True, False]]
+
+def test_empty_diagnosis_never_matches():
+    matcher = DiagnosisMatcher()
+    assert matcher.resolve('') is None
+    assert matcher.match_matrix([''], ['']).tolist() == [[False]]
+
+def test_score_is_case_weighted():
+    results = pd.DataFrame([
+        {"model": 'm', "task": 't', "rep": 'rep1', "Case": 'A', "t1": 'Kawasaki disease', "t2": '', "t3": ''},
+        {"model": 'm', "task": 't', "rep": 'rep2', "Case": 'A', "t1": 'Measles', "t2": '', "t3": 'Kawasaki disease'},
+        {"model": 'm', "task": 't', "rep": 'rep1', "Case": 'B', "t1": 'PE', "t2": '', "t3": ''},
+    ])
+    summary, per_case = score(results, {'A': 'Kawasaki disease', 'B': 'Pulmonary embolism'}, n_boot=10)
+    assert summary['top1'].item() == 0.75
+    assert summary['top3'].item() == 1.0
+    assert per_case.set_index('Case')['top1'].to_dict() == {'A': 0.5, 'B': 1.0}
+
+def test_truth_alternatives_match_any():
+    matcher = DiagnosisMatcher()
+    predictions = ['Asthma exacerbation', 'Acute asthma', 'AECOPD', 'Pneumonia']
+    assert matcher.match_matrix(predictions, ['Exacerbation COPD/asthma']).tolist() == [[True], [True], [True], [False]]
+    assert matcher.match_matrix(['Pneumonia', 'Septic shock', 'Urosepsis', 'UTI'], ['Septic shock due to pneumonia', 'Urosepsis or UTI']).tolist() == [[True, False], [True, False], [False, True], [False, True]]
+
+def test_distinct_diagnoses_do_not_match():
+    matcher = DiagnosisMatcher()
+    predictions = ['Lower GI bleeding', 'LGIB', 'Cirrhosis', 'Thoracic aortic aneurysm', 'Aortic aneurysm', 'Pyelonephritis', 'Urosepsis']
+    truths = ['Diverticular bleeding', 'Decompensated liver cirrhosis', 'AAA', 'UTI']
+    assert not matcher.match_matrix(predictions, truths).any()
+
+def test_score_credits_either_alternative():
+    results = pd.DataFrame([
+        {"model": 'm', "task": 't', "rep": 'rep1', "Case": 'Case 6', "t1": 'Asthma exacerbation', "t2": '', "t3": ''},
+        {"model": 'm', "task": 't', "rep": 'rep2', "Case": 'Case 6', "t1": 'Pneumonia', "t2": 'Acute asthma', "t3": ''},
+    ])
+    summary, _ = score(results, {'Case 6': 'Exacerbation COPD/asthma'}, n_boot=10)
+    assert summary['top1'].item() == 0.5
+    assert summary['top3'].item() == 1.0
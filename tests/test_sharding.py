@@ -0,0 +1,51 @@
+import os
+import json
+import argparse
+import pytest
+from run_journal import RunJournal
+from scoring import read_rep_dir
+from sharding import LEGACY_MANIFEST_NAME, MANIFEST_NAME, find_shard_dirs, merge, parse_shard, shard_cases, write_manifest
+
+CASES = [f'Case {i}' for i in range(1, 21)]
+REL_DIR = os.path.join('result_gpt_4o', 'ER_3DDX_v2.0_NoThoughts_new', 'rep1')
+
+def test_parse_shard():
+    assert parse_shard('1/4') == (1, 4)
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_shard('4/4')
+
+def test_shards_partition_the_cases():
+    shards = [shard_cases(CASES, (i, 3)) for i in range(3)]
+    assert sorted(sum(shards, [])) == sorted(CASES)
+    assert shard_cases(CASES[5:], (1, 3)) == [case_name for case_name in shards[1] if case_name in CASES[5:]]
+
+def test_manifest_conflict(tmp_path):
+    write_manifest(str(tmp_path), (0, 2), 'x.csv', CASES)
+    with pytest.raises(ValueError):
+        write_manifest(str(tmp_path), (1, 2), 'x.csv', CASES)
+
+def run_shard(root, shard):
+    save_dir = os.path.join(root, REL_DIR)
+    os.makedirs(save_dir)
+    write_manifest(save_dir, shard, 'ER_3DDX_v2.0_NoThoughts_new_rep1.csv', CASES)
+    journal = RunJournal(save_dir)
+    for case_name in shard_cases(CASES, shard):
+        with open(os.path.join(save_dir, f'{case_name}.json'), 'w') as f:
+            json.dump({"top1": 'PE', "top2": 'ACS', "top3": 'AAA'}, f)
+        journal.record({"Case": case_name, "t1": 'PE', "t2": 'ACS', "t3": 'AAA', "Tokens": 10})
+    return save_dir
+
+def test_merge_and_readers_skip_the_manifest(tmp_path):
+    save_dirs = [run_shard(str(tmp_path / f'node{i}'), (i, 2)) for i in range(2)]
+    assert set(read_rep_dir(save_dirs[0])['Case']) == set(shard_cases(CASES, (0, 2)))
+
+    out = tmp_path / 'merged'
+    assert merge(argparse.Namespace(shard_roots=[str(tmp_path / 'node0'), str(tmp_path / 'node1')], output=str(out), overwrite=False)) == 0
+    assert list(read_rep_dir(str(out / REL_DIR))['Case']) == CASES
+
+def test_legacy_manifest(tmp_path):
+    save_dir = run_shard(str(tmp_path), (0, 2))
+    os.replace(os.path.join(save_dir, MANIFEST_NAME), os.path.join(save_dir, LEGACY_MANIFEST_NAME))
+    assert find_shard_dirs(str(tmp_path)) == [REL_DIR]
+    write_manifest(save_dir, (0, 2), 'ER_3DDX_v2.0_NoThoughts_new_rep1.csv', CASES)
+    assert sorted(os.listdir(save_dir)).count(LEGACY_MANIFEST_NAME) == 0
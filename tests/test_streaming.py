@@ -0,0 +1,29 @@
+from streaming import StreamingFieldParser, estimate_usage
+
+RESPONSE = '{"reasoning": {"history": "fever: 3 days"}, "tags": ["a", "b"], "top1": "Pneumonia", "top2": "Sepsis \\"early\\"", "top3": "PE"}'
+
+def feed_chars(parser, text):
+    return [parser.feed(ch) for ch in text]
+
+def test_fields_complete_while_streaming():
+    parser = StreamingFieldParser()
+    done = feed_chars(parser, RESPONSE)
+    assert parser.fields == {"top1": 'Pneumonia', "top2": 'Sepsis "early"', "top3": 'PE'}
+    # Complete as soon as the closing quote of top3 arrives, before the closing brace
+    assert done.index(True) == len(RESPONSE) - 2
+
+def test_preamble_with_colon_and_quotes():
+    parser = StreamingFieldParser()
+    assert parser.feed('Here is my answer: "see below" ```json\n' + RESPONSE + '\n```')
+    assert parser.fields['top1'] == 'Pneumonia'
+
+def test_nested_values_are_skipped():
+    parser = StreamingFieldParser(required=('top1',))
+    parser.feed('{"reasoning": {"top1": "nested"}, "top1": "outer"}')
+    assert parser.fields == {"top1": 'outer'}
+
+def test_estimate_usage():
+    request = {"model": 'gpt-4o', "messages": [{"role": 'user', "content": 'chest pain'}]}
+    usage = estimate_usage(request, '{"top1": "PE"}')
+    assert usage.prompt_tokens > 0 and usage.completion_tokens > 0
+    assert usage.total_tokens == usage.prompt_tokens + usage.completion_tokens
@@ -0,0 +1,58 @@
+import asyncio
+import types
+from key_pool import ApiKey, KeyPool, RetryPolicy
+from telemetry import Telemetry, add_request, current_metrics
+
+class RateLimited(Exception):
+    status_code = 429
+    response = types.SimpleNamespace(headers={'retry-after-ms': '10'})
+
+class FakeRaw:
+    headers = {}
+
+    def parse(self):
+        usage = types.SimpleNamespace(prompt_tokens=10, completion_tokens=5, total_tokens=15, prompt_tokens_details=None)
+        return types.SimpleNamespace(choices=[], usage=usage)
+
+def fake_client(outcomes):
+    async def create(**request):
+        await asyncio.sleep(0.02)
+        outcome = outcomes.pop(0)
+        if outcome == 429:
+            raise RateLimited()
+        return FakeRaw()
+    return types.SimpleNamespace(chat=types.SimpleNamespace(completions=types.SimpleNamespace(with_raw_response=types.SimpleNamespace(create=create))))
+
+def test_call_metrics(tmp_path):
+    telemetry = Telemetry(str(tmp_path), 'test')
+    with telemetry.call(case='Case 1') as metrics:
+        assert current_metrics() is metrics
+        add_request(metrics, FakeRaw().parse().usage)
+    assert current_metrics() is None
+    record = telemetry.records[0]
+    assert record['requests'] == 1 and record['prompt_tokens'] == 10
+    assert 'queue_wait' not in record and record['started'] >= 0
+    telemetry.close()
+
+def test_pool_records_latency_queue_wait_and_retries(tmp_path):
+    telemetry = Telemetry(str(tmp_path), 'test')
+    key = ApiKey('API_KEY_1', 'test-key', max_in_flight=1)
+    key.client = fake_client([429, 200, 200])
+    pool = KeyPool([key], RetryPolicy(max_attempts=3))
+
+    async def call(case_name):
+        with telemetry.call(case=case_name) as metrics:
+            await pool.chat.completions.create(model='gpt-4o', messages=[])
+        return metrics
+
+    async def run():
+        return await asyncio.gather(call('Case 1'), call('Case 2'))
+
+    first, second = asyncio.run(run())
+    # Network time only: two attempts of ~20ms, not the Retry-After pause or the other call
+    assert 0.03 < first['latency'] < 0.1
+    assert first['pool_retries'] == 1
+    assert 0.015 < second['latency'] < 0.06
+    # The second call waited for the single slot
+    assert second['queue_wait'] >= 0.015
+    telemetry.close()